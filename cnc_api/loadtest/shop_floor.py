@@ -0,0 +1,405 @@
+"""
+Closed-loop load generator that simulates a running shop floor.
+Virtual users play three roles against a running server:
+- Planners (admins): create orders with tasks, start them and pass maintenances.
+- Operators: pick tasks in progress, "work" on them and complete them.
+- Dashboards: poll the machine and order lists.
+Every user waits for its answer before the next action (closed loop),
+so the load grows with the number of users, not with a fixed rate.
+
+Use the users created by seed_workshop:
+python -m cnc_api.loadtest.shop_floor --url http://localhost:8000 --planners 2 --operators 20 --dashboards 10 --duration 120
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+MACHINE_TYPES = ["lathe", "mill", "grinder", "other"]
+OPERATIONS = {
+    "lathe": ["turning", "facing", "threading"],
+    "mill": ["milling", "drilling", "pocketing"],
+    "grinder": ["grinding", "honing"],
+    "other": ["deburring", "inspection"],
+}
+# Answer given by the API when a task cannot get a machine
+ASSIGNMENT_CONFLICT = "No machines of the required type available"
+
+
+class HttpError(Exception):
+    pass
+
+
+class HttpClient:
+    """
+    Minimal HTTP/1.1 client on top of asyncio streams.
+    Keeps the connection alive between requests when the server allows it.
+    """
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.token = None
+        self._reader = None
+        self._writer = None
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+        self._reader = self._writer = None
+
+    async def request(self, method, path, payload=None):
+        """Returns (status code, body bytes)."""
+        return await asyncio.wait_for(self._request(method, path, payload), self.timeout)
+
+    async def _request(self, method, path, payload, retry=True):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode() if payload is not None else b""
+        headers = [
+            f"{method} {path} HTTP/1.1",
+            f"Host: {self.host}:{self.port}",
+            "Accept: application/json",
+            "Connection: keep-alive",
+            f"Content-Length: {len(body)}",
+        ]
+        if payload is not None:
+            headers.append("Content-Type: application/json")
+        if self.token:
+            headers.append(f"Authorization: Bearer {self.token}")
+        self._writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            await self.close()
+            if not retry:
+                raise ConnectionResetError("The server closed the connection.")
+            # The server closed the kept alive connection, try again once
+            return await self._request(method, path, payload, retry=False)
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            data = await self._read_chunked()
+        elif "content-length" in response_headers:
+            data = await self._reader.readexactly(int(response_headers["content-length"]))
+        else:
+            # No length: the body ends when the server closes the connection
+            data = await self._reader.read()
+            await self.close()
+        if response_headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, data
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self._reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await self._reader.readline()
+                return b"".join(chunks)
+            chunks.append(await self._reader.readexactly(size))
+            await self._reader.readline()
+
+
+class Stats:
+    """Latencies and errors, per endpoint and per reporting window."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.totals = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.window = []
+        self.window_errors = defaultdict(int)
+        self.timeline = []
+
+    def record(self, label, seconds, outcome):
+        self.totals[label].append(seconds)
+        self.window.append(seconds)
+        if outcome != "ok":
+            self.errors[(label, outcome)] += 1
+            self.window_errors[outcome] += 1
+
+    def flush_window(self, interval):
+        """Closes the current window and returns its summary."""
+        latencies = sorted(self.window)
+        summary = {
+            "elapsed_s": round(time.monotonic() - self.started, 1),
+            "requests": len(latencies),
+            "throughput_rps": round(len(latencies) / interval, 1),
+            "p50_ms": round(_percentile(latencies, 0.50) * 1000, 1),
+            "p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+            "p99_ms": round(_percentile(latencies, 0.99) * 1000, 1),
+            "errors": dict(self.window_errors),
+        }
+        self.timeline.append(summary)
+        self.window = []
+        self.window_errors = defaultdict(int)
+        return summary
+
+    def summary(self):
+        endpoints = {}
+        for label, latencies in sorted(self.totals.items()):
+            latencies = sorted(latencies)
+            endpoints[label] = {
+                "requests": len(latencies),
+                "p50_ms": round(_percentile(latencies, 0.50) * 1000, 1),
+                "p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+                "p99_ms": round(_percentile(latencies, 0.99) * 1000, 1),
+                "errors": {
+                    outcome: count
+                    for (error_label, outcome), count in self.errors.items()
+                    if error_label == label
+                },
+            }
+        return endpoints
+
+
+def _percentile(ordered, share):
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+
+class VirtualUser:
+    """One client of the API with its own connection and token."""
+
+    def __init__(self, options, stats, username, number):
+        self.options = options
+        self.stats = stats
+        self.username = username
+        self.http = HttpClient(options.url, options.timeout)
+        # Every user gets its own reproducible random sequence
+        self.rng = random.Random(f"{options.seed}-{type(self).__name__}-{number}")
+
+    async def call(self, label, method, path, payload=None, retry=True):
+        """
+        Makes a timed request. Returns (status, parsed JSON or None).
+        A 401 logs in again and retries once; a second one is an error.
+        """
+        started = time.monotonic()
+        try:
+            status, body = await self.http.request(method, path, payload)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError) as error:
+            await self.http.close()
+            self.stats.record(label, time.monotonic() - started, type(error).__name__)
+            return None, None
+        elapsed = time.monotonic() - started
+
+        if status == 401 and label != "login" and retry:
+            # Token expired: log in again and retry
+            await self.login()
+            return await self.call(label, method, path, payload, retry=False)
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+
+        if status < 400:
+            outcome = "ok"
+        elif ASSIGNMENT_CONFLICT in body.decode("utf-8", "replace"):
+            outcome = "assignment_conflict"
+        else:
+            outcome = f"http_{status}"
+        self.stats.record(label, elapsed, outcome)
+        return status, data
+
+    async def login(self):
+        status, data = await self.call(
+                "login",
+                "POST",
+                "/api/token/",
+                {"username": self.username, "password": self.options.password}
+        )
+        if status != 200:
+            raise HttpError(f"Login failed for '{self.username}' ({status}).")
+        self.http.token = data["access"]
+
+    async def think(self, mean_seconds):
+        """Random pause between actions (exponential, like human think time)."""
+        await asyncio.sleep(self.rng.expovariate(1 / mean_seconds) if mean_seconds else 0)
+
+    async def run(self, deadline):
+        await self.login()
+        try:
+            while time.monotonic() < deadline:
+                await self.step()
+        finally:
+            await self.http.close()
+
+    async def step(self):
+        raise NotImplementedError
+
+
+class Planner(VirtualUser):
+    """Creates orders, starts them and passes maintenance to machines."""
+
+    async def step(self):
+        action = self.rng.choices(["order", "maintenance"], [8, 2])[0]
+        if action == "order":
+            await self.create_and_start_order()
+        else:
+            await self.pass_maintenance()
+        await self.think(self.options.planner_think)
+
+    async def create_and_start_order(self):
+        status, order = await self.call(
+                "orders-create",
+                "POST",
+                "/api/orders/",
+                {"name": f"Load {self.username} {self.rng.randint(0, 10**6)}"}
+        )
+        if status != 201:
+            return
+        for queue_number in range(1, self.rng.randint(1, 4) + 1):
+            machine_type = self.rng.choice(MACHINE_TYPES)
+            await self.call(
+                    "tasks-create",
+                    "POST",
+                    "/api/tasks/",
+                    {
+                        "order": order["order_id"],
+                        "required_machine_type": machine_type,
+                        "operation": self.rng.choice(OPERATIONS[machine_type]),
+                        "queue_number": queue_number,
+                    }
+            )
+        await self.call("orders-start", "PUT", f"/api/orders/{order['order_id']}/start/")
+
+    async def pass_maintenance(self):
+        status, machines = await self.call("machines-list-maintenance", "GET", "/api/machines/?status=maintenance")
+        if status == 200 and machines:
+            machine = self.rng.choice(machines)
+            await self.call(
+                    "machines-pass_maintenance",
+                    "PUT",
+                    f"/api/machines/{machine['machine_id']}/pass_maintenance/"
+            )
+
+
+class Operator(VirtualUser):
+    """Takes a task in progress, works on it and completes it."""
+
+    async def step(self):
+        status, tasks = await self.call("tasks-list-in_progress", "GET", "/api/tasks/?status=in_progress")
+        if status != 200 or not tasks:
+            # Nothing to do: try to start a pending task
+            status, pending = await self.call("tasks-list-pending", "GET", "/api/tasks/?status=pending")
+            if status == 200 and pending:
+                task = self.rng.choice(pending)
+                await self.call("tasks-start", "PUT", f"/api/tasks/{task['task_id']}/start/")
+            await self.think(self.options.operator_think)
+            return
+
+        task = self.rng.choice(tasks)
+        # Work on the task (log-normal minutes, sped up by --time-scale)
+        minutes = min(self.rng.lognormvariate(3.0, 0.6), 240)
+        await asyncio.sleep(minutes * 60 / self.options.time_scale)
+        await self.call("tasks-complete", "PUT", f"/api/tasks/{task['task_id']}/complete/")
+        await self.think(self.options.operator_think)
+
+
+class Dashboard(VirtualUser):
+    """Polls the machine and order boards."""
+
+    async def step(self):
+        await self.call("machines-list", "GET", "/api/machines/")
+        await self.call("orders-list-in_progress", "GET", "/api/orders/?status=in_progress")
+        await self.think(self.options.dashboard_interval)
+
+
+async def report(stats, interval, deadline):
+    """Prints a line per interval while the test runs."""
+    print(f"{'time':>7} {'req':>6} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8}  errors")
+    while time.monotonic() < deadline:
+        await asyncio.sleep(interval)
+        window = stats.flush_window(interval)
+        errors = ", ".join(f"{name}={count}" for name, count in window["errors"].items()) or "-"
+        print(
+                f"{window['elapsed_s']:>6}s {window['requests']:>6} {window['throughput_rps']:>7} "
+                f"{window['p50_ms']:>6}ms {window['p95_ms']:>6}ms {window['p99_ms']:>6}ms  {errors}"
+        )
+
+
+async def main(options):
+    stats = Stats()
+    deadline = time.monotonic() + options.duration
+    users = (
+        [Planner(options, stats, options.admin, n) for n in range(options.planners)]
+        + [Operator(options, stats, f"{options.operator_prefix}{n % options.operator_accounts}", n)
+           for n in range(options.operators)]
+        + [Dashboard(options, stats, f"{options.operator_prefix}{n % options.operator_accounts}", n)
+           for n in range(options.dashboards)]
+    )
+    reporter = asyncio.create_task(report(stats, options.interval, deadline))
+    results = await asyncio.gather(*(user.run(deadline) for user in users), return_exceptions=True)
+    reporter.cancel()
+
+    failures = [result for result in results if isinstance(result, Exception)]
+    for failure in failures[:5]:
+        print(f"User failed: {failure!r}")
+
+    summary = stats.summary()
+    print(f"\n{'endpoint':<28} {'req':>7} {'p50':>8} {'p95':>8} {'p99':>8}  errors")
+    for label, data in summary.items():
+        errors = ", ".join(f"{name}={count}" for name, count in data["errors"].items()) or "-"
+        print(
+                f"{label:<28} {data['requests']:>7} {data['p50_ms']:>6}ms "
+                f"{data['p95_ms']:>6}ms {data['p99_ms']:>6}ms  {errors}"
+        )
+    total = sum(data["requests"] for data in summary.values())
+    print(f"\n{total} requests in {options.duration}s ({total / options.duration:.1f} req/s)")
+
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump({"endpoints": summary, "timeline": stats.timeline}, output, indent=2)
+        print(f"Results written to {options.output}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulate a busy shop floor against the API.")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run.")
+    parser.add_argument("--planners", type=int, default=1)
+    parser.add_argument("--operators", type=int, default=10)
+    parser.add_argument("--dashboards", type=int, default=5)
+    parser.add_argument("--admin", default="seed_admin")
+    parser.add_argument("--operator-prefix", default="seed_operator_")
+    parser.add_argument("--operator-accounts", type=int, default=10, help="Operator users to rotate.")
+    parser.add_argument("--password", default="seed1234")
+    parser.add_argument("--planner-think", type=float, default=2.0, help="Mean seconds between planner actions.")
+    parser.add_argument("--operator-think", type=float, default=1.0, help="Mean seconds between operator actions.")
+    parser.add_argument("--dashboard-interval", type=float, default=5.0, help="Mean seconds between polls.")
+    parser.add_argument(
+            "--time-scale",
+            type=float,
+            default=600,
+            help="How much faster than real life tasks are worked on (600: 10 minutes take 1 second)."
+    )
+    parser.add_argument("--interval", type=float, default=5, help="Seconds between progress lines.")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the summary and timeline to this JSON file.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,6 +47,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Before the rest so it compresses the final body
+    'cnc_api.workshop.compression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -89,6 +92,41 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Local memory is per process: several workers need a shared backend so the
+# cached responses stay coherent. Set WORKSHOP_CACHE_URL in the environment:
+# redis://host:6379/0 (needs the "redis" package) or memcached://host:11211
+# (needs "pymemcache").
+WORKSHOP_CACHE_URL = os.environ.get("WORKSHOP_CACHE_URL", "")
+
+if WORKSHOP_CACHE_URL.startswith(("redis://", "rediss://")):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': WORKSHOP_CACHE_URL,
+        }
+    }
+elif WORKSHOP_CACHE_URL.startswith("memcached://"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': WORKSHOP_CACHE_URL.removeprefix("memcached://"),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'cnc_api',
+        }
+    }
+
+# Only one process serves the API (runserver). With a per-process cache,
+# the response cache is bypassed unless this is on (see workshop/response_cache.py)
+WORKSHOP_SINGLE_PROCESS = os.environ.get("WORKSHOP_SINGLE_PROCESS", "1" if DEBUG else "0") == "1"
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -133,15 +171,111 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework.authentication.SessionAuthentication",
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "cnc_api.workshop.authentication.WorkshopJWTAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": (
         "rest_framework.permissions.IsAuthenticated",
     ),
     "DEFAULT_FILTER_BACKENDS": [
         "django_filters.rest_framework.DjangoFilterBackend"
-    ]
+    ],
+    # JSON stays the default, MessagePack is chosen with the Accept header
+    "DEFAULT_RENDERER_CLASSES": [
+        "rest_framework.renderers.JSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+        "cnc_api.workshop.renderers.MessagePackRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "rest_framework.parsers.JSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+        "cnc_api.workshop.renderers.MessagePackParser",
+    ],
+    # Token buckets per user and endpoint (budgets in WORKSHOP_THROTTLE_RATES)
+    "DEFAULT_THROTTLE_CLASSES": [
+        "cnc_api.workshop.throttling.TokenBucketThrottle",
+    ],
+}
+
+# The tokens carry the roles of the user so permissions need no queries
+SIMPLE_JWT = {
+    "TOKEN_OBTAIN_SERIALIZER": "cnc_api.workshop.serializers.WorkshopTokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "cnc_api.workshop.serializers.WorkshopTokenRefreshSerializer",
 }
 
 # Tell Swagger that I don't want the old compatibility
-SWAGGER_USE_COMPAT_RENDERERS = False
\ No newline at end of file
+SWAGGER_USE_COMPAT_RENDERERS = False
+
+# Workshop
+# Seconds that the /metrics gauges (machines by status, pending tasks) are cached
+WORKSHOP_METRICS_GAUGE_TTL = 15
+# Who can read /metrics: these client addresses, and any request with
+# "Authorization: Bearer <token>" (None: no token accepted)
+WORKSHOP_METRICS_ALLOWED_IPS = ("127.0.0.1", "::1")
+WORKSHOP_METRICS_TOKEN = os.environ.get("WORKSHOP_METRICS_TOKEN") or None
+# Seconds the roles of a session user are cached (cleared when their groups change)
+WORKSHOP_ROLES_CACHE_TTL = 60
+# Seconds a cached list/detail response is kept (it is invalidated on writes anyway)
+WORKSHOP_RESPONSE_CACHE_TTL = 300
+# Sync endpoint: days the tombstones of deleted rows are kept (older tokens get a 410)
+WORKSHOP_SYNC_TOMBSTONE_DAYS = 30
+# Seconds looked back before the token to catch late commits
+WORKSHOP_SYNC_OVERLAP_SECONDS = 5
+# Rows of each resource per sync page (the rest comes with the "next" cursor)
+WORKSHOP_SYNC_PAGE_SIZE = 1000
+# Build request.user from the JWT claims instead of loading it from the DB
+WORKSHOP_JWT_STATELESS_USER = False
+# Precomputed OpenAPI schema written by "manage.py build_schema" (see workshop/schema.py)
+WORKSHOP_SCHEMA_DIR = BASE_DIR / "schema"
+# Rate limits (see workshop/throttling.py): requests per user and endpoint,
+# also the burst allowed. None disables the limit of that scope
+WORKSHOP_THROTTLE_RATES = {"export": "30/min", "write": "600/min", "read": "3000/min"}
+# Dispatch queue (see workshop/dispatcher.py): "inline" (queries on every
+# assignment), "thread" (in-memory dispatcher in this process, single process only)
+# or "external" (in-memory dispatcher run by "manage.py run_dispatcher")
+WORKSHOP_DISPATCHER = "inline"
+WORKSHOP_DISPATCHER_BATCH_SIZE = 200
+# Seconds between reloads from the DB and between consistency checks
+WORKSHOP_DISPATCHER_RELOAD_SECONDS = 30
+WORKSHOP_DISPATCHER_CHECK_SECONDS = 300
+# Maintenance sweeper (see workshop/sweeper.py): "external" (run by
+# "manage.py run_maintenance_sweeper") or "thread" (in this process)
+WORKSHOP_MAINTENANCE_SWEEPER = "external"
+# Seconds between sweeps (there is always one right after midnight)
+WORKSHOP_MAINTENANCE_SWEEP_SECONDS = 3600
+# Stale task watchdog (see workshop/watchdog.py, "manage.py watch_stale_tasks").
+# A task is overdue after factor x its expected duration + the grace minutes;
+# a factor of None turns that policy off
+WORKSHOP_WATCHDOG_GRACE_MINUTES = 30
+WORKSHOP_WATCHDOG_NOTIFY_FACTOR = 2.0
+WORKSHOP_WATCHDOG_FAIL_FACTOR = None
+# Duration statistics (see workshop/estimates.py): completed tasks a
+# statistic needs before it replaces the estimated durations
+WORKSHOP_STATS_MIN_COUNT = 3
+# Maintenance planner (see workshop/planner.py): days planned ahead
+# and working hours of a machine per day
+WORKSHOP_PLANNER_HORIZON_DAYS = 21
+WORKSHOP_PLANNER_HOURS_PER_DAY = 16
+# Days of recent orders the arriving work per day is averaged on
+WORKSHOP_PLANNER_ARRIVAL_DAYS = 14
+# Matching of queued tasks and idle machines (see workshop/assignment.py)
+# Cost of a task: expected minutes on the machine + these minutes per place
+# in the dispatch order; tasks without estimated_duration count as the default
+WORKSHOP_ASSIGNMENT_RANK_MINUTES = 30
+WORKSHOP_ASSIGNMENT_DEFAULT_MINUTES = 60
+# Response compression (see workshop/compression.py)
+# Encoding -> level, in order of preference (br and zstd only if installed)
+WORKSHOP_COMPRESSION_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+# Bytes below which responses are sent uncompressed
+WORKSHOP_COMPRESSION_MIN_SIZE = 1024
+
+# Request profiling (see workshop/profiling.py)
+# Admins can ask for a profile with the "X-Profile" header or "?profile=1"
+WORKSHOP_PROFILING_ENABLED = True
+# Share of the traffic profiled without asking (0.01 = 1%)
+WORKSHOP_PROFILING_SAMPLE_RATE = 0.0
+# "sampling" (low overhead, collapsed stacks) or "cprofile" (.prof files)
+WORKSHOP_PROFILING_MODE = "sampling"
+WORKSHOP_PROFILING_INTERVAL = 0.005
+WORKSHOP_PROFILING_DIR = BASE_DIR / "profiles"
+WORKSHOP_PROFILING_MAX_FILES = 200
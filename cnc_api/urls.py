@@ -15,52 +15,40 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
-from rest_framework import permissions
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
-
-# Swagger config
-schema_view = get_schema_view(
-        openapi.Info(
-            title="CNC Workshop Manager API",
-            default_version="v1",
-            description="API for managing CNC orders, machines and tasks.",
-            terms_of_service="my_company/ToS",
-            contact=openapi.Contact(email="company@email.com"),
-            license=openapi.License(name="MIT License"),
-        ),
-        public=True,
-        permission_classes=[permissions.AllowAny],
-)
+from cnc_api.workshop.metrics import metrics_view
+# Swagger config (the schema is precomputed, see workshop/schema.py)
+from cnc_api.workshop.schema import SchemaView
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("cnc_api.workshop.urls")),
     # Path for login/logout
     path("api-auth/", include("rest_framework.urls")),
+    # Prometheus scrape endpoint
+    path("metrics", metrics_view, name="metrics"),
     # Obtain an access token and refresh
     path("api/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     # Renew the token?
     path("api/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
+    # Schema alone: /swagger.json and /swagger.yaml
+    re_path(
+            r"^swagger\.(?P<format>json|yaml)$",
+            SchemaView.without_ui(),
+            name="schema-json"
+    ),
     # For Swagger
     path(
             "swagger/", 
-            schema_view.with_ui(
-                "swagger",
-                cache_timeout=0
-            ),
+            SchemaView.with_ui("swagger"),
             name="schema-swagger-ui"
     ),
     # For Redoc
     path(
             "redoc/",
-            schema_view.with_ui(
-                "redoc",
-                cache_timeout=0
-            ),
+            SchemaView.with_ui("redoc"),
             name="schema-redoc"
     ),
 ]
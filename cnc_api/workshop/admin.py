@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Order, Machine, Task, ActivityLog
+from .models import Order, Machine, MachineCapability, Task, ActivityLog, DurationStat
 
 # Register your models here.
 @admin.register(Order)
@@ -10,8 +10,14 @@ class OrderAdmin(admin.ModelAdmin):
     ordering = ("name",)
 
 
+class MachineCapabilityInline(admin.TabularInline):
+    model = MachineCapability
+    extra = 0
+
+
 @admin.register(Machine)
 class MachineAdmin(admin.ModelAdmin):
+    inlines = (MachineCapabilityInline,)
     list_display = ("name", "machine_type", "status", "location", "last_maintenance", "next_maintenance")
     list_filter = ("machine_type", "status")
     search_fields = ("name", "location")
@@ -30,4 +36,12 @@ class ActivityLogAdmin(admin.ModelAdmin):
     list_display = ("time", "log_type", "task", "message", "user")
     list_filter = ("log_type", "time")
     search_fields = ("message",)
-    ordering = ("-time",)
\ No newline at end of file
+    ordering = ("-time",)
+
+
+@admin.register(DurationStat)
+class DurationStatAdmin(admin.ModelAdmin):
+    list_display = ("operation", "machine_type", "machine", "count", "mean_seconds", "updated_at")
+    list_filter = ("machine_type",)
+    search_fields = ("operation",)
+    readonly_fields = ("count", "mean_seconds", "m2", "quantiles", "updated_at")
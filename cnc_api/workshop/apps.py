@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class WorkshopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cnc_api.workshop'
+
+    def ready(self):
+        # Registers the system checks
+        from . import checks  # noqa: F401
+        from . import signals
+        signals.connect()
@@ -0,0 +1,156 @@
+"""
+Assignment of queued tasks to idle machines.
+A machine does the work of its machine_type and of its capabilities
+(MachineCapability), each one at its own speed. A batch of idle machines
+and queued tasks is matched as a minimum cost bipartite assignment, where
+the cost of a task on a machine is its expected time there
+(estimated_duration / speed_factor) plus WORKSHOP_ASSIGNMENT_RANK_MINUTES
+per place in the dispatch order of the candidates, so priorities and
+due dates still count and a long task isn't passed over forever.
+Only the first tasks of each queue are candidates (as many as there are
+machines able to take them): the matrix stays small however long the
+queues are.
+scipy's linear_sum_assignment solves it when scipy is installed,
+the numpy Hungarian algorithm below otherwise.
+"""
+from collections import Counter
+
+import numpy as np
+from django.conf import settings
+
+from .models import MachineCapability
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+# Minutes of a task without estimated_duration
+DEFAULT_TASK_MINUTES = 60
+DEFAULT_RANK_MINUTES = 30
+# Cost of a task on a machine that can't do it: higher than any sum of
+# real costs, so the assignment takes as many feasible pairs as possible
+INFEASIBLE = 1e12
+
+
+def load_speeds(machines):
+    """Machine id -> {machine type it can do: speed factor} (one query)."""
+    speeds = {machine.pk: {machine.machine_type: 1.0} for machine in machines}
+    for machine_id, machine_type, speed_factor in (
+        MachineCapability.objects
+        .filter(machine_id__in=speeds)
+        .values_list("machine_id", "machine_type", "speed_factor")
+    ):
+        speeds[machine_id][machine_type] = speed_factor
+    return speeds
+
+
+def candidate_counts(speeds):
+    """Machine type -> how many of the machines can do it (tasks to look at)."""
+    return Counter(machine_type for capabilities in speeds.values() for machine_type in capabilities)
+
+
+def expected_minutes(estimated_duration):
+    if estimated_duration is None:
+        return getattr(settings, "WORKSHOP_ASSIGNMENT_DEFAULT_MINUTES", DEFAULT_TASK_MINUTES)
+    return estimated_duration.total_seconds() / 60
+
+
+def build_costs(candidates, speeds):
+    """
+    Cost matrix (tasks x machines) and the ids of its rows and columns.
+    candidates: [(task id, machine type, estimated duration)] in dispatch order.
+    speeds: machine id -> {machine type: speed factor}.
+    """
+    rank_minutes = getattr(settings, "WORKSHOP_ASSIGNMENT_RANK_MINUTES", DEFAULT_RANK_MINUTES)
+    task_ids = [task_id for task_id, _, _ in candidates]
+    machine_ids = list(speeds)
+    cost = np.full((len(task_ids), len(machine_ids)), INFEASIBLE)
+    if not task_ids:
+        return cost, task_ids, machine_ids
+
+    machine_types = np.array([machine_type for _, machine_type, _ in candidates])
+    minutes = np.array([expected_minutes(duration) for _, _, duration in candidates])
+    waiting = np.arange(len(candidates)) * rank_minutes
+    for column, machine_id in enumerate(machine_ids):
+        for machine_type, speed_factor in speeds[machine_id].items():
+            rows = machine_types == machine_type
+            cost[rows, column] = minutes[rows] / speed_factor + waiting[rows]
+    return cost, task_ids, machine_ids
+
+
+def hungarian(cost):
+    """
+    Minimum cost assignment of a rectangular matrix (same result as
+    scipy's linear_sum_assignment): arrays of rows and of their columns.
+    Shortest augmenting paths with potentials, O(n^2 m); the inner loop
+    over the columns is vectorized.
+    """
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    # Potentials of the rows and columns; column 0 is the virtual start
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    # Row (1-based) matched to each column, 0 for none
+    row_of = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+
+    for row in range(1, n + 1):
+        row_of[0] = row
+        column = 0
+        min_reduced = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[column] = True
+            current = row_of[column]
+            free = np.flatnonzero(~used[1:]) + 1
+            reduced = cost[current - 1, free - 1] - u[current] - v[free]
+            better = reduced < min_reduced[free]
+            min_reduced[free[better]] = reduced[better]
+            way[free[better]] = column
+            next_column = free[np.argmin(min_reduced[free])]
+            delta = min_reduced[next_column]
+            u[row_of[used]] += delta
+            v[used] -= delta
+            min_reduced[~used] -= delta
+            column = next_column
+            if row_of[column] == 0:
+                break
+        # Flip the augmenting path
+        while column:
+            previous = way[column]
+            row_of[column] = row_of[previous]
+            column = previous
+
+    columns = np.flatnonzero(row_of[1:])
+    rows = row_of[columns + 1] - 1
+    if transposed:
+        rows, columns = columns, rows
+    order = np.argsort(rows)
+    return rows[order], columns[order]
+
+
+def solve(cost):
+    """(row, column) pairs of the minimum cost assignment, feasible pairs only."""
+    if cost.size == 0:
+        return []
+    if linear_sum_assignment is not None:
+        rows, columns = linear_sum_assignment(cost)
+    else:
+        rows, columns = hungarian(cost)
+    return [
+        (row, column) for row, column in zip(rows.tolist(), columns.tolist())
+        if cost[row, column] < INFEASIBLE
+    ]
+
+
+def match(candidates, speeds):
+    """
+    Best (task id, machine id) pairs for these candidates and idle machines
+    (arguments as in build_costs). Tasks and machines left out keep waiting.
+    """
+    cost, task_ids, machine_ids = build_costs(candidates, speeds)
+    return [(task_ids[row], machine_ids[column]) for row, column in solve(cost)]
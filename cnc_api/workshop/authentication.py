@@ -0,0 +1,38 @@
+"""
+JWT authentication for the workshop API.
+With WORKSHOP_JWT_STATELESS_USER on, request.user is built from the claims
+of the access token (id, username, roles) instead of loading the User row.
+Nothing in the API needs more than that: the logs only store the user id
+(services.create_log_event_task).
+Trade-off: a deactivated user keeps access until the token expires
+(ACCESS_TOKEN_LIFETIME, 5 minutes by default).
+"""
+from django.conf import settings
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+
+from .permissions import ROLES_CLAIM
+
+
+class WorkshopTokenUser(TokenUser):
+    """Lightweight user made from a verified access token."""
+
+    @cached_property
+    def roles(self):
+        return tuple(self.token.get(ROLES_CLAIM, ()))
+
+    def get_username(self):
+        return self.username
+
+
+class WorkshopJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that can skip the per-request User query."""
+
+    def get_user(self, validated_token):
+        if not getattr(settings, "WORKSHOP_JWT_STATELESS_USER", False):
+            return super().get_user(validated_token)
+        # Tokens issued before the roles claim existed need the DB
+        if ROLES_CLAIM not in validated_token:
+            return super().get_user(validated_token)
+        return WorkshopTokenUser(validated_token)
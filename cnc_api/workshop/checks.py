@@ -0,0 +1,30 @@
+"""
+System checks of the workshop app (run by manage.py check, runserver, migrate...).
+Registered in WorkshopConfig.ready().
+"""
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+from .response_cache import shared_cache
+
+
+@register(Tags.caches)
+def response_cache_check(app_configs, **kwargs):
+    """The response cache needs a shared backend when several processes serve the API."""
+    if shared_cache():
+        return []
+    hint = "Set WORKSHOP_CACHE_URL to a Redis or Memcached server shared by the workers."
+    if not getattr(settings, "WORKSHOP_SINGLE_PROCESS", False):
+        return [Warning(
+                "The cache backend is per process: the response cache is off.",
+                hint=hint,
+                id="workshop.W001",
+        )]
+    if not settings.DEBUG:
+        return [Warning(
+                "The cache backend is per process and WORKSHOP_SINGLE_PROCESS is on: "
+                "cached responses go stale if more than one process serves the API.",
+                hint=hint,
+                id="workshop.W002",
+        )]
+    return []
@@ -0,0 +1,169 @@
+"""
+Negotiated response compression: zstd, brotli or gzip (Accept-Encoding).
+brotli and zstd are optional packages: an encoding whose package isn't
+installed is never offered.
+Streamed responses (the log exports) are compressed chunk by chunk and
+every chunk is flushed, so the client keeps receiving data while the
+export is being produced.
+Small responses (below WORKSHOP_COMPRESSION_MIN_SIZE) are sent as they are:
+for them the CPU cost and the headers are worth more than the bytes saved.
+"""
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encoding -> level, in order of preference when the client accepts several
+DEFAULT_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+DEFAULT_MIN_SIZE = 1024
+
+# Already compressed, compressing them again only costs CPU
+INCOMPRESSIBLE_TYPES = ("image/", "video/", "audio/", "application/zip", "application/gzip", "application/x-gzip")
+
+
+def _gzip_stream(level):
+    # wbits 16 + MAX_WBITS -> gzip header and trailer instead of raw zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (
+            lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush
+    )
+
+
+def _brotli_stream(level):
+    compressor = brotli.Compressor(quality=level)
+    return (lambda chunk: compressor.process(chunk) + compressor.flush()), compressor.finish
+
+
+def _zstd_stream(level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return (
+            lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+            compressor.flush
+    )
+
+
+def _gzip_compress(content, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(content) + compressor.flush()
+
+
+# Encoding -> (whole body compressor, streaming compressor factory)
+ENCODERS = {"gzip": (_gzip_compress, _gzip_stream)}
+if brotli is not None:
+    ENCODERS["br"] = (lambda content, level: brotli.compress(content, quality=level), _brotli_stream)
+if zstandard is not None:
+    ENCODERS["zstd"] = (lambda content, level: zstandard.ZstdCompressor(level=level).compress(content), _zstd_stream)
+
+
+def get_levels():
+    """Available encodings and their level, in order of preference."""
+    levels = getattr(settings, "WORKSHOP_COMPRESSION_LEVELS", DEFAULT_LEVELS)
+    return {encoding: level for encoding, level in levels.items() if encoding in ENCODERS}
+
+
+def choose_encoding(accept_encoding):
+    """
+    Best encoding of the Accept-Encoding header (or None).
+    Highest q-value wins; on a tie, the order of WORKSHOP_COMPRESSION_LEVELS.
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in get_levels():
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress_stream(chunks, encoding, level):
+    """Compresses an iterator of chunks, flushing after every chunk."""
+    compress_chunk, finish = ENCODERS[encoding][1](level)
+    for chunk in chunks:
+        compressed = compress_chunk(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+
+def _weaken_etag(response):
+    # The compressed body is not byte-for-byte the one the ETag was made for
+    etag = response.get("ETag")
+    if etag and etag.startswith('"'):
+        response["ETag"] = "W/" + etag
+
+
+class CompressionMiddleware:
+    """
+    Compresses the responses for the clients that accept it.
+    Goes near the top of MIDDLEWARE so it sees the final body.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+
+        # Not modified: the client keeps the compressed body it has, same ETag
+        if response.status_code == 304:
+            if encoding:
+                _weaken_etag(response)
+            return response
+
+        if response.has_header("Content-Encoding"):
+            return response
+        if response.get("Content-Type", "").startswith(INCOMPRESSIBLE_TYPES):
+            return response
+        # Async streams are not produced by this API
+        if response.streaming and response.is_async:
+            return response
+        min_size = getattr(settings, "WORKSHOP_COMPRESSION_MIN_SIZE", DEFAULT_MIN_SIZE)
+        if not response.streaming and len(response.content) < min_size:
+            return response
+
+        # The body depends on Accept-Encoding from here on (caches must know)
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if encoding is None:
+            return response
+        level = get_levels()[encoding]
+
+        if response.streaming:
+            response.streaming_content = compress_stream(response.streaming_content, encoding, level)
+            # Unknown until the whole stream is compressed
+            if response.has_header("Content-Length"):
+                del response["Content-Length"]
+        else:
+            compressed = ENCODERS[encoding][0](response.content, level)
+            # Not worth it (already compressed data, random bytes...)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response["Content-Length"] = str(len(compressed))
+
+        _weaken_etag(response)
+        response["Content-Encoding"] = encoding
+        return response
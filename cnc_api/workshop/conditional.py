@@ -0,0 +1,100 @@
+"""
+Conditional GET (ETag / Last-Modified) for the read endpoints.
+The validators come from the rows themselves: MAX(updated_at) and COUNT
+of the rows in the response (the filtered list, or the one row of a
+detail) and of their nested rows (tasks, logs), so they are the same in
+every process and only change when those rows change.
+Each nested relation is aggregated on its own, through an IN subquery
+on the rows of the response, instead of joining the relations together
+(orders x tasks x logs) and counting distinct rows.
+An unchanged poll gets a 304 without running the serializers.
+Counts are part of the ETag so deletions change it too.
+"""
+import hashlib
+
+from django.db.models import Count, Max
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+
+def related_rows(queryset, relation):
+    """
+    Rows of a nested relation ("tasks__logs") of the rows of a queryset:
+    a queryset of the related model filtered by an IN subquery.
+    """
+    model = queryset.model
+    remote_names = []
+    for name in relation.split("__"):
+        field = model._meta.get_field(name)
+        # Reverse foreign key (related_name): the FK is on the related model
+        remote_names.append(field.field.name)
+        model = field.related_model
+    lookup = "__".join(reversed(remote_names)) + "__in"
+    return model._default_manager.filter(**{lookup: queryset.order_by().values("pk")})
+
+
+class ConditionalGetMixin:
+    """
+    Adds ETag/Last-Modified to list and retrieve and answers 304 when
+    the client already has the current version.
+    `conditional_relations` are the nested relations shown by the serializer.
+    """
+    conditional_relations = ()
+
+    def get_conditional_relations(self):
+        return self.conditional_relations
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.conditional_response(queryset, super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+                **{self.lookup_field: kwargs[lookup_url_kwarg]}
+        )
+        return self.conditional_response(queryset, super().retrieve, request, *args, **kwargs)
+
+    def get_validators(self, queryset):
+        """(etag, last_modified, count) of the rows of the queryset and their nested rows."""
+        values = queryset.order_by().aggregate(updated=Max("updated_at"), count=Count("pk"))
+        for position, relation in enumerate(self.get_conditional_relations()):
+            nested = related_rows(queryset, relation).order_by().aggregate(
+                    updated=Max("updated_at"), count=Count("pk")
+            )
+            values[f"updated_{position}"] = nested["updated"]
+            values[f"count_{position}"] = nested["count"]
+
+        stamps = [value for name, value in values.items() if name.startswith("updated") and value]
+        last_modified = max(stamps) if stamps else None
+        media_type = getattr(self.request, "accepted_media_type", "")
+        raw = f"{self.request.get_full_path()}|{media_type}|{sorted(values.items())}"
+        etag = f'"{hashlib.sha1(raw.encode("utf-8")).hexdigest()}"'
+        return etag, last_modified, values["count"]
+
+    def conditional_response(self, queryset, handler, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return handler(request, *args, **kwargs)
+
+        etag, last_modified, count = self.get_validators(queryset)
+        not_modified = False
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match:
+            # Weak comparison: the compression middleware sends the ETag as W/"..."
+            client_etags = [tag.removeprefix("W/") for tag in parse_etags(if_none_match)]
+            not_modified = etag in client_etags or if_none_match.strip() == "*"
+        elif last_modified and self.action == "retrieve":
+            # Only for details: a deleted row in a list doesn't move MAX(updated_at)
+            if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+            not_modified = if_modified_since is not None and int(last_modified.timestamp()) <= if_modified_since
+
+        if not_modified and (count or self.action == "list"):
+            response = HttpResponseNotModified()
+        else:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified.timestamp())
+        return response
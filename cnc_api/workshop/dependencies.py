@@ -0,0 +1,163 @@
+"""
+Task dependencies inside an order.
+Every task can declare predecessors (tasks of the same order that must be
+completed first); together they form a DAG, so independent branches
+(milling and grinding of different parts...) run in parallel.
+Orders whose tasks declare no predecessors keep the old behaviour:
+a chain ordered by queue_number.
+Everything here works on the whole order at once (two queries),
+orders have a handful of tasks.
+"""
+from datetime import timedelta
+
+from .models import Task
+
+
+class CycleError(ValueError):
+    pass
+
+
+def load_order_graph(order_id, implicit_chain=True):
+    """
+    (tasks by id, predecessor ids by task id) of an order.
+    Without explicit predecessors, each task depends on the previous one
+    by queue_number (unless implicit_chain is False).
+    """
+    tasks = {task.pk: task for task in Task.objects.filter(order_id=order_id)}
+    predecessors = {task_id: set() for task_id in tasks}
+    edges = Task.predecessors.through.objects.filter(from_task__order_id=order_id)
+    for task_id, predecessor_id in edges.values_list("from_task_id", "to_task_id"):
+        predecessors[task_id].add(predecessor_id)
+
+    if implicit_chain and not any(predecessors.values()):
+        chain = sorted(tasks.values(), key=lambda task: task.queue_number)
+        for previous, task in zip(chain, chain[1:]):
+            predecessors[task.pk].add(previous.pk)
+    return tasks, predecessors
+
+
+def topological_order(predecessors):
+    """Task ids with every task after its predecessors. CycleError on a cycle."""
+    remaining = {task_id: set(preds) for task_id, preds in predecessors.items()}
+    ordered = []
+    ready = sorted((task_id for task_id, preds in remaining.items() if not preds), key=str)
+    while ready:
+        task_id = ready.pop()
+        ordered.append(task_id)
+        del remaining[task_id]
+        for other_id, preds in remaining.items():
+            if task_id in preds:
+                preds.discard(task_id)
+                if not preds:
+                    ready.append(other_id)
+    if remaining:
+        raise CycleError("Task dependencies can't form a cycle.")
+    return ordered
+
+
+def creates_cycle(task_id, new_predecessor_ids, predecessors):
+    """True if giving these predecessors to the task closes a cycle."""
+    graph = {key: set(value) for key, value in predecessors.items()}
+    graph[task_id] = set(new_predecessor_ids)
+    try:
+        topological_order(graph)
+    except CycleError:
+        return True
+    return False
+
+
+def ready_tasks(order_id):
+    """
+    Pending tasks of the order whose predecessors are all completed
+    and that are not waiting in the dispatch queue already.
+    """
+    tasks, predecessors = load_order_graph(order_id)
+    ready = [
+        task for task_id, task in tasks.items()
+        if task.status == "pending"
+        and task.queued_at is None
+        and all(tasks[pred].status == "completed" for pred in predecessors[task_id])
+    ]
+    return sorted(ready, key=lambda task: task.queue_number)
+
+
+def blocked_tasks(tasks, predecessors):
+    """
+    Ids of the pending tasks that can't start anymore: a task before them
+    (directly or through others) failed. They stay blocked until the
+    failed task is dealt with.
+    """
+    blocked = set()
+    for task_id in topological_order(predecessors):
+        if tasks[task_id].status == "pending" and any(
+            tasks[pred].status == "failed" or pred in blocked for pred in predecessors[task_id]
+        ):
+            blocked.add(task_id)
+    return sorted(blocked, key=lambda task_id: tasks[task_id].queue_number)
+
+
+def task_duration(task):
+    """Actual time for completed tasks, the estimate otherwise (None if unknown)."""
+    if task.status == "completed" and task.start_time and task.finish_time:
+        return task.finish_time - task.start_time
+    return task.estimated_duration
+
+
+def critical_path(order_id):
+    """
+    Longest chain of dependent tasks: the minimum time the order needs
+    with unlimited machines (its makespan), and the slack of every task
+    (how much it can be delayed without delaying the order).
+    Tasks without an estimate count as 0 and are listed as unestimated.
+    Tasks that can't start because of a failed task are listed as blocked.
+    """
+    tasks, predecessors = load_order_graph(order_id)
+    ordered = topological_order(predecessors)
+    durations = {}
+    unestimated = []
+    for task_id in ordered:
+        durations[task_id] = task_duration(tasks[task_id])
+        if durations[task_id] is None:
+            unestimated.append(task_id)
+            durations[task_id] = timedelta(0)
+
+    # Forward pass: earliest finish
+    finish = {}
+    for task_id in ordered:
+        start = max((finish[pred] for pred in predecessors[task_id]), default=timedelta(0))
+        finish[task_id] = start + durations[task_id]
+    makespan = max(finish.values(), default=timedelta(0))
+
+    # Backward pass: latest finish that doesn't delay the order
+    latest = {task_id: makespan for task_id in ordered}
+    for task_id in reversed(ordered):
+        for pred in predecessors[task_id]:
+            latest[pred] = min(latest[pred], latest[task_id] - durations[task_id])
+
+    # The critical path: zero slack tasks, following the dependencies
+    path = []
+    candidates = [task_id for task_id in ordered if finish[task_id] == makespan]
+    task_id = candidates[0] if candidates else None
+    while task_id is not None:
+        path.append(task_id)
+        start = finish[task_id] - durations[task_id]
+        task_id = next((pred for pred in predecessors[task_id] if finish[pred] == start), None)
+    path.reverse()
+
+    return {
+        "makespan_minutes": _minutes(makespan),
+        "critical_path": [str(task_id) for task_id in path],
+        "tasks": {
+            str(task_id): {
+                "earliest_finish_minutes": _minutes(finish[task_id]),
+                "slack_minutes": _minutes(latest[task_id] - finish[task_id]),
+            }
+            for task_id in ordered
+        },
+        "unestimated": [str(task_id) for task_id in unestimated],
+        "blocked": [str(task_id) for task_id in blocked_tasks(tasks, predecessors)],
+    }
+
+
+def _minutes(duration):
+    return round(duration.total_seconds() / 60, 1)
@@ -0,0 +1,376 @@
+"""
+In-memory dispatcher (optional, see WORKSHOP_DISPATCHER).
+Keeps a dict of the idle machines (machine id -> speed factor per machine
+type it can do) and, per machine type, a heap of the queued tasks (same
+order as DISPATCH_ORDER), so a batch of assignments is a few heap pops
+and one matching instead of queries.
+The decisions are written in batches, one transaction per batch, and
+rows that changed in the DB meanwhile (a machine taken by hand...) are
+rejected instead of overwritten. Only the rejected tasks and machines
+are then reloaded from the DB, not the whole state.
+
+Modes:
+- "inline" (default): no dispatcher, services.dispatch_machine queries the DB.
+- "thread": a thread of the API process; the services hand it the events
+  (machine idle, task queued) through a local queue. Only for a single
+  API process: every process would run its own dispatcher.
+- "external": the "run_dispatcher" command runs it as its own process,
+  which picks up the changes by reloading from the DB every few seconds.
+The state is rebuilt from the DB on startup and every
+WORKSHOP_DISPATCHER_RELOAD_SECONDS, and check_consistency() compares it
+with the DB (drift is logged and the drifted rows are reloaded).
+
+Writes that don't go through the services bypass the state: a direct
+PUT /tasks/{id}/start/ takes a machine the state still has as idle (and
+may start a task still in a heap). In thread mode nothing tells the
+dispatcher; the decision using that machine or task is rejected by
+persist() and only then are they reloaded. Until the next periodic
+reload the state can also miss machines freed that way.
+"""
+import heapq
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import metrics
+from .assignment import candidate_counts, load_speeds, match
+from .estimates import load_stats, predict_finish
+from .models import ActivityLog, Machine, Order, Task
+from .response_cache import bump_versions
+
+logger = logging.getLogger(__name__)
+
+
+def get_mode():
+    return getattr(settings, "WORKSHOP_DISPATCHER", "inline")
+
+
+def dispatch_key(priority, due_date, queued_at):
+    """Heap key: highest priority, earliest due date (none last), first queued."""
+    return (
+        -priority,
+        due_date.toordinal() if due_date else float("inf"),
+        queued_at.timestamp(),
+    )
+
+
+class DispatcherState:
+    """Idle machines and queued tasks by machine type."""
+
+    def __init__(self):
+        # machine id -> {machine type it can do: speed factor}
+        self.idle = {}
+        # machine type -> heap of (dispatch key, task id)
+        self.queued = defaultdict(list)
+        # task id -> dispatch key of its live heap entry. Heaps can't remove
+        # from the middle: entries of dropped tasks (or with an old key)
+        # stay in the heap and are skipped when popped.
+        self.keys = {}
+        # task id -> estimated duration (for the assignment costs)
+        self.durations = {}
+
+    @property
+    def queued_ids(self):
+        return self.keys.keys()
+
+    def load(self):
+        """Rebuilds everything from the DB (three queries)."""
+        self.__init__()
+        self._load_rows(idle_machines(), queued_tasks())
+
+    def refresh(self, task_ids=(), machine_ids=()):
+        """
+        Drops these tasks and machines and loads back the ones the DB
+        still has queued or idle (three queries at most).
+        """
+        for task_id in task_ids:
+            self.drop_task(task_id)
+        for machine_id in machine_ids:
+            self.idle.pop(machine_id, None)
+        self._load_rows(
+                idle_machines().filter(pk__in=machine_ids) if machine_ids else Machine.objects.none(),
+                queued_tasks().filter(pk__in=task_ids) if task_ids else Task.objects.none()
+        )
+
+    def _load_rows(self, machines, tasks):
+        for machine_id, speeds in load_speeds(machines).items():
+            self.add_machine(machine_id, speeds)
+        for task_id, machine_type, priority, due_date, queued_at, estimated_duration in tasks.values_list(
+                "task_id", "required_machine_type", "priority", "due_date", "queued_at", "estimated_duration"
+        ):
+            self.add_task(task_id, machine_type, dispatch_key(priority, due_date, queued_at), estimated_duration)
+
+    def add_machine(self, machine_id, speeds):
+        self.idle.setdefault(machine_id, speeds)
+
+    def add_task(self, task_id, machine_type, key, estimated_duration=None):
+        if task_id not in self.keys:
+            self.keys[task_id] = key
+            self.durations[task_id] = estimated_duration
+            heapq.heappush(self.queued[machine_type], (key, task_id))
+
+    def drop_task(self, task_id):
+        # Its heap entry is skipped from now on
+        self.keys.pop(task_id, None)
+        self.durations.pop(task_id, None)
+
+    def assign(self):
+        """
+        Matches the idle machines with the heads of the queues they can take
+        (assignment.match). Pops as many tasks of each queue as machines
+        can do its type, and pushes back the ones left waiting.
+        """
+        popped, seen = [], set()
+        for machine_type, count in candidate_counts(self.idle).items():
+            heap = self.queued.get(machine_type)
+            while heap and count:
+                key, task_id = heapq.heappop(heap)
+                # Dropped (or re-added with the same key: keep one entry)
+                if self.keys.get(task_id) != key or task_id in seen:
+                    continue
+                seen.add(task_id)
+                popped.append((key, task_id, machine_type))
+                count -= 1
+        if not popped:
+            return []
+
+        popped.sort()
+        decisions = match(
+                [(task_id, machine_type, self.durations[task_id]) for _, task_id, machine_type in popped],
+                self.idle
+        )
+        assigned = {task_id for task_id, _ in decisions}
+        for key, task_id, machine_type in popped:
+            if task_id not in assigned:
+                heapq.heappush(self.queued[machine_type], (key, task_id))
+        for task_id, machine_id in decisions:
+            self.drop_task(task_id)
+            del self.idle[machine_id]
+        return decisions
+
+
+def idle_machines():
+    """Machines the dispatcher can give tasks to."""
+    # Due machines go to maintenance, they don't take tasks
+    return (
+        Machine.objects
+        .filter(status="idle")
+        .exclude(Machine.due_for_maintenance(timezone.now().date()))
+        .only("machine_id", "machine_type")
+    )
+
+
+def queued_tasks():
+    return Task.objects.filter(status="pending", queued_at__isnull=False)
+
+
+def persist(decisions):
+    """
+    Writes the decisions in one transaction: a few bulk statements
+    for the whole batch instead of saves per task.
+    Returns (applied, rejected) decisions; rejected ones found the task
+    or the machine changed in the DB.
+    """
+    if not decisions:
+        return [], []
+    now = timezone.now()
+    with transaction.atomic():
+        machines = Machine.objects.select_for_update().in_bulk(
+                [machine_id for _, machine_id in decisions]
+        )
+        tasks = Task.objects.select_for_update().in_bulk([task_id for task_id, _ in decisions])
+        applied, rejected = [], []
+        for task_id, machine_id in decisions:
+            task, machine = tasks.get(task_id), machines.get(machine_id)
+            if (
+                task is None or machine is None
+                or machine.status != "idle"
+                # Due since the state was loaded: left for the maintenance sweeper
+                or machine.needs_maintenance
+                or task.status != "pending" or task.queued_at is None
+            ):
+                rejected.append((task_id, machine_id))
+                continue
+            task.machine = machine
+            task.status = "in_progress"
+            task.start_time = now
+            task.queued_at = None
+            task.updated_at = now
+            applied.append((task, machine))
+
+        if applied:
+            stats = load_stats([task for task, _ in applied])
+            for task, _ in applied:
+                task.predicted_finish = predict_finish(task, stats)
+            Task.objects.bulk_update(
+                    [task for task, _ in applied],
+                    ["machine", "status", "start_time", "predicted_finish", "queued_at", "updated_at"]
+            )
+            Machine.objects.filter(pk__in=[machine.pk for _, machine in applied]).update(
+                    status="running", updated_at=now
+            )
+            # The first task of an order that couldn't start
+            Order.objects.filter(pk__in={task.order_id for task, _ in applied}, status="pending").update(
+                    status="in_progress", date_start=now, updated_at=now
+            )
+            ActivityLog.objects.bulk_create([
+                ActivityLog(
+                        task=task,
+                        log_type="info",
+                        message=f"[INFO] - '{task.operation}' started on machine '{machine.name}' (from the dispatch queue)."
+                )
+                for task, machine in applied
+            ])
+            # Bulk writes don't send signals
+            bump_versions("order", "machine", "task", "activitylog")
+
+    for task, machine in applied:
+        metrics.TASKS_STARTED.inc(machine_type=task.required_machine_type)
+        metrics.TASKS_DISPATCHED.inc(machine_type=machine.machine_type)
+    return [(task.pk, machine.pk) for task, machine in applied], rejected
+
+
+def find_drift(state):
+    """
+    Ids where the state and the DB differ (empty sets when they agree).
+    "missing": in the DB but not in memory; "extra": in memory but not in the DB.
+    """
+    fresh = DispatcherState()
+    fresh.load()
+    return {
+        "idle_missing": fresh.idle.keys() - state.idle.keys(),
+        "idle_extra": state.idle.keys() - fresh.idle.keys(),
+        "queued_missing": fresh.queued_ids - state.queued_ids,
+        "queued_extra": state.queued_ids - fresh.queued_ids,
+    }
+
+
+def check_consistency(state):
+    """find_drift() with the ids as sorted strings (for logs and tests)."""
+    return {name: sorted(map(str, ids)) for name, ids in find_drift(state).items()}
+
+
+class Dispatcher:
+    """
+    Applies the events of the inbox to the state, assigns and persists.
+    Events: ("machine_idle", machine_id, {machine type: speed factor}),
+    ("task_queued", task_id, machine_type, dispatch key, estimated duration)
+    and ("reload",).
+    """
+
+    def __init__(self, batch_size=None, reload_seconds=None, check_seconds=None):
+        self.state = DispatcherState()
+        self.inbox = queue.Queue()
+        self.batch_size = batch_size or getattr(settings, "WORKSHOP_DISPATCHER_BATCH_SIZE", 200)
+        self.reload_seconds = reload_seconds or getattr(settings, "WORKSHOP_DISPATCHER_RELOAD_SECONDS", 30)
+        self.check_seconds = check_seconds or getattr(settings, "WORKSHOP_DISPATCHER_CHECK_SECONDS", 300)
+        # monotonic() of the last reload and consistency check
+        self.loaded_at = self.checked_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, *event):
+        self.inbox.put(event)
+
+    def reload(self):
+        self.state.load()
+        # A fresh state agrees with the DB, no need to check it soon
+        self.loaded_at = self.checked_at = time.monotonic()
+
+    def run_once(self, timeout=0.0):
+        """
+        Waits up to `timeout` for an event, takes the rest of the batch,
+        and persists the assignments. Returns the applied decisions.
+        """
+        events = []
+        try:
+            events.append(self.inbox.get(timeout=timeout) if timeout else self.inbox.get_nowait())
+            while len(events) < self.batch_size:
+                events.append(self.inbox.get_nowait())
+        except queue.Empty:
+            pass
+
+        if (
+            self.loaded_at is None
+            or time.monotonic() - self.loaded_at >= self.reload_seconds
+            or any(event[0] == "reload" for event in events)
+        ):
+            self.reload()
+            events = []
+        for event in events:
+            if event[0] == "machine_idle":
+                self.state.add_machine(event[1], event[2])
+            elif event[0] == "task_queued":
+                self.state.add_task(*event[1:])
+
+        applied, rejected = persist(self.state.assign())
+        if rejected:
+            # Those rows changed behind our back: reload just them from the DB
+            logger.info("Dispatcher: %s decisions rejected, reloading their rows.", len(rejected))
+            self.state.refresh(
+                    [task_id for task_id, _ in rejected], [machine_id for _, machine_id in rejected]
+            )
+        if time.monotonic() - self.checked_at >= self.check_seconds:
+            self.checked_at = time.monotonic()
+            drift = find_drift(self.state)
+            if any(drift.values()):
+                logger.warning(
+                        "Dispatcher state differs from the DB: %s",
+                        {name: sorted(map(str, ids)) for name, ids in drift.items()}
+                )
+                metrics.DISPATCHER_DRIFT.inc()
+                self.state.refresh(
+                        list(drift["queued_missing"] | drift["queued_extra"]),
+                        list(drift["idle_missing"] | drift["idle_extra"])
+                )
+        return applied
+
+    def run(self, poll_seconds=1.0):
+        """Loop of the thread/process until stop()."""
+        self.reload()
+        while not self._stop.is_set():
+            try:
+                self.run_once(timeout=poll_seconds)
+            except Exception:
+                logger.exception("Dispatcher pass failed, reloading.")
+                self.loaded_at = None
+            finally:
+                close_old_connections()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="workshop-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """The dispatcher thread of this process (started on first use)."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher()
+            _dispatcher.start()
+    return _dispatcher
+
+
+def notify(*event):
+    """
+    Hands an event to the dispatcher thread once the transaction commits
+    (before that, the dispatcher couldn't see the rows).
+    """
+    if get_mode() == "thread":
+        transaction.on_commit(lambda: get_dispatcher().submit(*event))
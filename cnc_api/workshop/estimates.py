@@ -0,0 +1,214 @@
+"""
+Duration statistics and ETAs.
+Every completed task adds its duration to two DurationStat rows: its
+operation on its machine, and its operation on any machine of the type.
+The rows keep count, mean and variance (Welford) and the median and
+90th percentile (P² estimators, five markers each): a completion
+updates two rows, whatever the size of the history.
+The ETAs only read these rows:
+- Task.predicted_finish, set when a task starts: start + expected duration.
+- projected_completion(order): the earliest finish of the order,
+  following the task dependencies (unlimited machines, like the critical path).
+Expected duration of a task: the statistic of its machine once it has
+WORKSHOP_STATS_MIN_COUNT observations, else the one of the machine type,
+else its estimated_duration, else the default of the assignment.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .assignment import expected_minutes
+from .dependencies import load_order_graph, topological_order
+from .models import DurationStat
+
+QUANTILES = (0.5, 0.9)
+DEFAULT_MIN_COUNT = 3
+
+
+class P2Quantile:
+    """
+    P² estimator of a quantile (Jain & Chlamtac): five markers whose
+    heights follow the minimum, p/2, p, (1+p)/2 and the maximum, moved by
+    a parabolic (else linear) step after every observation.
+    The state is a dict, stored in DurationStat.quantiles.
+    """
+
+    def __init__(self, p, state=None):
+        self.p = p
+        state = state or {}
+        # Heights; the first five observations, sorted, until there are five
+        self.heights = list(state.get("heights", []))
+        self.positions = list(state.get("positions", [1, 2, 3, 4, 5]))
+        self.desired = list(state.get("desired", [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]))
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def state(self):
+        return {"heights": self.heights, "positions": self.positions, "desired": self.desired}
+
+    def add(self, x):
+        q, n = self.heights, self.positions
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        # Cell of the observation, stretching the extremes if needed
+        if x < q[0]:
+            q[0] = x
+            cell = 0
+        elif x >= q[4]:
+            q[4] = x
+            cell = 3
+        else:
+            cell = next(i for i in range(4) if q[i] <= x < q[i + 1])
+        for i in range(cell + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Move the middle markers toward their desired positions
+        for i in (1, 2, 3):
+            offset = self.desired[i] - n[i]
+            if (offset >= 1 and n[i + 1] - n[i] > 1) or (offset <= -1 and n[i - 1] - n[i] < -1):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+                q[i] = height
+                n[i] += step
+
+    def _parabolic(self, i, step):
+        q, n = self.heights, self.positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self):
+        """The estimate (the exact quantile of the sample while it's below five)."""
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[round(self.p * (len(self.heights) - 1))]
+        return self.heights[2]
+
+
+def observe(stat, seconds):
+    """Adds one duration to the statistics of a row (not saved)."""
+    stat.count += 1
+    delta = seconds - stat.mean_seconds
+    stat.mean_seconds += delta / stat.count
+    stat.m2 += delta * (seconds - stat.mean_seconds)
+    quantiles = {}
+    for p in QUANTILES:
+        estimator = P2Quantile(p, stat.quantiles.get(str(p)))
+        estimator.add(seconds)
+        quantiles[str(p)] = estimator.state()
+    stat.quantiles = quantiles
+
+
+def quantile_seconds(stat, p):
+    return P2Quantile(p, stat.quantiles.get(str(p))).value()
+
+
+def record_duration(task):
+    """
+    Adds a completed task to the statistics of its machine and machine type.
+    Once per task: called by services.complete_task with the task locked.
+    """
+    if not (task.start_time and task.finish_time):
+        return
+    seconds = (task.finish_time - task.start_time).total_seconds()
+    with transaction.atomic():
+        for machine in ([task.machine, None] if task.machine_id else [None]):
+            # Locked: two completions of the same operation don't lose an update
+            stat, _ = DurationStat.objects.select_for_update().get_or_create(
+                    operation=task.operation,
+                    machine_type=task.required_machine_type,
+                    machine=machine,
+            )
+            observe(stat, seconds)
+            stat.save()
+
+
+def load_stats(tasks):
+    """
+    Statistics that can give the expected duration of these tasks (one query):
+    (operation, machine type, machine id or None) -> DurationStat.
+    """
+    operations = {task.operation for task in tasks}
+    machine_types = {task.required_machine_type for task in tasks}
+    machine_ids = {task.machine_id for task in tasks if task.machine_id}
+    rows = DurationStat.objects.filter(
+            Q(machine__isnull=True) | Q(machine_id__in=machine_ids),
+            operation__in=operations,
+            machine_type__in=machine_types,
+    )
+    return {(stat.operation, stat.machine_type, stat.machine_id): stat for stat in rows}
+
+
+def expected_duration(task, stats, quantile=None):
+    """
+    Expected duration of a task on its machine (or on any machine of the
+    type if it has none yet): the mean, or the given quantile.
+    """
+    min_count = getattr(settings, "WORKSHOP_STATS_MIN_COUNT", DEFAULT_MIN_COUNT)
+    keys = [(task.operation, task.required_machine_type, None)]
+    if task.machine_id:
+        keys.insert(0, (task.operation, task.required_machine_type, task.machine_id))
+    for key in keys:
+        stat = stats.get(key)
+        if stat is not None and stat.count >= min_count:
+            seconds = stat.mean_seconds if quantile is None else quantile_seconds(stat, quantile)
+            return timedelta(seconds=seconds)
+    if task.estimated_duration is not None:
+        return task.estimated_duration
+    return timedelta(minutes=expected_minutes(None))
+
+
+def predict_finish(task, stats):
+    """start_time + expected duration (for a task that is starting)."""
+    return task.start_time + expected_duration(task, stats)
+
+
+def projected_completion(order_id, now=None):
+    """
+    When the order should be completed: the latest earliest finish of its
+    tasks, each one starting when its predecessors finish (and not before now).
+    With the means and with the 90th percentiles (a pessimistic date).
+    """
+    now = now or timezone.now()
+    tasks, predecessors = load_order_graph(order_id)
+    ordered = topological_order(predecessors)
+    stats = load_stats(tasks.values())
+
+    projection = {}
+    for quantile in (None, 0.9):
+        finish = {}
+        for task_id in ordered:
+            task = tasks[task_id]
+            if task.status in ("completed", "failed"):
+                finish[task_id] = task.finish_time or now
+            elif task.status == "in_progress":
+                expected = task.start_time + expected_duration(task, stats, quantile)
+                # Late already: it should finish any moment now
+                finish[task_id] = max(now, expected)
+            else:
+                start = max([now, *(finish[pred] for pred in predecessors[task_id])])
+                finish[task_id] = start + expected_duration(task, stats, quantile)
+        projection[quantile] = finish
+
+    return {
+        "projected_completion": max(projection[None].values(), default=None),
+        "projected_completion_p90": max(projection[0.9].values(), default=None),
+        "tasks": {
+            str(task_id): {
+                "status": tasks[task_id].status,
+                "predicted_finish": projection[None][task_id],
+                "predicted_finish_p90": projection[0.9][task_id],
+            }
+            for task_id in ordered
+        },
+    }
@@ -0,0 +1,354 @@
+"""
+Benchmarks every public endpoint against the current database
+(usually filled with seed_workshop).
+For each endpoint it records p50/p95 latency, query count and peak memory.
+Write endpoints run inside a transaction that is rolled back, so the
+data is the same on every iteration.
+Every measured run is a cache miss (the response cache versions are bumped
+before it, untimed). Read endpoints are also measured warm, served from
+the response cache, and reported apart ("warm").
+Cases without a row to work on (no machine to put under maintenance...)
+are skipped, and so are write cases that don't succeed (a 400 would time
+the error path, not the endpoint).
+
+Examples:
+python manage.py bench_endpoints --output bench/baseline.json
+python manage.py bench_endpoints --compare bench/baseline.json --threshold 0.2
+python manage.py bench_endpoints --auth jwt-stateless --compare bench/baseline.json
+"""
+import json
+import logging
+import math
+import platform
+import time
+import tracemalloc
+
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from cnc_api.workshop.models import ActivityLog, Machine, MachineCapability, Order, Task
+from cnc_api.workshop.response_cache import RESOURCES, bump_versions
+from cnc_api.workshop.serializers import WorkshopTokenObtainPairSerializer
+
+
+def percentile(values, share):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    position = max(0, math.ceil(share * len(ordered)) - 1)
+    return ordered[position]
+
+
+class SkipCase(Exception):
+    """The case can't be measured: no row to work on, or a write that fails."""
+
+
+class BenchmarkCase:
+    """
+    One endpoint to benchmark.
+    `prepare` runs before every iteration (not timed) and returns the URL,
+    None when there is no row to work on.
+    Cases with `writes` run inside a rolled back transaction.
+    """
+
+    def __init__(self, name, method, prepare, writes=False):
+        self.name = name
+        self.method = method
+        self.prepare = prepare
+        self.writes = writes
+
+
+def _first_pk(queryset):
+    """Primary key of the first row, None if there are none."""
+    return queryset.values_list("pk", flat=True).first()
+
+
+def _available_types():
+    """
+    Machine types an idle machine that isn't due for maintenance can do
+    (its own type and its capabilities), like the services check.
+    """
+    machines = Machine.objects.filter(status="idle").exclude(Machine.due_for_maintenance(timezone.now().date()))
+    types = set(machines.values_list("machine_type", flat=True))
+    types.update(
+            MachineCapability.objects.filter(machine__in=machines).values_list("machine_type", flat=True)
+    )
+    return types
+
+
+def _startable_task():
+    """A pending task with an available machine for its type."""
+    return _first_pk(Task.objects.filter(status="pending", required_machine_type__in=_available_types()))
+
+
+def _startable_order():
+    """A pending order whose first task can get a machine."""
+    return _first_pk(
+            Order.objects.filter(
+                status="pending",
+                tasks__queue_number=1,
+                tasks__required_machine_type__in=_available_types(),
+            )
+    )
+
+
+def _machine_in_maintenance():
+    """A machine under maintenance. Puts an idle one there if there are none."""
+    pk = _first_pk(Machine.objects.filter(status="maintenance"))
+    if pk is None:
+        pk = _first_pk(Machine.objects.filter(status="idle"))
+        if pk is not None:
+            Machine.objects.filter(pk=pk).update(status="maintenance")
+    return pk
+
+
+def _detail_url(resource, pk, action=""):
+    """URL of a row (and action), None without a row."""
+    if pk is None:
+        return None
+    return f"/api/{resource}/{pk}/{action + '/' if action else ''}"
+
+
+def build_cases():
+    """Every public endpoint of the API."""
+    cases = []
+    resources = [
+        ("orders", Order),
+        ("machines", Machine),
+        ("tasks", Task),
+        ("activitylogs", ActivityLog),
+    ]
+    for resource, model in resources:
+        cases.append(BenchmarkCase(f"{resource}-list", "get", lambda r=resource: f"/api/{r}/"))
+        cases.append(BenchmarkCase(
+                f"{resource}-retrieve",
+                "get",
+                lambda r=resource, m=model: _detail_url(r, _first_pk(m.objects.order_by("pk")))
+        ))
+    cases += [
+        BenchmarkCase("orders-start", "put", lambda: _detail_url("orders", _startable_order(), "start"), writes=True),
+        BenchmarkCase("tasks-start", "put", lambda: _detail_url("tasks", _startable_task(), "start"), writes=True),
+        BenchmarkCase(
+                "tasks-complete",
+                "put",
+                lambda: _detail_url("tasks", _first_pk(Task.objects.filter(status="in_progress")), "complete"),
+                writes=True
+        ),
+        BenchmarkCase(
+                "machines-pass_maintenance",
+                "put",
+                lambda: _detail_url("machines", _machine_in_maintenance(), "pass_maintenance"),
+                writes=True
+        ),
+        BenchmarkCase("activitylogs-export_json", "get", lambda: "/api/activitylogs/export/json/"),
+        BenchmarkCase("activitylogs-export_csv", "get", lambda: "/api/activitylogs/export/csv/"),
+    ]
+    return cases
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the API endpoints and compares them with a JSON baseline."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--warmup", type=int, default=2)
+        parser.add_argument("--only", nargs="*", help="Case names to run (all by default).")
+        parser.add_argument("--user", default="seed_admin", help="Username making the requests.")
+        parser.add_argument(
+                "--auth",
+                choices=["jwt", "jwt-stateless", "session"],
+                default="jwt",
+                help="How the client authenticates. jwt-stateless turns WORKSHOP_JWT_STATELESS_USER on."
+        )
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument("--compare", help="Baseline JSON file to compare with.")
+        parser.add_argument(
+                "--threshold",
+                type=float,
+                default=0.2,
+                help="Allowed p95 slowdown before flagging a regression (0.2 = 20%%)."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["user"])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['user']}' not found. Run seed_workshop first.")
+
+        # Expected 400s (no machine available...) would flood the output
+        logging.getLogger("django.request").setLevel(logging.ERROR)
+        client = self.build_client(user, options["auth"])
+        cases = build_cases()
+        if options["only"]:
+            cases = [case for case in cases if case.name in options["only"]]
+
+        results = {}
+        # No rate limits: the benchmark calls every endpoint in a loop on purpose
+        with override_settings(
+                WORKSHOP_JWT_STATELESS_USER=options["auth"] == "jwt-stateless",
+                WORKSHOP_THROTTLE_RATES={}
+        ):
+            for case in cases:
+                try:
+                    result = self.run_case(client, case, options["iterations"], options["warmup"])
+                except SkipCase as reason:
+                    self.stdout.write(f"{case.name:<30} skipped ({reason})")
+                    continue
+                results[case.name] = result
+                line = (
+                        f"{case.name:<30} {result['status']:>4} "
+                        f"p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  "
+                        f"{result['queries']:>5} queries  {result['peak_kb']:>10.1f} KB"
+                )
+                if "warm" in result:
+                    warm = result["warm"]
+                    line += f"  (warm p95 {warm['p95_ms']:9.2f} ms  {warm['queries']:>3} queries)"
+                self.stdout.write(line)
+
+        report = {
+            "meta": {
+                "date": timezone.now().isoformat(),
+                "python": platform.python_version(),
+                "database": connection.vendor,
+                "auth": options["auth"],
+                "iterations": options["iterations"],
+                "rows": {
+                    "orders": Order.objects.count(),
+                    "machines": Machine.objects.count(),
+                    "tasks": Task.objects.count(),
+                    "activitylogs": ActivityLog.objects.count(),
+                },
+            },
+            "results": results,
+        }
+        if options["output"]:
+            path = Path(options["output"])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(report, indent=2))
+            self.stdout.write(f"Results written to {path}")
+        if options["compare"]:
+            self.compare(report, options["compare"], options["threshold"])
+
+    def build_client(self, user, auth):
+        """Test client authenticated as `user`."""
+        # "localhost" is always allowed while DEBUG is on
+        client = Client(HTTP_HOST="localhost")
+        if auth in ("jwt", "jwt-stateless"):
+            # Same token as the one given by /api/token/
+            token = WorkshopTokenObtainPairSerializer.get_token(user).access_token
+            client.defaults["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+        else:
+            client.force_login(user)
+        return client
+
+    def request(self, client, case, url):
+        """Makes the request and reads the whole body (also streamed ones)."""
+        response = getattr(client, case.method)(url)
+        if response.streaming:
+            b"".join(response.streaming_content)
+        else:
+            response.content
+        return response
+
+    def run_once(self, client, case, measure, cold=True):
+        """
+        One iteration. `measure(callable)` wraps the request.
+        A cold one misses the response cache, a warm one is served from it
+        (the previous iteration cached the response).
+        """
+        if not case.writes:
+            url = self.prepare(case, cold)
+            return measure(lambda: self.request(client, case, url))
+        with transaction.atomic():
+            url = self.prepare(case, cold)
+            result = measure(lambda: self.request(client, case, url))
+            transaction.set_rollback(True)
+        return result
+
+    def prepare(self, case, cold):
+        url = case.prepare()
+        if url is None:
+            raise SkipCase("no row to work on")
+        if cold:
+            # New versions: the cached responses can't be reached anymore
+            bump_versions(*RESOURCES)
+        return url
+
+    def run_case(self, client, case, iterations, warmup):
+        # Queries and memory are measured apart so they don't slow down the timings
+        def count_queries(call):
+            with CaptureQueriesContext(connection) as queries:
+                response = call()
+            return response, len(queries)
+
+        def peak_memory(call):
+            tracemalloc.start()
+            try:
+                call()
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        def elapsed(call):
+            started = time.perf_counter()
+            call()
+            return time.perf_counter() - started
+
+        response, queries = self.run_once(client, case, count_queries)
+        if case.writes and not 200 <= response.status_code < 300:
+            raise SkipCase(f"answered {response.status_code}")
+        peak = self.run_once(client, case, peak_memory)
+        for _ in range(warmup):
+            self.run_once(client, case, elapsed)
+        timings = [self.run_once(client, case, elapsed) * 1000 for _ in range(iterations)]
+        result = {
+            "status": response.status_code,
+            "p50_ms": percentile(timings, 0.50),
+            "p95_ms": percentile(timings, 0.95),
+            "mean_ms": sum(timings) / len(timings),
+            "queries": queries,
+            "peak_kb": peak / 1024,
+        }
+
+        if not case.writes:
+            # The last cold run cached the response
+            _, warm_queries = self.run_once(client, case, count_queries, cold=False)
+            warm_timings = [
+                self.run_once(client, case, elapsed, cold=False) * 1000 for _ in range(iterations)
+            ]
+            result["warm"] = {
+                "p50_ms": percentile(warm_timings, 0.50),
+                "p95_ms": percentile(warm_timings, 0.95),
+                "queries": warm_queries,
+            }
+        return result
+
+    def compare(self, report, baseline_path, threshold):
+        """Flags the cases slower (p95) or with more queries than the baseline."""
+        baseline = json.loads(Path(baseline_path).read_text())["results"]
+        regressions = []
+        for name, result in report["results"].items():
+            if name not in baseline:
+                continue
+            base = baseline[name]
+            change = (result["p95_ms"] - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0.0
+            flags = []
+            if change > threshold:
+                flags.append(f"p95 {change:+.0%}")
+            if result["queries"] > base["queries"]:
+                flags.append(f"queries {base['queries']} -> {result['queries']}")
+            line = f"{name:<30} p95 {base['p95_ms']:9.2f} -> {result['p95_ms']:9.2f} ms ({change:+.0%})"
+            if flags:
+                regressions.append(name)
+                self.stdout.write(self.style.ERROR(f"{line}  REGRESSION: {', '.join(flags)}"))
+            else:
+                self.stdout.write(line)
+
+        if regressions:
+            raise CommandError(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        self.stdout.write(self.style.SUCCESS("No regressions."))
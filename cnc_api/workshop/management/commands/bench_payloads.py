@@ -0,0 +1,86 @@
+"""
+Compares the wire formats on large task and log lists
+(usually from a seed_workshop dataset): payload size, encode time
+(server side) and decode time (client side).
+Then the bytes on the wire and the CPU cost of every available
+compression (at the levels of WORKSHOP_COMPRESSION_LEVELS).
+
+Example:
+python manage.py bench_payloads --tasks 20000 --logs 200000
+"""
+import json
+import time
+
+import msgpack
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from cnc_api.workshop.compression import ENCODERS, get_levels
+from cnc_api.workshop.models import ActivityLog, Task
+from cnc_api.workshop.renderers import MessagePackRenderer
+from cnc_api.workshop.serializers import ActivityLogSerializer, TaskSerializer
+
+FORMATS = {
+    "json": (JSONRenderer(), lambda payload: json.loads(payload)),
+    "msgpack": (MessagePackRenderer(), lambda payload: msgpack.unpackb(payload, raw=False)),
+}
+
+
+def best_time(function, repeat):
+    """Fastest of `repeat` runs, in ms (the least disturbed by the machine)."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+class Command(BaseCommand):
+    help = "Benchmarks payload size and encode/decode time of the API formats."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tasks", type=int, default=10000, help="Tasks in the task list.")
+        parser.add_argument("--logs", type=int, default=100000, help="Logs in the log list.")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        payloads = {
+            "tasks": TaskSerializer(
+                    Task.objects.prefetch_related("logs")[:options["tasks"]],
+                    many=True
+            ).data,
+            "activitylogs": ActivityLogSerializer(
+                    ActivityLog.objects.all()[:options["logs"]],
+                    many=True
+            ).data,
+        }
+
+        bodies = []
+        self.stdout.write(f"{'payload':<14} {'rows':>8} {'format':<8} {'bytes':>12} {'encode ms':>10} {'decode ms':>10}")
+        for name, data in payloads.items():
+            for format_name, (renderer, decode) in FORMATS.items():
+                body = renderer.render(data)
+                bodies.append((name, format_name, body))
+                encode_ms = best_time(lambda: renderer.render(data), options["repeat"])
+                decode_ms = best_time(lambda: decode(body), options["repeat"])
+                self.stdout.write(
+                        f"{name:<14} {len(data):>8} {format_name:<8} {len(body):>12} "
+                        f"{encode_ms:>10.2f} {decode_ms:>10.2f}"
+                )
+
+        self.stdout.write("")
+        self.stdout.write(
+                f"{'payload':<14} {'format':<8} {'encoding':<9} {'level':>5} {'bytes':>12} "
+                f"{'ratio':>6} {'compress ms':>12}"
+        )
+        for name, format_name, body in bodies:
+            for encoding, level in get_levels().items():
+                compress = ENCODERS[encoding][0]
+                compressed = compress(body, level)
+                compress_ms = best_time(lambda: compress(body, level), options["repeat"])
+                self.stdout.write(
+                        f"{name:<14} {format_name:<8} {encoding:<9} {level:>5} {len(compressed):>12} "
+                        f"{len(body) / len(compressed):>6.1f} {compress_ms:>12.2f}"
+                )
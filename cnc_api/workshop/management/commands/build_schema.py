@@ -0,0 +1,28 @@
+"""
+Writes the OpenAPI schema (JSON and YAML) to WORKSHOP_SCHEMA_DIR.
+Run it when building/deploying: the docs endpoints then load these files
+instead of introspecting the API. Run it again after changing the API.
+
+Example:
+python manage.py build_schema
+"""
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from cnc_api.workshop.schema import get_schema_dir, render_schema
+
+
+class Command(BaseCommand):
+    help = "Writes the precomputed OpenAPI schema served by /swagger/ and /redoc/."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="Directory for the files (default: WORKSHOP_SCHEMA_DIR).")
+
+    def handle(self, *args, **options):
+        output = Path(options["output"]) if options["output"] else get_schema_dir()
+        output.mkdir(parents=True, exist_ok=True)
+        for schema_format, body in render_schema().items():
+            path = output / f"openapi.{schema_format}"
+            path.write_bytes(body)
+            self.stdout.write(f"{path} ({len(body)} bytes)")
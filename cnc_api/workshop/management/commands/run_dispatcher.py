@@ -0,0 +1,40 @@
+"""
+Runs the in-memory dispatcher as its own process (WORKSHOP_DISPATCHER = "external").
+It rebuilds its state from the DB, assigns the queued tasks to the idle
+machines, and reloads every --reload-seconds to see what the API did.
+
+Examples:
+python manage.py run_dispatcher
+python manage.py run_dispatcher --once
+"""
+from django.core.management.base import BaseCommand
+
+from cnc_api.workshop.dispatcher import Dispatcher
+
+
+class Command(BaseCommand):
+    help = "Runs the in-memory dispatcher (queued tasks -> idle machines)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="One pass and exit.")
+        parser.add_argument("--reload-seconds", type=float, default=2.0)
+        parser.add_argument("--check-seconds", type=float, default=300.0)
+        parser.add_argument("--batch-size", type=int, default=None)
+
+    def handle(self, *args, **options):
+        dispatcher = Dispatcher(
+                batch_size=options["batch_size"],
+                reload_seconds=options["reload_seconds"],
+                check_seconds=options["check_seconds"],
+        )
+        if options["once"]:
+            applied = dispatcher.run_once()
+            self.stdout.write(f"Started {len(applied)} queued tasks.")
+            return
+
+        self.stdout.write("Dispatcher running (Ctrl+C to stop).")
+        try:
+            # No local queue in this process: each pass waits, then reloads
+            dispatcher.run(poll_seconds=options["reload_seconds"])
+        except KeyboardInterrupt:
+            self.stdout.write("Dispatcher stopped.")
@@ -0,0 +1,33 @@
+"""
+Runs the maintenance sweeper as its own process (WORKSHOP_MAINTENANCE_SWEEPER = "external").
+Sends the due idle machines to maintenance every --interval-seconds
+and right after midnight, and purges the old sync tombstones.
+
+Examples:
+python manage.py run_maintenance_sweeper
+python manage.py run_maintenance_sweeper --once
+"""
+from django.core.management.base import BaseCommand
+
+from cnc_api.workshop.sweeper import MaintenanceSweeper
+
+
+class Command(BaseCommand):
+    help = "Sends the due machines to maintenance on a schedule."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="One sweep and exit.")
+        parser.add_argument("--interval-seconds", type=float, default=None)
+
+    def handle(self, *args, **options):
+        sweeper = MaintenanceSweeper(interval_seconds=options["interval_seconds"])
+        if options["once"]:
+            machines, purged = sweeper.sweep()
+            self.stdout.write(f"{len(machines)} machines sent to maintenance, {purged} tombstones purged.")
+            return
+
+        self.stdout.write("Maintenance sweeper running (Ctrl+C to stop).")
+        try:
+            sweeper.run()
+        except KeyboardInterrupt:
+            self.stdout.write("Maintenance sweeper stopped.")
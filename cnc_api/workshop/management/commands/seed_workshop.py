@@ -0,0 +1,445 @@
+"""
+Generates a synthetic workshop: machines, orders, tasks and activity logs.
+The same --seed (and --reference-date) always generates the same data,
+so benchmarks can be compared.
+On PostgreSQL the rows are loaded with COPY, on other databases with
+batched INSERTs.
+
+Examples:
+python manage.py seed_workshop --flush
+python manage.py seed_workshop --machines 300 --orders 200000 --logs 20000000 --seed 7
+python manage.py seed_workshop --flush --reference-date 2025-06-01
+"""
+import io
+import random
+import uuid
+
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from cnc_api.workshop.models import ActivityLog, Machine, Order, Task
+from cnc_api.workshop.response_cache import RESOURCES, bump_versions
+
+# How common every machine type is on the floor
+MACHINE_TYPE_WEIGHTS = {"lathe": 35, "mill": 35, "grinder": 20, "other": 10}
+
+OPERATIONS = {
+    "lathe": ["turning", "facing", "threading", "boring", "parting"],
+    "mill": ["milling", "drilling", "pocketing", "slotting", "tapping"],
+    "grinder": ["grinding", "honing", "lapping"],
+    "other": ["deburring", "inspection", "washing", "marking"],
+}
+
+# Share of orders on each status
+ORDER_STATUS_WEIGHTS = {"completed": 70, "in_progress": 10, "pending": 15, "cancelled": 5}
+# Share of orders on each priority (low, normal, high, urgent)
+PRIORITIES = [0, 1, 2, 3]
+PRIORITY_WEIGHTS = [20, 60, 15, 5]
+
+SEED_PASSWORD = "seed1234"
+
+
+def _copy_value(value):
+    """Formats a value for the COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return f"{value.total_seconds()} seconds"
+    return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+    )
+
+
+class TableWriter:
+    """
+    Buffers the rows of a model and writes them in batches.
+    Columns not given in `attnames` get their default value
+    (the current time for auto_now fields).
+    Parent writers are flushed first so the foreign keys exist.
+    """
+
+    def __init__(self, model, attnames, batch_size, use_copy, parents=()):
+        self.model = model
+        self.batch_size = batch_size
+        self.use_copy = use_copy
+        self.parents = parents
+        self.rows = []
+        self.written = 0
+
+        now = timezone.now()
+        fields_by_attname = {f.attname: f for f in model._meta.concrete_fields}
+        self.fields = [fields_by_attname[name] for name in attnames]
+        # Constant values for every other column
+        self.extra_fields = []
+        self.extra_values = []
+        for field in model._meta.concrete_fields:
+            if field.attname in attnames:
+                continue
+            if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False):
+                value = now.date() if field.get_internal_type() == "DateField" else now
+            elif field.has_default():
+                value = field.get_default()
+            else:
+                value = None
+            self.extra_fields.append(field)
+            self.extra_values.append(value)
+
+    def add(self, *values):
+        self.rows.append(values)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        for parent in self.parents:
+            parent.flush()
+        fields = self.fields + self.extra_fields
+        columns = ", ".join(connection.ops.quote_name(f.column) for f in fields)
+        table = connection.ops.quote_name(self.model._meta.db_table)
+
+        with connection.cursor() as cursor:
+            if self.use_copy:
+                buffer = io.StringIO()
+                for row in self.rows:
+                    buffer.write("\t".join(_copy_value(v) for v in (*row, *self.extra_values)))
+                    buffer.write("\n")
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN", buffer)
+            else:
+                placeholders = ", ".join(["%s"] * len(fields))
+                cursor.executemany(
+                        f"INSERT INTO {table} ({columns}) VALUES ({placeholders})",
+                        [
+                            [
+                                field.get_db_prep_save(value, connection)
+                                for field, value in zip(fields, (*row, *self.extra_values))
+                            ]
+                            for row in self.rows
+                        ]
+                )
+        self.written += len(self.rows)
+        self.rows = []
+
+
+class Command(BaseCommand):
+    help = "Generates a reproducible synthetic workshop dataset for load testing."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--machines", type=int, default=50)
+        parser.add_argument("--orders", type=int, default=1000)
+        parser.add_argument("--max-tasks-per-order", type=int, default=6)
+        parser.add_argument("--logs", type=int, default=10000, help="Total activity logs.")
+        parser.add_argument("--operators", type=int, default=10)
+        parser.add_argument("--days", type=int, default=90, help="Days of history.")
+        parser.add_argument(
+                "--start-date",
+                type=date.fromisoformat,
+                default=date(2025, 1, 1),
+                help="First day of the history (YYYY-MM-DD)."
+        )
+        parser.add_argument(
+                "--reference-date",
+                type=date.fromisoformat,
+                default=None,
+                help="Day the maintenance schedule is relative to (YYYY-MM-DD): no machine "
+                     "is due on it. Default: today (printed, pass it again to get the same rows)."
+        )
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--batch-size", type=int, default=50000)
+        parser.add_argument("--flush", action="store_true", help="Delete the workshop data first.")
+        parser.add_argument(
+                "--no-copy",
+                action="store_true",
+                help="Use INSERTs even on PostgreSQL."
+        )
+
+    def handle(self, *args, **options):
+        if options["machines"] < 1:
+            raise CommandError("At least one machine is needed.")
+        self.rng = random.Random(options["seed"])
+        self.start = datetime.combine(options["start_date"], time(6), tzinfo=dt_timezone.utc)
+        self.period = timedelta(days=options["days"])
+        self.reference_date = options["reference_date"] or timezone.now().date()
+        use_copy = connection.vendor == "postgresql" and not options["no_copy"]
+        batch_size = options["batch_size"]
+
+        with transaction.atomic():
+            if options["flush"]:
+                self.flush_workshop()
+            self.user_ids = self.seed_users(options["operators"])
+
+            self.machines = TableWriter(
+                    Machine,
+                    ["machine_id", "name", "description", "machine_type", "status",
+                     "location", "last_maintenance", "maintenance_gap_days", "maintenance_due_date"],
+                    batch_size, use_copy,
+            )
+            self.orders = TableWriter(
+                    Order,
+                    ["order_id", "name", "description", "date_creation", "date_start",
+                     "date_completion", "status", "priority", "due_date"],
+                    batch_size, use_copy,
+            )
+            self.tasks = TableWriter(
+                    Task,
+                    ["task_id", "order_id", "required_machine_type", "machine_id", "operation",
+                     "queue_number", "status", "start_time", "finish_time", "queued_at",
+                     "priority", "due_date", "estimated_duration"],
+                    batch_size, use_copy, parents=(self.machines, self.orders),
+            )
+            self.logs = TableWriter(
+                    ActivityLog,
+                    ["log_id", "task_id", "time", "message", "log_type", "user_id"],
+                    batch_size, use_copy, parents=(self.tasks,),
+            )
+
+            self.seed_machines(options["machines"])
+            self.seed_orders(options["orders"], options["max_tasks_per_order"], options["logs"])
+            for writer in (self.machines, self.orders, self.tasks, self.logs):
+                writer.flush()
+            # Raw inserts don't send signals: drop the cached responses here
+            bump_versions(*RESOURCES)
+
+        if connection.vendor == "postgresql":
+            # Fresh statistics so the planner knows the new table sizes
+            with connection.cursor() as cursor:
+                for model in (Machine, Order, Task, ActivityLog):
+                    cursor.execute(f"ANALYZE {connection.ops.quote_name(model._meta.db_table)}")
+
+        self.stdout.write(self.style.SUCCESS(
+                f"Seeded {self.machines.written} machines, {self.orders.written} orders, "
+                f"{self.tasks.written} tasks and {self.logs.written} logs "
+                f"({'COPY' if use_copy else 'INSERT'}, seed {options['seed']}, "
+                f"reference date {self.reference_date.isoformat()})."
+        ))
+
+    def new_uuid(self):
+        """Random UUID taken from the seeded generator."""
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4)
+
+    def flush_workshop(self):
+        """Deletes every machine, order, task and log."""
+        if connection.vendor == "postgresql":
+            tables = ", ".join(
+                    connection.ops.quote_name(model._meta.db_table)
+                    for model in (ActivityLog, Task, Order, Machine)
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(f"TRUNCATE {tables} CASCADE")
+        else:
+            for model in (ActivityLog, Task, Order, Machine):
+                model.objects.all().delete()
+
+    def seed_users(self, operators):
+        """An admin and some operators. Every one of them uses SEED_PASSWORD."""
+        password = make_password(SEED_PASSWORD)
+        admin_group, _ = Group.objects.get_or_create(name="admin")
+        operator_group, _ = Group.objects.get_or_create(name="operator")
+
+        admin, _ = User.objects.get_or_create(username="seed_admin", defaults={"password": password})
+        admin.groups.add(admin_group)
+        user_ids = [admin.id]
+        for number in range(operators):
+            operator, _ = User.objects.get_or_create(
+                    username=f"seed_operator_{number}",
+                    defaults={"password": password}
+            )
+            operator.groups.add(operator_group)
+            user_ids.append(operator.id)
+        return user_ids
+
+    def seed_machines(self, total):
+        """
+        Every machine starts "idle". Some will be "running" an in progress task.
+        The maintenance schedule is relative to the reference date (not to
+        the history): the last maintenance is less than a gap before it,
+        so no machine is due on that day.
+        """
+        rng = self.rng
+        types = list(MACHINE_TYPE_WEIGHTS)
+        weights = list(MACHINE_TYPE_WEIGHTS.values())
+        reference_date = self.reference_date
+
+        self.machines_by_type = {machine_type: [] for machine_type in types}
+        for number in range(total):
+            machine_type = rng.choices(types, weights)[0]
+            machine_id = self.new_uuid()
+            name = f"{machine_type.capitalize()} {number + 1:04d}"
+            gap = rng.randint(7, 30)
+            location = f"Zone {rng.choice('ABCDEF')}{rng.randint(1, 9)}"
+            last_maintenance = reference_date - timedelta(days=rng.randint(0, gap - 1))
+            self.machines_by_type[machine_type].append((machine_id, name))
+            self.machines.add(
+                    machine_id,
+                    name,
+                    f"Synthetic {machine_type}",
+                    machine_type,
+                    "idle",
+                    location,
+                    last_maintenance,
+                    gap,
+                    # Bulk inserts skip Machine.save
+                    last_maintenance + timedelta(days=gap),
+            )
+        # Only the types with machines can be required by a task
+        self.machines_by_type = {t: m for t, m in self.machines_by_type.items() if m}
+        self.idle_by_type = {t: list(m) for t, m in self.machines_by_type.items()}
+
+    def seed_orders(self, total, max_tasks, total_logs):
+        """Orders with their tasks, and the logs of the started tasks."""
+        rng = self.rng
+        statuses = list(ORDER_STATUS_WEIGHTS)
+        weights = list(ORDER_STATUS_WEIGHTS.values())
+        available_types = list(self.machines_by_type)
+        type_weights = [MACHINE_TYPE_WEIGHTS[t] for t in available_types]
+        period_seconds = self.period.total_seconds()
+
+        # Logs per started task so the total ends close to `total_logs`.
+        # Roughly 75% of the tasks get started.
+        expected_started = max(1.0, total * (1 + max_tasks) / 2 * 0.75)
+        self.logs_per_task = total_logs / expected_started
+        self.logs_budget = total_logs
+        self.logs_carry = 0.0
+
+        for number in range(total):
+            order_id = self.new_uuid()
+            status = rng.choices(statuses, weights)[0]
+            created = self.start + timedelta(seconds=rng.random() * period_seconds * 0.95)
+            clock = created + timedelta(minutes=rng.randint(5, 240))
+            date_start = clock if status in ("completed", "in_progress") else None
+            task_total = rng.randint(1, max_tasks)
+            priority = rng.choices(PRIORITIES, PRIORITY_WEIGHTS)[0]
+            due_date = (created + timedelta(days=rng.randint(3, 30))).date()
+            # Tasks done before the current one (in progress orders)
+            done = task_total if status == "completed" else 0
+            if status == "in_progress":
+                done = rng.randint(0, task_total - 1)
+            elif status == "cancelled":
+                done = rng.randint(0, task_total - 1)
+
+            for queue_number in range(1, task_total + 1):
+                required_type = rng.choices(available_types, type_weights)[0]
+                operation = rng.choice(OPERATIONS[required_type])
+                task_id = self.new_uuid()
+                # Planned time, same distribution as the real durations
+                estimated_duration = timedelta(minutes=round(min(rng.lognormvariate(3.4, 0.6), 600)))
+                machine_id = machine_name = start_time = finish_time = queued_at = None
+                task_status = "pending"
+
+                if queue_number <= done:
+                    machine_id, machine_name = rng.choice(self.machines_by_type[required_type])
+                    start_time = clock
+                    # Log-normal durations: most tasks are short, a few are very long
+                    finish_time = start_time + timedelta(minutes=min(rng.lognormvariate(3.4, 0.6), 600))
+                    clock = finish_time + timedelta(minutes=rng.randint(1, 30))
+                    task_status = "completed"
+                elif queue_number == done + 1 and status == "in_progress" and self.idle_by_type[required_type]:
+                    idle = self.idle_by_type[required_type]
+                    machine_id, machine_name = idle.pop(rng.randrange(len(idle)))
+                    start_time = clock
+                    task_status = "in_progress"
+                elif queue_number == done + 1 and status == "in_progress":
+                    # Its turn came but every machine of its type was busy
+                    queued_at = clock
+
+                self.tasks.add(
+                        task_id, order_id, required_type, machine_id, operation,
+                        queue_number, task_status, start_time, finish_time, queued_at,
+                        priority, due_date, estimated_duration,
+                )
+                if start_time:
+                    self.seed_task_logs(task_id, operation, machine_name, start_time, finish_time)
+
+            self.orders.add(
+                    order_id,
+                    f"Order {number + 1:07d}",
+                    f"Synthetic order with {task_total} tasks",
+                    created,
+                    date_start,
+                    clock if status == "completed" else None,
+                    status,
+                    priority,
+                    due_date,
+            )
+
+        self.mark_running_machines()
+        self.seed_system_logs()
+
+    def seed_task_logs(self, task_id, operation, machine_name, start_time, finish_time):
+        """Start and completion logs, plus some warnings in between."""
+        rng = self.rng
+        self.logs_carry += self.logs_per_task
+        count = min(int(self.logs_carry), self.logs_budget)
+        self.logs_carry -= int(self.logs_carry)
+        end = finish_time or start_time + timedelta(minutes=30)
+        span = (end - start_time).total_seconds()
+
+        for position in range(count):
+            if position == 0:
+                log_type, message, moment = "info", f"'{operation}' started on machine '{machine_name}'.", start_time
+            elif position == 1 and finish_time:
+                log_type, message, moment = "info", f"'{operation}' completed", finish_time
+            else:
+                log_type = rng.choices(["info", "warning", "error"], [70, 25, 5])[0]
+                message = rng.choice([
+                    f"Tool change on '{machine_name}'.",
+                    f"Coolant level low on '{machine_name}'.",
+                    f"Dimension check for '{operation}'.",
+                    f"Operator note on '{operation}'.",
+                ])
+                moment = start_time + timedelta(seconds=rng.random() * span)
+            self.logs.add(
+                    self.new_uuid(),
+                    task_id,
+                    moment,
+                    f"[{log_type.upper()}] - {message}",
+                    log_type,
+                    rng.choice(self.user_ids),
+            )
+        self.logs_budget -= count
+
+    def seed_system_logs(self):
+        """Fills the remaining log budget with maintenance logs without a task."""
+        rng = self.rng
+        period_seconds = self.period.total_seconds()
+        names = [name for machines in self.machines_by_type.values() for _, name in machines]
+        for _ in range(self.logs_budget):
+            self.logs.add(
+                    self.new_uuid(),
+                    None,
+                    self.start + timedelta(seconds=rng.random() * period_seconds),
+                    f"[WARNING] - {rng.choice(names)} is now under MAINTENANCE",
+                    "warning",
+                    None,
+            )
+        self.logs_budget = 0
+
+    def mark_running_machines(self):
+        """Machines that took an in progress task are "running"."""
+        idle = {machine_id for machines in self.idle_by_type.values() for machine_id, _ in machines}
+        running = [
+            machine_id
+            for machines in self.machines_by_type.values()
+            for machine_id, _ in machines
+            if machine_id not in idle
+        ]
+        self.machines.flush()
+        for position in range(0, len(running), 1000):
+            Machine.objects.filter(pk__in=running[position:position + 1000]).update(
+                    status="running",
+                    updated_at=timezone.now()
+            )
@@ -0,0 +1,40 @@
+"""
+Runs the stale task watchdog (see workshop/watchdog.py) every --interval-seconds.
+Overdue in progress tasks are logged, or failed and their machine
+released, as set by the WORKSHOP_WATCHDOG_* settings.
+
+Examples:
+python manage.py watch_stale_tasks
+python manage.py watch_stale_tasks --once --dry-run
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from cnc_api.workshop.watchdog import check_stale_tasks
+
+
+class Command(BaseCommand):
+    help = "Finds the tasks left in progress for too long."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="One pass and exit.")
+        parser.add_argument("--dry-run", action="store_true", help="Only report, change nothing.")
+        parser.add_argument("--interval-seconds", type=float, default=300.0)
+
+    def handle(self, *args, **options):
+        while True:
+            result = check_stale_tasks(dry_run=options["dry_run"])
+            self.stdout.write(
+                    f"{len(result['notified'])} tasks notified, {len(result['failed'])} failed"
+                    + (" (dry run)." if options["dry_run"] else ".")
+            )
+            if options["once"]:
+                return
+            close_old_connections()
+            try:
+                time.sleep(options["interval_seconds"])
+            except KeyboardInterrupt:
+                self.stdout.write("Watchdog stopped.")
+                return
@@ -0,0 +1,268 @@
+"""
+In-process metrics exposed in the Prometheus text format on /metrics.
+Counters and histograms live in memory and are updated by the views
+and services without touching the DB.
+Gauges are computed from aggregate queries only when /metrics is scraped,
+and those aggregates are cached for a few seconds.
+Each worker process keeps its own numbers, so scrape every worker
+(or sum them) when running several processes.
+/metrics only answers the addresses of WORKSHOP_METRICS_ALLOWED_IPS and the
+requests with "Authorization: Bearer <WORKSHOP_METRICS_TOKEN>" (403 otherwise).
+"""
+import hmac
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.http import HttpResponse, HttpResponseForbidden
+
+# Upper bounds (seconds) for the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+GAUGES_CACHE_KEY = "workshop:metrics:gauges"
+
+_lock = threading.Lock()
+_registry = []
+
+
+def _format_labels(labels):
+    """Turns a tuple of (name, value) pairs into '{name="value",...}'."""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        # Backslashes, quotes and new lines must be escaped in label values
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """A value that only goes up (events, errors...)."""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def lines(self):
+        with _lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+
+class Histogram:
+    """Counts observations (latencies) into cumulative buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # key -> [counts per bucket..., +Inf count, sum]
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        with _lock:
+            data = self._values.get(key)
+            if data is None:
+                data = [0] * (len(self.buckets) + 1) + [0.0]
+                self._values[key] = data
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[position] += 1
+            # The +Inf bucket counts everything
+            data[len(self.buckets)] += 1
+            data[-1] += value
+
+    def count(self, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        data = self._values.get(key)
+        return data[len(self.buckets)] if data else 0
+
+    def lines(self):
+        with _lock:
+            items = [(key, list(data)) for key, data in self._values.items()]
+        for key, data in items:
+            for position, bound in enumerate(self.buckets):
+                labels = key + (("le", repr(float(bound))),)
+                yield f"{self.name}_bucket{_format_labels(labels)} {data[position]}"
+            labels = key + (("le", "+Inf"),)
+            yield f"{self.name}_bucket{_format_labels(labels)} {data[len(self.buckets)]}"
+            yield f"{self.name}_sum{_format_labels(key)} {data[-1]}"
+            yield f"{self.name}_count{_format_labels(key)} {data[len(self.buckets)]}"
+
+
+# API
+REQUEST_LATENCY = Histogram(
+        "workshop_request_duration_seconds",
+        "Time spent serving a viewset action.",
+        labelnames=("viewset", "action", "method"),
+)
+RESPONSES = Counter(
+        "workshop_responses_total",
+        "Responses sent by viewset action and status code.",
+        labelnames=("viewset", "action", "status"),
+)
+THROTTLED = Counter(
+        "workshop_throttled_total",
+        "Requests refused by the rate limits, by budget.",
+        labelnames=("scope",),
+)
+
+# Scheduler
+TASKS_STARTED = Counter(
+        "workshop_tasks_started_total",
+        "Tasks that started on a machine.",
+        labelnames=("machine_type",),
+)
+TASKS_COMPLETED = Counter(
+        "workshop_tasks_completed_total",
+        "Tasks that were completed.",
+        labelnames=("machine_type",),
+)
+TASKS_QUEUED = Counter(
+        "workshop_tasks_queued_total",
+        "Tasks that went to the dispatch queue (no machine was free).",
+        labelnames=("machine_type",),
+)
+TASKS_DISPATCHED = Counter(
+        "workshop_tasks_dispatched_total",
+        "Queued tasks started when a machine became idle.",
+        labelnames=("machine_type",),
+)
+DISPATCHER_DRIFT = Counter(
+        "workshop_dispatcher_drift_total",
+        "Consistency checks that found the in-memory dispatcher out of sync with the DB.",
+)
+STALE_TASKS = Counter(
+        "workshop_stale_tasks_total",
+        "Overdue in progress tasks found by the watchdog, by what was done.",
+        labelnames=("action", "machine_type"),
+)
+ASSIGNMENT_FAILURES = Counter(
+        "workshop_assignment_failures_total",
+        "Task starts that found no idle machine of the required type.",
+        labelnames=("machine_type",),
+)
+MAINTENANCE_TRANSITIONS = Counter(
+        "workshop_maintenance_transitions_total",
+        "Machines entering or leaving maintenance.",
+        labelnames=("transition", "machine_type"),
+)
+
+
+def _compute_gauges():
+    """Aggregates used by the gauges. Three GROUP BY queries."""
+    # Import here to avoid loading the models when the module is imported
+    from .models import Machine, Task
+
+    machines = list(
+            Machine.objects
+            .values_list("status", "machine_type")
+            .annotate(total=Count("pk"))
+            .order_by()
+    )
+    pending = list(
+            Task.objects
+            .filter(status="pending")
+            .values_list("required_machine_type")
+            .annotate(total=Count("pk"))
+            .order_by()
+    )
+    queued = list(
+            Task.objects
+            .filter(status="pending", queued_at__isnull=False)
+            .values_list("required_machine_type")
+            .annotate(total=Count("pk"))
+            .order_by()
+    )
+    return {"machines": machines, "pending": pending, "queued": queued}
+
+
+def gauge_lines():
+    """Gauges for machines by status/type and the pending backlog."""
+    timeout = getattr(settings, "WORKSHOP_METRICS_GAUGE_TTL", 15)
+    gauges = cache.get_or_set(GAUGES_CACHE_KEY, _compute_gauges, timeout)
+
+    yield "# HELP workshop_machines Machines by status and type."
+    yield "# TYPE workshop_machines gauge"
+    for machine_status, machine_type, total in gauges["machines"]:
+        labels = (("status", machine_status), ("machine_type", machine_type))
+        yield f"workshop_machines{_format_labels(labels)} {total}"
+
+    yield "# HELP workshop_pending_tasks Tasks waiting to be started, by required machine type."
+    yield "# TYPE workshop_pending_tasks gauge"
+    for machine_type, total in gauges["pending"]:
+        yield f"workshop_pending_tasks{_format_labels((('machine_type', machine_type),))} {total}"
+
+    yield "# HELP workshop_queued_tasks Tasks in the dispatch queue, by required machine type."
+    yield "# TYPE workshop_queued_tasks gauge"
+    for machine_type, total in gauges["queued"]:
+        yield f"workshop_queued_tasks{_format_labels((('machine_type', machine_type),))} {total}"
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.lines())
+    lines.extend(gauge_lines())
+    return "\n".join(lines) + "\n"
+
+
+def scrape_allowed(request):
+    """The scraper is on an allowed address or sends the metrics token."""
+    if request.META.get("REMOTE_ADDR") in getattr(settings, "WORKSHOP_METRICS_ALLOWED_IPS", ("127.0.0.1", "::1")):
+        return True
+    token = getattr(settings, "WORKSHOP_METRICS_TOKEN", None)
+    if not token:
+        return False
+    scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip(), token)
+
+
+def metrics_view(request):
+    """Plain Django view for /metrics (no DRF, no authentication queries)."""
+    if not scrape_allowed(request):
+        return HttpResponseForbidden("Metrics are only served to the allowed addresses or with the metrics token.")
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class MetricsMixin:
+    """
+    Times every request served by a viewset.
+    The action name ("list", "start"...) is known once DRF has
+    initialized the request, so the timing wraps the whole dispatch.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        started = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        elapsed = time.perf_counter() - started
+
+        viewset = getattr(self, "basename", None) or self.__class__.__name__
+        action = getattr(self, "action", None) or request.method.lower()
+        REQUEST_LATENCY.observe(elapsed, viewset=viewset, action=action, method=request.method)
+        RESPONSES.inc(viewset=viewset, action=action, status=response.status_code)
+        return response
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.1 on 2026-10-19 01:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workshop', '0017_deletedrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('queued_at__isnull', False), ('status', 'pending')), fields=['required_machine_type', 'queued_at'], name='task_dispatch_queue_idx'),
+        ),
+    ]
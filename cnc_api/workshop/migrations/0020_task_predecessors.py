@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-19 01:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workshop', '0019_order_priority_due_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='estimated_duration',
+            field=models.DurationField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='predecessors',
+            field=models.ManyToManyField(blank=True, related_name='successors', to='workshop.task'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-19 02:00
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workshop', '0020_task_predecessors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MachineCapability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('machine_type', models.CharField(choices=[('lathe', 'Lathe'), ('mill', 'Mill'), ('grinder', 'Grinder'), ('other', 'Other')], max_length=50)),
+                ('speed_factor', models.FloatField(default=1.0, validators=[django.core.validators.MinValueValidator(0.1)])),
+                ('machine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='capabilities', to='workshop.machine')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('machine', 'machine_type'), name='unique_machine_capability')],
+            },
+        ),
+    ]
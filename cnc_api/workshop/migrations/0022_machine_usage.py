@@ -0,0 +1,59 @@
+# Generated by Django 5.2.1 on 2026-10-19 02:03
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def fill_maintenance_due_date(apps, schema_editor):
+    # Machine.save keeps it from now on
+    Machine = apps.get_model("workshop", "Machine")
+    for machine in Machine.objects.only("last_maintenance", "maintenance_gap_days"):
+        machine.maintenance_due_date = machine.last_maintenance + timedelta(days=machine.maintenance_gap_days)
+        machine.save(update_fields=["maintenance_due_date"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workshop', '0021_machinecapability'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machine',
+            name='cycles_since_maintenance',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='hours_since_maintenance',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='maintenance_due_date',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='maintenance_gap_cycles',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='maintenance_gap_hours',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='total_cycles',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='total_hours',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(fill_maintenance_due_date, migrations.RunPython.noop),
+    ]
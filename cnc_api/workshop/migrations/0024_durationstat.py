@@ -0,0 +1,36 @@
+# Generated by Django 5.2.1 on 2026-10-19 02:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workshop', '0023_task_overdue_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='predicted_finish',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='DurationStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(max_length=50)),
+                ('machine_type', models.CharField(choices=[('lathe', 'Lathe'), ('mill', 'Mill'), ('grinder', 'Grinder'), ('other', 'Other')], max_length=50)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('mean_seconds', models.FloatField(default=0)),
+                ('m2', models.FloatField(default=0)),
+                ('quantiles', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('machine', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='duration_stats', to='workshop.machine')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('machine__isnull', False)), fields=('operation', 'machine_type', 'machine'), name='unique_duration_stat_machine'), models.UniqueConstraint(condition=models.Q(('machine__isnull', True)), fields=('operation', 'machine_type'), name='unique_duration_stat_type')],
+            },
+        ),
+    ]
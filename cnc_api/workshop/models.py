@@ -1,6 +1,7 @@
 import uuid
 
-from datetime import timedelta
+from datetime import date, timedelta
+from django.core.validators import MinValueValidator
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -15,6 +16,13 @@ class Order(models.Model):
         ("cancelled", "Cancelled"),
     ]
 
+    PRIORITY_POSSIBLE = [
+        (0, "Low"),
+        (1, "Normal"),
+        (2, "High"),
+        (3, "Urgent"),
+    ]
+
     # Attributes
     order_id = models.UUIDField(
             primary_key=True,
@@ -31,6 +39,12 @@ class Order(models.Model):
             choices=STATUS_POSSIBLE,
             default="pending"
     )
+    # Scheduling: the tasks of the order copy them (see Task.save)
+    priority = models.PositiveSmallIntegerField(choices=PRIORITY_POSSIBLE, default=1)
+    due_date = models.DateField(blank=True, null=True)
+    # Last change of the row (for ETags and sync)
+    # Bulk updates must set it by hand: update(..., updated_at=timezone.now())
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
@@ -72,23 +86,87 @@ class Machine(models.Model):
     # A new machine will be on point coming from the manufacturer
     last_maintenance = models.DateField(auto_now_add=True)
     maintenance_gap_days = models.PositiveIntegerField(default=10)
+    # next_maintenance stored (see save), so the sweep filters on a column
+    maintenance_due_date = models.DateField(blank=True, null=True, editable=False)
+    # Maintenance based on usage: also due after these hours of work or
+    # these completed tasks since the last one (empty: no limit)
+    maintenance_gap_hours = models.FloatField(blank=True, null=True)
+    maintenance_gap_cycles = models.PositiveIntegerField(blank=True, null=True)
+    # Usage counters, added to on every completed task (services.complete_task)
+    # and never recomputed from the history. The "since" ones restart at each maintenance
+    hours_since_maintenance = models.FloatField(default=0)
+    cycles_since_maintenance = models.PositiveIntegerField(default=0)
+    total_hours = models.FloatField(default=0)
+    total_cycles = models.PositiveIntegerField(default=0)
+    # Last change of the row (for ETags and sync)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     @property
     def next_maintenance(self):
         return self.last_maintenance + timedelta(days=self.maintenance_gap_days)
+
+    @property
+    def usage_limit_reached(self):
+        return (
+            (self.maintenance_gap_hours is not None and self.hours_since_maintenance >= self.maintenance_gap_hours)
+            or (self.maintenance_gap_cycles is not None and self.cycles_since_maintenance >= self.maintenance_gap_cycles)
+        )
     
     @property
     def needs_maintenance(self):
         maintenance_date = self.next_maintenance
-        if timezone.now().date() >= maintenance_date:
+        if timezone.now().date() >= maintenance_date or self.usage_limit_reached:
             self.status = "maintenance"
             return True
         return False
 
+    @staticmethod
+    def due_for_maintenance(today):
+        """Filter of the machines that need maintenance (same rules as needs_maintenance)."""
+        return (
+            models.Q(maintenance_due_date__lte=today)
+            | models.Q(maintenance_gap_hours__isnull=False, hours_since_maintenance__gte=models.F("maintenance_gap_hours"))
+            | models.Q(maintenance_gap_cycles__isnull=False, cycles_since_maintenance__gte=models.F("maintenance_gap_cycles"))
+        )
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            # What auto_now_add is about to set
+            self.last_maintenance = date.today()
+        self.maintenance_due_date = self.next_maintenance
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"last_maintenance", "maintenance_gap_days"} & set(update_fields):
+            kwargs["update_fields"] = [*update_fields, "maintenance_due_date"]
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
 
+class MachineCapability(models.Model):
+    """
+    Another kind of work a machine can do (a mill-turn center mills too)
+    or the speed of the machine at its own type.
+    A machine without capabilities does its machine_type at speed 1.
+    """
+    machine = models.ForeignKey(
+            Machine,
+            on_delete=models.CASCADE,
+            related_name="capabilities",
+    )
+    machine_type = models.CharField(max_length=50, choices=Machine.TYPE_POSSIBLE)
+    # Relative to a standard machine: 2.0 does the work in half the estimated time
+    speed_factor = models.FloatField(default=1.0, validators=[MinValueValidator(0.1)])
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["machine", "machine_type"], name="unique_machine_capability"),
+        ]
+
+    def __str__(self):
+        return f"{self.machine} - {self.machine_type} x{self.speed_factor}"
+
+
 class Task(models.Model):
     """
     Represents each individual operation that needs to be done
@@ -133,9 +211,52 @@ class Task(models.Model):
     )
     start_time = models.DateTimeField(blank=True, null=True)
     finish_time = models.DateTimeField(blank=True, null=True)
+    # When the task was ready to start but no machine was free.
+    # Pending tasks with it set are in the dispatch queue of their machine type
+    # and start as soon as a machine of that type becomes idle (see services.py)
+    queued_at = models.DateTimeField(blank=True, null=True)
+    # Tasks of the same order that must be completed before this one starts.
+    # They form a DAG per order (checked by the serializer); an order whose
+    # tasks declare none runs them one after another by queue_number
+    predecessors = models.ManyToManyField(
+            "self",
+            symmetrical=False,
+            related_name="successors",
+            blank=True,
+    )
+    # Planned time on the machine (used by the critical path)
+    estimated_duration = models.DurationField(blank=True, null=True)
+    # Expected end of the task, set when it starts (see estimates.py)
+    predicted_finish = models.DateTimeField(blank=True, null=True)
+    # When the watchdog found it running for too long (see watchdog.py)
+    overdue_at = models.DateTimeField(blank=True, null=True)
+    # Copied from the order so the dispatch queue is ordered by one index
+    priority = models.PositiveSmallIntegerField(choices=Order.PRIORITY_POSSIBLE, default=1)
+    due_date = models.DateField(blank=True, null=True)
+    # Last change of the row (for ETags and sync)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         ordering = ["queue_number"]
+        indexes = [
+            # Next task of the dispatch queue of a machine type:
+            # highest priority, then earliest due date, then first queued
+            # (same order as DISPATCH_ORDER in services.py)
+            models.Index(
+                    fields=["required_machine_type", "-priority", "due_date", "queued_at"],
+                    name="task_dispatch_queue_idx",
+                    condition=models.Q(status="pending", queued_at__isnull=False),
+            ),
+            # The watchdog scans the in progress tasks by start time
+            models.Index(fields=["status", "start_time"], name="task_status_start_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        # New tasks take the priority and due date of their order
+        if self._state.adding:
+            self.priority = self.order.priority
+            self.due_date = self.order.due_date
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.operation}"
@@ -175,8 +296,76 @@ class ActivityLog(models.Model):
                         null=True,
                         blank=True
     )
+    # Last change of the row (for ETags and sync)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         # If there is a task, get the task_id
         task = self.task.task_id if self.task else None
-        return f"[{self.log_type.upper()}] - {self.time} - Task: {task}"
\ No newline at end of file
+        return f"[{self.log_type.upper()}] - {self.time} - Task: {task}"
+
+
+class DeletedRecord(models.Model):
+    """
+    Tombstone of a deleted order, machine or task.
+    Lets the sync endpoint tell clients what to remove.
+    """
+    RESOURCE_POSSIBLE = [
+        ("order", "Order"),
+        ("machine", "Machine"),
+        ("task", "Task"),
+    ]
+
+    # Attributes
+    resource = models.CharField(max_length=20, choices=RESOURCE_POSSIBLE)
+    object_id = models.UUIDField()
+    deleted_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.resource} {self.object_id} deleted at {self.deleted_at}"
+
+
+class DurationStat(models.Model):
+    """
+    Running statistics of how long an operation takes, updated on every
+    completed task (see estimates.py), never recomputed from the history.
+    One row per operation, machine type and machine, and one per operation
+    and machine type for all the machines (machine empty).
+    """
+    operation = models.CharField(max_length=50)
+    machine_type = models.CharField(max_length=50, choices=Machine.TYPE_POSSIBLE)
+    machine = models.ForeignKey(
+            Machine,
+            on_delete=models.CASCADE,
+            null=True,
+            blank=True,
+            related_name="duration_stats",
+    )
+    count = models.PositiveIntegerField(default=0)
+    # Welford: the mean and the sum of squared differences from it, in seconds
+    mean_seconds = models.FloatField(default=0)
+    m2 = models.FloatField(default=0)
+    # P² estimators of the quantiles: quantile ("0.5"...) -> markers
+    quantiles = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                    fields=["operation", "machine_type", "machine"],
+                    condition=models.Q(machine__isnull=False),
+                    name="unique_duration_stat_machine",
+            ),
+            models.UniqueConstraint(
+                    fields=["operation", "machine_type"],
+                    condition=models.Q(machine__isnull=True),
+                    name="unique_duration_stat_type",
+            ),
+        ]
+
+    @property
+    def variance_seconds(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def __str__(self):
+        return f"{self.operation} - {self.machine or self.machine_type} ({self.count})"
@@ -1,5 +1,57 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import Group
 from rest_framework import permissions
 
+ADMIN_GROUP = "admin"
+# Claim of the JWT access token with the group names of the user
+ROLES_CLAIM = "roles"
+
+
+def roles_cache_key(user_id):
+    return f"workshop:roles:{user_id}"
+
+
+def roles_for_user_id(user_id):
+    """Group names of a user, from the DB."""
+    return sorted(Group.objects.filter(user__id=user_id).values_list("name", flat=True))
+
+
+def get_user_roles(request):
+    """
+    Group names of the user making the request.
+    Looked up in this order, the first one found wins:
+    - The memo on the request (DRF may ask more than once per request).
+    - The "roles" claim of the JWT access token.
+    - The process cache (short TTL, cleared when the groups of the user change).
+    - The DB.
+    """
+    roles = getattr(request, "_workshop_roles", None)
+    if roles is not None:
+        return roles
+
+    user = request.user
+    if not (user and user.is_authenticated):
+        roles = ()
+    else:
+        token = request.auth
+        if token is not None and hasattr(token, "get") and token.get(ROLES_CLAIM) is not None:
+            roles = tuple(token[ROLES_CLAIM])
+        else:
+            key = roles_cache_key(user.pk)
+            roles = cache.get(key)
+            if roles is None:
+                roles = tuple(roles_for_user_id(user.pk))
+                cache.set(key, roles, getattr(settings, "WORKSHOP_ROLES_CACHE_TTL", 60))
+    request._workshop_roles = roles
+    return roles
+
+
+def is_admin(request):
+    """True if the user making the request is in the "admin" group."""
+    return ADMIN_GROUP in get_user_roles(request)
+
+
 class IsAdminOrReadOnly(permissions.BasePermission):
     """
     Admins can write (and read).
@@ -18,10 +70,15 @@ class IsAdminOrReadOnly(permissions.BasePermission):
         # Part for all the users to use GET
         if request.method in permissions.SAFE_METHODS:
             return True
-        return (
-                request.user and
-                # User it authenticated
-                request.user.is_authenticated and
-                # And is an admin
-                request.user.groups.filter(name="admin").exists()
-        )
\ No newline at end of file
+        # User is authenticated and is an admin (no query on the hot path)
+        return is_admin(request)
+
+
+class IsAdmin(permissions.BasePermission):
+    """
+    Only admins can read or write.
+    Used for internal tools like the stored profiles.
+    """
+
+    def has_permission(self, request, view):
+        return is_admin(request)
@@ -0,0 +1,233 @@
+"""
+Maintenance planner: a staggered schedule of the coming maintenances.
+Left alone, a machine goes to maintenance the day it is due, and machines
+of the same type (bought or serviced together) fall due together and
+stall the dispatch queue of their type.
+The planner picks for every machine due within the horizon a day between
+today and its due date (never later) that delays the work the least:
+- Each machine type is a fluid model: every day its backlog (expected
+  hours of the pending tasks) grows by the work that arrives (the average
+  of the last WORKSHOP_PLANNER_ARRIVAL_DAYS) and shrinks by what the
+  machines that are up can do, WORKSHOP_PLANNER_HOURS_PER_DAY each.
+  A maintenance takes its machine down for that day.
+- The cost of a plan is the work left waiting at the end of each day,
+  summed over the horizon (hour-days), above the cost with no maintenance.
+  Days with spare capacity are free, and two machines down on the same
+  busy day cost more than on two days.
+- On a tie, the day with fewer machines of the type down wins, then the
+  latest one (an early maintenance wastes part of the gap).
+- Machines are placed by due date, then moved one at a time while that
+  lowers the cost (a few passes of machines x days x horizon steps).
+Machines count for their own machine_type only (not their capabilities).
+Due dates by usage are projected as if the machine worked every hour of the day.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .assignment import expected_minutes
+from .models import Machine, Task
+
+DEFAULT_HORIZON_DAYS = 21
+DEFAULT_HOURS_PER_DAY = 16
+DEFAULT_ARRIVAL_DAYS = 14
+# Improvement passes after the greedy placement
+PASSES = 3
+
+
+def expected_hours(tasks):
+    """Machine type -> expected hours of these tasks (one query)."""
+    hours = {}
+    for row in (
+        tasks
+        .values("required_machine_type")
+        .annotate(
+                estimated=Sum("estimated_duration"),
+                unestimated=Count("pk", filter=Q(estimated_duration__isnull=True)),
+        )
+    ):
+        minutes = expected_minutes(row["estimated"]) if row["estimated"] else 0
+        minutes += row["unestimated"] * expected_minutes(None)
+        hours[row["required_machine_type"]] = minutes / 60
+    return hours
+
+
+def projected_due_date(machine, today, hours_per_day):
+    """Due date by days, or earlier if its usage limits will be reached first."""
+    due = machine.maintenance_due_date or machine.next_maintenance
+    if machine.maintenance_gap_hours is not None:
+        hours_left = max(0.0, machine.maintenance_gap_hours - machine.hours_since_maintenance)
+        due = min(due, today + timedelta(days=int(hours_left // hours_per_day)))
+    if machine.maintenance_gap_cycles is not None and machine.cycles_since_maintenance:
+        # Cycles at the average length of the past ones
+        hours_per_cycle = machine.total_hours / machine.total_cycles if machine.total_cycles else 0
+        cycles_left = max(0, machine.maintenance_gap_cycles - machine.cycles_since_maintenance)
+        if hours_per_cycle:
+            due = min(due, today + timedelta(days=int(cycles_left * hours_per_cycle // hours_per_day)))
+        elif not cycles_left:
+            due = min(due, today)
+    return due
+
+
+def waiting_work(backlog, arrival, machines, down, hours_per_day):
+    """Hour-days of work waiting: the backlog left at the end of every day, summed."""
+    left = backlog
+    total = 0.0
+    for machines_down in down:
+        left = max(0.0, left + arrival - max(0, machines - machines_down) * hours_per_day)
+        total += left
+    return total
+
+
+class MaintenancePlanner:
+    """Plans the machines of every type (see the module docstring)."""
+
+    def __init__(self, horizon_days=None, hours_per_day=None, today=None):
+        self.horizon_days = horizon_days or getattr(settings, "WORKSHOP_PLANNER_HORIZON_DAYS", DEFAULT_HORIZON_DAYS)
+        self.hours_per_day = hours_per_day or getattr(settings, "WORKSHOP_PLANNER_HOURS_PER_DAY", DEFAULT_HOURS_PER_DAY)
+        self.arrival_days = getattr(settings, "WORKSHOP_PLANNER_ARRIVAL_DAYS", DEFAULT_ARRIVAL_DAYS)
+        self.today = today or timezone.now().date()
+
+    def load(self):
+        """Machines, their due dates, the backlog and the work arriving (three queries)."""
+        self.backlog = expected_hours(Task.objects.filter(status="pending"))
+        since = timezone.now() - timedelta(days=self.arrival_days)
+        self.arrival = {
+            machine_type: hours / self.arrival_days
+            for machine_type, hours in expected_hours(Task.objects.filter(order__date_creation__gte=since)).items()
+        }
+        # Machine type -> machines that work / already in maintenance
+        self.machines = defaultdict(int)
+        self.in_maintenance = defaultdict(int)
+        # (machine, due date) of the machines to plan
+        self.due = []
+        for machine in Machine.objects.exclude(status="error"):
+            self.machines[machine.machine_type] += 1
+            if machine.status == "maintenance":
+                # Back (at the earliest) tomorrow
+                self.in_maintenance[machine.machine_type] += 1
+                continue
+            due = projected_due_date(machine, self.today, self.hours_per_day)
+            if (due - self.today).days < self.horizon_days:
+                self.due.append((machine, due))
+        self.due.sort(key=lambda item: (item[1], item[0].name))
+
+        # Machine type -> machines down per day (the plan fills it)
+        self.down = self.empty_days()
+        # Waiting work without any maintenance, what the costs are measured against
+        self.baseline = {
+            machine_type: self.waiting(machine_type, [0] * self.horizon_days)
+            for machine_type in self.machines
+        }
+
+    def empty_days(self):
+        """Machines down per day and type: only the ones in maintenance today."""
+        down = defaultdict(lambda: [0] * self.horizon_days)
+        for machine_type, count in self.in_maintenance.items():
+            down[machine_type][0] = count
+        return down
+
+    def last_day(self, due):
+        """Last day (offset from today) a machine can be planned on."""
+        return min(max(0, (due - self.today).days), self.horizon_days - 1)
+
+    def waiting(self, machine_type, down):
+        return waiting_work(
+                self.backlog.get(machine_type, 0.0), self.arrival.get(machine_type, 0.0),
+                self.machines[machine_type], down, self.hours_per_day
+        )
+
+    def cost(self, machine_type, down):
+        """Extra hour-days of waiting work these maintenances cause."""
+        return self.waiting(machine_type, down) - self.baseline[machine_type]
+
+    def best_day(self, machine, due):
+        """Day (offset from today) that costs the least for this machine."""
+        down = self.down[machine.machine_type]
+        best, best_key = 0, None
+        for day in range(self.last_day(due) + 1):
+            down[day] += 1
+            key = (round(self.cost(machine.machine_type, down), 6), down[day], -day)
+            down[day] -= 1
+            if best_key is None or key < best_key:
+                best, best_key = day, key
+        return best
+
+    def plan(self):
+        """Machine id -> planned day (offset from today)."""
+        planned = {}
+        for machine, due in self.due:
+            day = self.best_day(machine, due)
+            self.down[machine.machine_type][day] += 1
+            planned[machine.pk] = day
+        for _ in range(PASSES):
+            moved = False
+            for machine, due in self.due:
+                down = self.down[machine.machine_type]
+                down[planned[machine.pk]] -= 1
+                day = self.best_day(machine, due)
+                down[day] += 1
+                if day != planned[machine.pk]:
+                    planned[machine.pk] = day
+                    moved = True
+            if not moved:
+                break
+        return planned
+
+    def cost_at_due_dates(self):
+        """Cost per type if every machine went to maintenance the day it is due."""
+        down = self.empty_days()
+        for machine, due in self.due:
+            down[machine.machine_type][self.last_day(due)] += 1
+        return {machine_type: self.cost(machine_type, down[machine_type]) for machine_type in self.machines}
+
+    def run(self):
+        """The plan, ready for the API."""
+        self.load()
+        planned = self.plan()
+        at_due_dates = self.cost_at_due_dates()
+
+        schedule = []
+        for machine, due in self.due:
+            planned_date = self.today + timedelta(days=planned[machine.pk])
+            schedule.append({
+                "machine_id": str(machine.pk),
+                "name": machine.name,
+                "machine_type": machine.machine_type,
+                "due_date": due,
+                "planned_date": planned_date,
+                "days_early": max(0, (due - planned_date).days),
+                "overdue": due < self.today,
+            })
+        schedule.sort(key=lambda row: (row["planned_date"], row["name"]))
+
+        types = {}
+        for machine_type, machines in sorted(self.machines.items()):
+            down = self.down[machine_type]
+            types[machine_type] = {
+                "machines": machines,
+                "backlog_hours": round(self.backlog.get(machine_type, 0.0), 1),
+                "arrival_hours_per_day": round(self.arrival.get(machine_type, 0.0), 1),
+                # Extra hour-days of waiting work, planned and if every
+                # machine went to maintenance the day it is due
+                "delay_hour_days": round(self.cost(machine_type, down), 1),
+                "delay_hour_days_at_due_dates": round(at_due_dates[machine_type], 1),
+                "down_per_day": [
+                    {"date": self.today + timedelta(days=day), "down": count}
+                    for day, count in enumerate(down) if count
+                ],
+            }
+        return {
+            "today": self.today,
+            "horizon_days": self.horizon_days,
+            "hours_per_day": self.hours_per_day,
+            "schedule": schedule,
+            "machine_types": types,
+        }
+
+
+def plan_maintenance(horizon_days=None):
+    return MaintenancePlanner(horizon_days=horizon_days).run()
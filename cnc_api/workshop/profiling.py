@@ -0,0 +1,229 @@
+"""
+Opt-in profiling of single API requests.
+A request is profiled when:
+- An admin asks for it with the "X-Profile" header or the "profile" query param.
+- It is picked by the random sample (WORKSHOP_PROFILING_SAMPLE_RATE).
+Two modes are available:
+- "cprofile": deterministic profile saved as a .prof file (snakeviz, flameprof...).
+- "sampling": the stack is sampled every few ms and saved as collapsed stacks
+  (one "frame;frame;frame count" line per stack) for flamegraph.pl or speedscope.
+Every profile also gets a .json summary with the SQL time grouped by the
+line (our code or DRF) that ran the query.
+"""
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .permissions import is_admin
+
+MODES = ("cprofile", "sampling")
+PROFILE_EXTENSIONS = (".prof", ".collapsed", ".json")
+
+
+def get_profiles_dir():
+    """Folder where the profiles are stored. Created on demand."""
+    folder = getattr(settings, "WORKSHOP_PROFILING_DIR", settings.BASE_DIR / "profiles")
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+
+def list_profiles():
+    """Stored profile files, newest first."""
+    files = [f for f in get_profiles_dir().iterdir() if f.suffix in PROFILE_EXTENSIONS]
+    return sorted(files, key=lambda f: f.stat().st_mtime, reverse=True)
+
+
+def _prune_profiles():
+    """Deletes the oldest profiles above WORKSHOP_PROFILING_MAX_FILES."""
+    limit = getattr(settings, "WORKSHOP_PROFILING_MAX_FILES", 200)
+    for old_file in list_profiles()[limit:]:
+        old_file.unlink(missing_ok=True)
+
+
+def _requested_mode(request):
+    """Mode asked by the client, None if the request does not ask for a profile."""
+    value = request.headers.get("X-Profile") or request.query_params.get("profile")
+    if not value or value in ("0", "false"):
+        return None
+    return value if value in MODES else getattr(settings, "WORKSHOP_PROFILING_MODE", "sampling")
+
+
+def choose_mode(request):
+    """
+    Decides if the request gets profiled and how.
+    Explicit requests are only honoured for admins.
+    """
+    if not getattr(settings, "WORKSHOP_PROFILING_ENABLED", False):
+        return None
+    mode = _requested_mode(request)
+    if mode:
+        return mode if is_admin(request) else None
+    sample_rate = getattr(settings, "WORKSHOP_PROFILING_SAMPLE_RATE", 0.0)
+    if sample_rate and random.random() < sample_rate:
+        return getattr(settings, "WORKSHOP_PROFILING_MODE", "sampling")
+    return None
+
+
+def _call_site(stack):
+    """
+    Innermost frame of the stack that is not part of Django's ORM.
+    That is our code or DRF code (serializers, mixins) running the query.
+    """
+    base_dir = str(settings.BASE_DIR)
+    for frame in reversed(stack):
+        filename = frame.filename
+        if f"{os.sep}django{os.sep}" in filename or filename == __file__:
+            continue
+        if filename.startswith(base_dir) and "site-packages" not in filename:
+            filename = filename[len(base_dir) + 1:]
+        elif "site-packages" in filename:
+            filename = filename.split("site-packages" + os.sep, 1)[1]
+        return f"{filename}:{frame.lineno} ({frame.name})"
+    return "<unknown>"
+
+
+class QueryRecorder:
+    """
+    DB execute wrapper that groups SQL time by call site.
+    Installed with connection.execute_wrapper().
+    """
+
+    def __init__(self):
+        self.sites = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            site = _call_site(traceback.extract_stack())
+            entry = self.sites.setdefault(site, {"queries": 0, "seconds": 0.0})
+            entry["queries"] += 1
+            entry["seconds"] += elapsed
+
+    def summary(self):
+        return sorted(
+                ({"site": site, **data} for site, data in self.sites.items()),
+                key=lambda entry: entry["seconds"],
+                reverse=True
+        )
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.items()) + "\n"
+
+
+class RequestProfile:
+    """Profile of one request: the profiler plus the SQL recorder."""
+
+    def __init__(self, mode, label):
+        self.mode = mode
+        self.label = label
+        self.profile_id = f"{timezone.now():%Y%m%dT%H%M%S}-{label}-{uuid.uuid4().hex[:8]}"
+        self.recorder = QueryRecorder()
+        self._stack = ExitStack()
+        self._profiler = None
+        self._sampler = None
+        self._started = None
+
+    def start(self):
+        self._stack.enter_context(connection.execute_wrapper(self.recorder))
+        if self.mode == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            interval = getattr(settings, "WORKSHOP_PROFILING_INTERVAL", 0.005)
+            self._sampler = StackSampler(threading.get_ident(), interval)
+            self._sampler.start()
+        self._started = time.perf_counter()
+
+    def stop(self, status_code=None):
+        """Stops profiling and writes the files. Returns the profile id."""
+        elapsed = time.perf_counter() - self._started
+        if self._profiler:
+            self._profiler.disable()
+        if self._sampler:
+            self._sampler.stop()
+        self._stack.close()
+
+        folder = get_profiles_dir()
+        if self._profiler:
+            self._profiler.dump_stats(folder / f"{self.profile_id}.prof")
+        if self._sampler:
+            (folder / f"{self.profile_id}.collapsed").write_text(self._sampler.collapsed())
+        summary = {
+            "profile_id": self.profile_id,
+            "mode": self.mode,
+            "label": self.label,
+            "status_code": status_code,
+            "seconds": elapsed,
+            "queries": sum(entry["queries"] for entry in self.recorder.sites.values()),
+            "sql_by_site": self.recorder.summary(),
+        }
+        (folder / f"{self.profile_id}.json").write_text(json.dumps(summary, indent=2))
+        _prune_profiles()
+        return self.profile_id
+
+
+class ProfilingMixin:
+    """
+    Profiles a viewset request when choose_mode() says so.
+    The profiler starts once the user is authenticated (so admins can be told apart)
+    and stops when the response is finalized, even on errors.
+    The profile id is returned in the "X-Profile-Id" header.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        mode = choose_mode(request)
+        if mode:
+            label = f"{getattr(self, 'basename', 'view')}-{getattr(self, 'action', None) or 'unknown'}"
+            self._request_profile = RequestProfile(mode, label)
+            self._request_profile.start()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        request_profile = getattr(self, "_request_profile", None)
+        if request_profile:
+            self._request_profile = None
+            response["X-Profile-Id"] = request_profile.stop(status_code=response.status_code)
+        return response
@@ -0,0 +1,50 @@
+"""
+MessagePack support for high-volume clients.
+Ask for it with "Accept: application/msgpack" (or ?format=msgpack)
+and send it with "Content-Type: application/msgpack".
+"""
+import datetime
+import decimal
+import uuid
+
+import msgpack
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+
+
+def _encode_default(value):
+    """Types msgpack doesn't know. Serializers usually send them as strings already."""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (uuid.UUID, decimal.Decimal)):
+        return str(value)
+    raise TypeError(f"Cannot encode {type(value).__name__} as MessagePack.")
+
+
+def message_packer():
+    """Packer with the renderer's options, for responses packed a piece at a time."""
+    return msgpack.Packer(default=_encode_default, use_bin_type=True)
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(data, default=_encode_default, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    media_type = "application/msgpack"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as e:
+            raise ParseError(f"MessagePack parse error - {e}")
@@ -0,0 +1,117 @@
+"""
+Versioned cache for the read endpoints.
+Every resource (order, machine, task, activitylog) has a version number
+in the cache. Cached responses are keyed by the endpoint, the query params
+and the versions of every resource they show, so bumping a version makes
+the old responses unreachable (they expire on their own).
+Versions are bumped when a row is saved or deleted (signals.py), which covers
+the services layer, and explicitly by services that use bulk updates.
+The versions only reach the processes sharing the cache: with a per-process
+backend (LocMemCache) the responses are only cached when a single process
+serves the API (WORKSHOP_SINGLE_PROCESS), else they are never cached
+(checks.py warns). Cached bodies always expire after
+WORKSHOP_RESPONSE_CACHE_TTL seconds.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+
+RESOURCES = ("order", "machine", "task", "activitylog")
+DEFAULT_TTL = 300
+# Backends whose data is only seen by the process that wrote it
+LOCAL_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def shared_cache():
+    """The default cache is seen by every process."""
+    return settings.CACHES["default"]["BACKEND"] not in LOCAL_BACKENDS
+
+
+def response_cache_enabled():
+    """Cached responses are coherent: a shared cache, or a single process."""
+    return shared_cache() or getattr(settings, "WORKSHOP_SINGLE_PROCESS", False)
+
+
+def version_key(resource):
+    return f"workshop:version:{resource}"
+
+
+def _bump(resources):
+    for resource in resources:
+        key = version_key(resource)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Missing (first use or evicted): start from a number never used before
+            cache.add(key, time.time_ns(), timeout=None)
+
+
+def bump_versions(*resources):
+    """
+    Invalidates the cached responses that show these resources.
+    Bumps now (so this process sees its own writes) and again on commit
+    (so a response cached by another request before the commit is not reused).
+    """
+    _bump(resources)
+    transaction.on_commit(lambda: _bump(resources))
+
+
+def get_versions(resources):
+    """Current version of each resource."""
+    keys = [version_key(resource) for resource in resources]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def response_cache_key(request, viewset, action, resources):
+    """Key for the endpoint, its query params, the format and the resource versions."""
+    params = sorted(request.query_params.lists())
+    media_type = getattr(request, "accepted_media_type", "")
+    raw = f"{request.path}|{params}|{media_type}|{get_versions(resources)}"
+    digest = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    return f"workshop:response:{viewset}:{action}:{digest}"
+
+
+class ResponseCacheMixin:
+    """
+    Caches the serialized data of list and retrieve.
+    `cache_dependencies` lists the resources shown by the endpoint
+    (the model itself and the nested ones).
+    """
+    cache_dependencies = ()
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if not self.cache_dependencies or request.method != "GET" or not response_cache_enabled():
+            return handler(request, *args, **kwargs)
+
+        key = response_cache_key(request, self.basename, self.action, self.cache_dependencies)
+        cached = cache.get(key)
+        if cached is not None:
+            response = Response(cached)
+            response["X-Cache"] = "HIT"
+            return response
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            # Never kept forever (None would mean no expiry)
+            ttl = getattr(settings, "WORKSHOP_RESPONSE_CACHE_TTL", None) or DEFAULT_TTL
+            cache.set(key, response.data, ttl)
+        response["X-Cache"] = "MISS"
+        return response
@@ -0,0 +1,114 @@
+"""
+Precomputed OpenAPI schema for /swagger/ and /redoc/.
+Introspecting every viewset and serializer is slow, so the schema is
+rendered once and the bytes are kept in memory:
+- At build time, "python manage.py build_schema" writes the JSON and YAML
+  files to WORKSHOP_SCHEMA_DIR, and every process loads them on the first hit.
+- Without those files, the first hit of each process generates the schema.
+Docs hits then only send the bytes (or a 304 for an unchanged ETag).
+"""
+import hashlib
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson, OpenAPICodecYaml
+from drf_yasg.generators import OpenAPISchemaGenerator
+from drf_yasg.renderers import SwaggerYAMLRenderer
+from drf_yasg.views import get_schema_view
+from rest_framework import permissions
+
+API_INFO = openapi.Info(
+        title="CNC Workshop Manager API",
+        default_version="v1",
+        description="API for managing CNC orders, machines and tasks.",
+        terms_of_service="my_company/ToS",
+        contact=openapi.Contact(email="company@email.com"),
+        license=openapi.License(name="MIT License"),
+)
+
+# Format -> codec that renders it
+CODECS = {"json": OpenAPICodecJson, "yaml": OpenAPICodecYaml}
+
+_lock = threading.Lock()
+# Format -> (body, etag)
+_documents = {}
+
+
+def get_schema_dir():
+    return Path(getattr(settings, "WORKSHOP_SCHEMA_DIR", settings.BASE_DIR / "schema"))
+
+
+def schema_path(schema_format):
+    return get_schema_dir() / f"openapi.{schema_format}"
+
+
+def render_schema():
+    """Introspects the API and renders the public schema in every format."""
+    schema = OpenAPISchemaGenerator(API_INFO).get_schema(request=None, public=True)
+    return {schema_format: codec([]).encode(schema) for schema_format, codec in CODECS.items()}
+
+
+def _etag(body):
+    return f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+def load_documents():
+    """The built files if all of them exist, else a freshly rendered schema."""
+    paths = {schema_format: schema_path(schema_format) for schema_format in CODECS}
+    if all(path.is_file() for path in paths.values()):
+        bodies = {schema_format: path.read_bytes() for schema_format, path in paths.items()}
+    else:
+        bodies = render_schema()
+    return {schema_format: (body, _etag(body)) for schema_format, body in bodies.items()}
+
+
+def get_document(schema_format):
+    """(body, etag) of the schema in this format, loaded once per process."""
+    if not _documents:
+        with _lock:
+            # Another thread may have loaded them while this one waited
+            if not _documents:
+                _documents.update(load_documents())
+    return _documents[schema_format]
+
+
+def clear_documents():
+    """Forgets the schema in memory (the next hit loads it again)."""
+    with _lock:
+        _documents.clear()
+
+
+BaseSchemaView = get_schema_view(
+        API_INFO,
+        public=True,
+        permission_classes=[permissions.AllowAny],
+)
+
+
+class SchemaView(BaseSchemaView):
+    """
+    drf_yasg schema view that sends the precomputed schema.
+    The UI pages (swagger, redoc) are still rendered by drf_yasg: they are
+    only a template (that shows the user) and don't introspect the API.
+    """
+
+    def get(self, request, version="", format=None):
+        renderer = request.accepted_renderer
+        if renderer.media_type == "text/html":
+            return super().get(request, version, format)
+
+        schema_format = "yaml" if isinstance(renderer, SwaggerYAMLRenderer) else "json"
+        body, etag = get_document(schema_format)
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match and etag in [tag.removeprefix("W/") for tag in parse_etags(if_none_match)]:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type=renderer.media_type)
+        response["ETag"] = etag
+        # Browsers revalidate every time, the answer is a cheap 304
+        response["Cache-Control"] = "no-cache"
+        return response
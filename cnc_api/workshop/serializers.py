@@ -1,38 +1,205 @@
 """
 Take a model and convert it to JSON format.
 """
+from django.db import transaction
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
 
+from .dependencies import creates_cycle, load_order_graph
+from .estimates import quantile_seconds
+from .models import Order, Machine, MachineCapability, Task, ActivityLog, DurationStat
+from .permissions import ROLES_CLAIM, roles_for_user_id
 
-from .models import Order, Machine, Task, ActivityLog
 
+def requested_fields(request):
+    """
+    Field names asked with ?fields=a,b and dropped with ?omit=c.
+    Returns (fields or None, omitted). Only for reads.
+    """
+    if request is None or request.method not in ("GET", "HEAD"):
+        return None, set()
+    params = request.query_params
 
-class ActivityLogSerializer(serializers.ModelSerializer):
+    def names(param):
+        return {name.strip() for value in params.getlist(param) for name in value.split(",") if name.strip()}
+
+    fields = names("fields")
+    return fields or None, names("omit")
+
+
+class SparseFieldsMixin:
+    """
+    Lets clients trim the response with ?fields= and ?omit=.
+    Only the top-level serializer is trimmed: nested serializers
+    are either kept whole or dropped.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # Nested serializers (tasks inside an order...) share the request context
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        if parent is not None:
+            return fields
+
+        wanted, omitted = requested_fields(self.context.get("request"))
+        for name in list(fields):
+            if (wanted is not None and name not in wanted) or name in omitted:
+                fields.pop(name)
+        return fields
+
+
+class ActivityLogSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = ActivityLog
         fields = "__all__"
 
-class TaskSerializer(serializers.ModelSerializer):
+class TaskSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     logs = ActivityLogSerializer(many=True, read_only=True)
     
     class Meta:
         model = Task
         fields = "__all__"
         # Lets a Task have null values for "machine"
+        # The dispatch queue is managed by the services
         extra_kwargs = {
-                "machine": {"required": False, "allow_null": True}
+                "machine": {"required": False, "allow_null": True},
+                "queued_at": {"read_only": True},
+                "overdue_at": {"read_only": True},
+                "predicted_finish": {"read_only": True},
+                # Inherited from the order
+                "priority": {"read_only": True},
+                "due_date": {"read_only": True},
         }
 
-class OrderSerializer(serializers.ModelSerializer):
+    def validate(self, attrs):
+        """Predecessors must be tasks of the same order and can't form a cycle."""
+        attrs = super().validate(attrs)
+        predecessors = attrs.get("predecessors")
+        if not predecessors:
+            return attrs
+        order = attrs.get("order") or self.instance.order
+        if any(predecessor.order_id != order.pk for predecessor in predecessors):
+            raise serializers.ValidationError({"predecessors": "Predecessors must be tasks of the same order."})
+        # A new task has no successors yet, so it can't close a cycle
+        if self.instance is not None:
+            _, graph = load_order_graph(order.pk, implicit_chain=False)
+            if creates_cycle(self.instance.pk, [p.pk for p in predecessors], graph):
+                raise serializers.ValidationError({"predecessors": "Task dependencies can't form a cycle."})
+        return attrs
+
+class OrderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     tasks = TaskSerializer(many=True, read_only=True)
     
     class Meta:
         model = Order
         fields = "__all__"
 
-class MachineSerializer(serializers.ModelSerializer):
+class MachineCapabilitySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MachineCapability
+        fields = ["machine_type", "speed_factor"]
+
+class MachineSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     tasks = TaskSerializer(many=True, read_only=True)
+    # Written with the machine: the list sent replaces the previous one
+    capabilities = MachineCapabilitySerializer(many=True, required=False)
     
     class Meta:
         model = Machine
-        fields = "__all__"
\ No newline at end of file
+        fields = "__all__"
+        # Kept by the services
+        read_only_fields = [
+            "hours_since_maintenance", "cycles_since_maintenance", "total_hours", "total_cycles",
+        ]
+
+    def validate_capabilities(self, value):
+        machine_types = [capability["machine_type"] for capability in value]
+        if len(machine_types) != len(set(machine_types)):
+            raise serializers.ValidationError("Each machine type can only be listed once.")
+        return value
+
+    def create(self, validated_data):
+        capabilities = validated_data.pop("capabilities", [])
+        with transaction.atomic():
+            machine = super().create(validated_data)
+            self.save_capabilities(machine, capabilities)
+        return machine
+
+    def update(self, instance, validated_data):
+        capabilities = validated_data.pop("capabilities", None)
+        with transaction.atomic():
+            # Left out of a partial update: unchanged.
+            # Written before the machine is saved, so the save (updated_at,
+            # cache versions bumped again on commit) comes after them
+            if capabilities is not None:
+                instance.capabilities.all().delete()
+                self.save_capabilities(instance, capabilities)
+            machine = super().update(instance, validated_data)
+        return machine
+
+    def save_capabilities(self, machine, capabilities):
+        MachineCapability.objects.bulk_create(
+                [MachineCapability(machine=machine, **capability) for capability in capabilities]
+        )
+
+
+class DurationStatSerializer(serializers.ModelSerializer):
+    variance_seconds = serializers.FloatField(read_only=True)
+    p50_seconds = serializers.SerializerMethodField()
+    p90_seconds = serializers.SerializerMethodField()
+
+    class Meta:
+        model = DurationStat
+        fields = [
+            "id", "operation", "machine_type", "machine", "count", "mean_seconds",
+            "variance_seconds", "p50_seconds", "p90_seconds", "updated_at",
+        ]
+
+    def get_p50_seconds(self, stat):
+        return quantile_seconds(stat, 0.5)
+
+    def get_p90_seconds(self, stat):
+        return quantile_seconds(stat, 0.9)
+
+
+# Flat versions (no nested rows) used by the sync endpoint
+class OrderSyncSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Order
+        fields = "__all__"
+
+class MachineSyncSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Machine
+        fields = "__all__"
+
+class TaskSyncSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Task
+        fields = "__all__"
+
+
+# Authentication
+class WorkshopTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """Adds the username and the roles (group names) to the tokens."""
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token["username"] = user.get_username()
+        token[ROLES_CLAIM] = roles_for_user_id(user.pk)
+        return token
+
+class WorkshopTokenRefreshSerializer(TokenRefreshSerializer):
+    """Reads the roles again when the access token is renewed."""
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        access = AccessToken(data["access"])
+        access[ROLES_CLAIM] = roles_for_user_id(access[jwt_settings.USER_ID_CLAIM])
+        data["access"] = str(access)
+        return data
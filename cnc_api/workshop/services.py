@@ -1,70 +1,399 @@
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from rest_framework.exceptions import ValidationError
-from .models import Machine, ActivityLog
+
+from . import metrics
+from .assignment import load_speeds, match
+from .dependencies import blocked_tasks, load_order_graph, ready_tasks
+from .dispatcher import dispatch_key, get_mode, notify
+from .estimates import load_stats, predict_finish, record_duration
+from .models import Machine, MachineCapability, Task, ActivityLog
+from .response_cache import bump_versions
+from .sweeper import start_sweeper
+
+# Order of the dispatch queue: highest priority, earliest due date
+# (no due date last), then first queued. Matches task_dispatch_queue_idx
+DISPATCH_ORDER = ("-priority", F("due_date").asc(nulls_last=True), "queued_at")
+
+# Machine counters updated by complete_task
+USAGE_FIELDS = ["hours_since_maintenance", "cycles_since_maintenance", "total_hours", "total_cycles"]
+
+
+class TaskQueued(ValidationError):
+    """
+    No machine of the required type was free: the task is waiting
+    in the dispatch queue and will start when one becomes idle.
+    """
+    default_detail = "No machines of the required type available. The task is queued and will start when one is free."
+
 
 # Machine
 def start_task_with_auto_machine_assignation(task):
     """
     Starts a task.
     Checks it is "pending".
-    Assigns an "idle" machine of the required type.
+    Assigns the fastest "idle" machine able to do the required type.
     Updates the task and machine status.
     Updates the order status if needed if it's the first tasks.
+    If no machine is free, the task goes to the dispatch queue (TaskQueued).
     """
     if task.status != "pending":
         raise ValidationError('Only tasks with "pending" status can be started.')
-    # Look into the machines with in case there is one with "idle" status that needs maintenance
-    check_need_maintenance_all_machines()
+    if task.predecessors.exclude(status="completed").exists():
+        raise ValidationError("The predecessors of the task must be completed first.")
+    # The fleet is swept for due machines in the background (see sweeper.py)
+    start_sweeper()
 
     # If there is no machine assigned to the task yet
     if not task.machine:
-        # Get the machines that can take the task
-        available_machines = Machine.objects.filter(
-                status="idle",
-                machine_type=task.required_machine_type
+        with transaction.atomic():
+            # Get the fastest idle machine that can take the task (its own
+            # machine type or a capability; speed factor 1 if not given).
+            # Locked, so two starts at once don't take the same machine
+            # (skip_locked: the other one takes the next machine instead of waiting)
+            capable = MachineCapability.objects.filter(machine_type=task.required_machine_type)
+            speed = capable.filter(machine=OuterRef("pk")).values("speed_factor")[:1]
+            machines = (
+                Machine.objects
+                .select_for_update(skip_locked=True)
+                .filter(status="idle")
+                .filter(
+                        Q(machine_type=task.required_machine_type)
+                        | Q(pk__in=capable.values("machine_id"))
+                )
+                .annotate(speed=Coalesce(Subquery(speed), Value(1.0)))
+                .order_by("-speed", "pk")
+            )
+            # Only the machine about to be taken is checked: a due one
+            # goes to maintenance and the next one is tried
+            machine = machines.first()
+            while machine is not None and machine.needs_maintenance:
+                enter_maintenance(machine)
+                machine = machines.first()
+            if machine is not None:
+                run_task_on_machine(task, machine)
+        if machine is None:
+            metrics.ASSIGNMENT_FAILURES.inc(machine_type=task.required_machine_type)
+            enqueue_task(task)
+            raise TaskQueued()
+    return task
+
+
+def run_task_on_machine(task, machine):
+    """Sets the task "in_progress" on the machine and the machine "running"."""
+    task.machine = machine
+    # Set the new status on the machine and save it
+    machine.status = "running"
+    machine.save()
+    # Do the same with the task and set its start_time
+    task.status = "in_progress"
+    task.start_time = timezone.now()
+    task.predicted_finish = predict_finish(task, load_stats([task]))
+    # Out of the dispatch queue (if it was in it)
+    task.queued_at = None
+    task.save()
+    metrics.TASKS_STARTED.inc(machine_type=task.required_machine_type)
+
+
+def enqueue_task(task):
+    """Puts a pending task in the dispatch queue (keeps its place if it already was)."""
+    if task.queued_at is None:
+        task.queued_at = timezone.now()
+        task.save(update_fields=["queued_at", "updated_at"])
+        metrics.TASKS_QUEUED.inc(machine_type=task.required_machine_type)
+        notify(
+                "task_queued", task.pk, task.required_machine_type,
+                dispatch_key(task.priority, task.due_date, task.queued_at),
+                task.estimated_duration
         )
-        if not available_machines:
-            raise ValidationError("No machines of the required type available.")
-        # Set the first machine on the list that fulfill the requirements
-        machine = available_machines[0]
-        task.machine = machine
-        # Set the new status on the machine and save it
-        machine.status = "running"
-        machine.save()
-        # Do the same with the task and set its start_time
-        task.status = "in_progress"
-        task.start_time = timezone.now()
-        task.save()
     return task
 
 
-def check_need_maintenance_all_machines():
+def dispatch_machine(machine):
     """
-    Changes the status of those machines that have "idle" status
-    when they should be on "maintenance" instead.
+    Starts a task of the dispatch queue on an idle machine: the best one
+    (see assignment.match) among the heads of the queues of the machine
+    types it can do.
+    Runs in the transaction of the caller (the one that freed the machine).
+    The machine and the task are locked; skip_locked lets two machines
+    freed at the same time take two different tasks.
+    Returns the started task (or None).
+    With the in-memory dispatcher on, it gets the idle machine instead
+    and starts the task on its own (returns None).
     """
-    # Filter "idle" machines alone
-    machines = Machine.objects.filter(
-        status="idle"
+    if get_mode() != "inline":
+        notify("machine_idle", machine.pk, load_speeds([machine])[machine.pk])
+        return None
+    with transaction.atomic():
+        machine = Machine.objects.select_for_update().filter(pk=machine.pk, status="idle").first()
+        if machine is None:
+            return None
+        if machine.needs_maintenance:
+            enter_maintenance(machine)
+            return None
+        # The head of the queue of every type the machine can do
+        speeds = load_speeds([machine])
+        heads = {}
+        for machine_type in speeds[machine.pk]:
+            task = (
+                Task.objects
+                .select_for_update(skip_locked=True)
+                .select_related("order")
+                .filter(status="pending", queued_at__isnull=False, required_machine_type=machine_type)
+                .order_by(*DISPATCH_ORDER)
+                .first()
+            )
+            if task is not None:
+                heads[machine_type] = task
+        heads = sorted(heads.values(), key=lambda task: dispatch_key(task.priority, task.due_date, task.queued_at))
+        pairs = match(
+                [(task.pk, task.required_machine_type, task.estimated_duration) for task in heads],
+                speeds
+        )
+        if not pairs:
+            return None
+        task = next(task for task in heads if task.pk == pairs[0][0])
+
+        run_task_on_machine(task, machine)
+        metrics.TASKS_DISPATCHED.inc(machine_type=machine.machine_type)
+        # The first task of an order that couldn't start
+        order = task.order
+        if order.status == "pending":
+            order.status = "in_progress"
+            order.date_start = task.start_time
+            order.save()
+        create_log_event_task(
+                task,
+                log_type="info",
+                message=f"'{task.operation}' started on machine '{machine.name}' (from the dispatch queue)."
+        )
+    return task
+
+
+def release_ready_tasks(order, user=None):
+    """
+    Starts every task of the order whose predecessors are completed,
+    each one on its own machine. The ones with no free machine go to
+    the dispatch queue.
+    Returns (started tasks, queued tasks).
+    """
+    started, queued = [], []
+    for task in ready_tasks(order.pk):
+        task.order = order
+        try:
+            start_task_with_auto_machine_assignation(task)
+        except TaskQueued:
+            queued.append(task)
+            continue
+        create_log_event_task(
+                task,
+                log_type="info",
+                message=f"'{task.operation}' started on machine '{task.machine.name}'.",
+                user=user
+        )
+        started.append(task)
+    return started, queued
+
+
+def get_backlog(machine_type, limit):
+    """
+    The dispatch queue of a machine type, in the order the tasks will start.
+    One index range scan (task_dispatch_queue_idx) per call.
+    """
+    return list(
+        Task.objects
+        .filter(status="pending", queued_at__isnull=False, required_machine_type=machine_type)
+        .order_by(*DISPATCH_ORDER)
+        .values(
+            "task_id", "order_id", "operation", "priority", "due_date", "queued_at",
+            order_name=F("order__name"),
+        )[:limit]
     )
-    # From those, get the ones that need maintenance and save their new status
-    for m in machines:
-        if m.needs_maintenance:
-            m.status = "maintenance"
-            m.save()
+
+
+def update_order_schedule(order):
+    """
+    Copies the priority and due date of an order to its unfinished tasks
+    (the queued ones move in the dispatch queue).
+    """
+    updated = (
+        Task.objects
+        .filter(order=order, status__in=("pending", "in_progress"))
+        .update(priority=order.priority, due_date=order.due_date, updated_at=timezone.now())
+    )
+    # Bulk updates don't send signals
+    if updated:
+        bump_versions("task")
+        # The queued ones change place
+        notify("reload")
+    return updated
+
+
+def complete_task(task):
+    """
+    Completes a task.
+    Checks it is "in_progress" (on the locked row).
+    Frees the machine: "idle" or "maintenance" if it's due.
+    An idle machine takes the next task of the dispatch queue right away.
+    """
+    with transaction.atomic():
+        # Locked and checked again: of two completions at the same time,
+        # the second one waits and finds the task completed, so the
+        # machine counts it once
+        task.refresh_from_db(from_queryset=Task.objects.select_for_update())
+        if task.status != "in_progress":
+            raise ValidationError("Cannot complete a task that is not 'in_progress'.")
+        task.status = "completed"
+        task.finish_time = timezone.now()
+        task.save()
+        metrics.TASKS_COMPLETED.inc(machine_type=task.required_machine_type)
+        # After the locked check: a task is added to the statistics once
+        record_duration(task)
+
+        # Add the task to the usage counters of the machine: one UPDATE,
+        # whatever the history of the machine (F() adds in the DB, so
+        # nothing is lost if the row changed since it was loaded)
+        machine = task.machine
+        hours = (task.finish_time - task.start_time).total_seconds() / 3600 if task.start_time else 0
+        Machine.objects.filter(pk=machine.pk).update(
+                hours_since_maintenance=F("hours_since_maintenance") + hours,
+                cycles_since_maintenance=F("cycles_since_maintenance") + 1,
+                total_hours=F("total_hours") + hours,
+                total_cycles=F("total_cycles") + 1,
+        )
+        machine.refresh_from_db(fields=USAGE_FIELDS)
+
+        # Change the status for the used machine depending if it needs or not maintenance
+        # (the view logs it with the task)
+        if machine.needs_maintenance:
+            machine.status = "maintenance"
+            metrics.MAINTENANCE_TRANSITIONS.inc(transition="entered", machine_type=machine.machine_type)
+        else:
+            machine.status = "idle"
+        machine.save(update_fields=["status", "updated_at"])
+        if machine.status == "idle":
+            dispatch_machine(machine)
+    # The machine may be running a task of the queue now
+    machine.refresh_from_db(fields=["status"])
+    return task
+
+
+def fail_task(task, reason):
+    """
+    Fails an "in_progress" task and releases its machine:
+    "idle" (taking the next queued task) or "maintenance" if it's due.
+    Returns None, changing nothing, if the task isn't "in_progress"
+    anymore (completed by an operator since it was loaded...).
+    The tasks of the order waiting on it can't start: they are logged
+    as blocked (and listed by the critical path of the order).
+    """
+    with transaction.atomic():
+        # Checked on the locked row: the machine of a task completed
+        # meanwhile may be running the next queued task already
+        task.refresh_from_db(from_queryset=Task.objects.select_for_update())
+        if task.status != "in_progress":
+            return None
+        task.status = "failed"
+        task.finish_time = timezone.now()
+        task.save()
+        create_log_event_task(task, log_type="error", message=f"'{task.operation}' failed: {reason}")
+        tasks, predecessors = load_order_graph(task.order_id)
+        blocked = blocked_tasks(tasks, predecessors)
+        if blocked:
             create_log_event_task(
-                    task=None,
+                    task,
                     log_type="warning",
-                    message=f"{m.name} is now under MAINTENANCE"
+                    message=f"'{task.operation}' failed, tasks of the order now blocked: "
+                            + ", ".join(f"'{tasks[task_id].operation}'" for task_id in blocked)
             )
 
+        machine = task.machine
+        if machine.needs_maintenance:
+            enter_maintenance(machine)
+        else:
+            machine.status = "idle"
+            machine.save(update_fields=["status", "updated_at"])
+            dispatch_machine(machine)
+    machine.refresh_from_db(fields=["status"])
+    return task
+
+
+def pass_machine_maintenance(machine):
+    """
+    Passes the maintenance of a machine.
+    Only machines under "maintenance" can pass it.
+    The machine goes back to "idle" and takes the next task of the dispatch queue.
+    """
+    if machine.status != "maintenance":
+        raise ValidationError(
+                f"Maintenance can only be passed to machines under MAINTENANCE - '{machine.name}' status: {machine.status}"
+        )
+    with transaction.atomic():
+        machine.last_maintenance = timezone.now().date()
+        machine.status = "idle"
+        # Usage is counted again from here
+        machine.hours_since_maintenance = 0
+        machine.cycles_since_maintenance = 0
+        machine.save()
+        metrics.MAINTENANCE_TRANSITIONS.inc(transition="passed", machine_type=machine.machine_type)
+        dispatch_machine(machine)
+    machine.refresh_from_db(fields=["status"])
+    return machine
+
+
+def enter_maintenance(machine):
+    """Puts a due machine under "maintenance" and logs it."""
+    machine.status = "maintenance"
+    machine.save(update_fields=["status", "updated_at"])
+    metrics.MAINTENANCE_TRANSITIONS.inc(transition="entered", machine_type=machine.machine_type)
+    create_log_event_task(
+            task=None,
+            log_type="warning",
+            message=f"{machine.name} is now under MAINTENANCE"
+    )
+
+
+def check_need_maintenance_all_machines():
+    """
+    Changes the status of those machines that have "idle" status
+    when they should be on "maintenance" instead (by date, hours of use or cycles).
+    Set-based: one query finds them and one update changes them all.
+    Run by the maintenance sweeper (sweeper.py), not by the requests.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = list(
+            Machine.objects
+            .select_for_update()
+            .filter(Machine.due_for_maintenance(now.date()), status="idle")
+            .values_list("pk", "name", "machine_type")
+        )
+        if not due:
+            return []
+        Machine.objects.filter(pk__in=[pk for pk, _, _ in due]).update(status="maintenance", updated_at=now)
+        ActivityLog.objects.bulk_create([
+            ActivityLog(log_type="warning", message=f"[WARNING] - {name} is now under MAINTENANCE")
+            for _, name, _ in due
+        ])
+        # Bulk writes don't send signals
+        bump_versions("machine", "activitylog")
+    for _, _, machine_type in due:
+        metrics.MAINTENANCE_TRANSITIONS.inc(transition="entered", machine_type=machine_type)
+    return [pk for pk, _, _ in due]
+
 
 # ActivityLogs
 def create_log_event_task(task, log_type, message, user=None):
-    """Creates a log for a task."""
+    """
+    Creates a log for a task.
+    Only the id of the user is needed, so token users (see authentication.py)
+    don't have to be loaded from the DB.
+    """
     return ActivityLog.objects.create(
             task=task,
             log_type=log_type,
             message=f"[{log_type.upper()}] - {message}",
-            user=user
+            user_id=user.pk if user else None
     )
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""
+Signal receivers of the workshop app.
+Connected in WorkshopConfig.ready().
+"""
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+
+from .models import ActivityLog, DeletedRecord, Machine, Order, Task
+from .permissions import roles_cache_key
+from .response_cache import bump_versions
+
+
+def _forget_roles(user_ids):
+    cache.delete_many([roles_cache_key(user_id) for user_id in user_ids])
+
+
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Clears the cached roles when users are added to or removed from groups."""
+    if not reverse and action in ("post_add", "post_remove", "post_clear"):
+        # user.groups.add(...) -> instance is the user
+        _forget_roles([instance.pk])
+    elif reverse and action in ("post_add", "post_remove"):
+        # group.user_set.add(...) -> pk_set are the users
+        _forget_roles(pk_set or ())
+    elif reverse and action == "pre_clear":
+        # group.user_set.clear() -> every member, while they are still members
+        _forget_roles(instance.user_set.values_list("pk", flat=True))
+
+
+def group_changed(sender, instance, **kwargs):
+    """A renamed or deleted group changes the roles of all its members."""
+    _forget_roles(instance.user_set.values_list("pk", flat=True))
+
+
+def user_deleted(sender, instance, **kwargs):
+    _forget_roles([instance.pk])
+
+
+def workshop_row_changed(sender, instance, **kwargs):
+    """Any saved or deleted row invalidates the cached responses that show it."""
+    bump_versions(sender._meta.model_name)
+
+
+def workshop_row_deleted(sender, instance, **kwargs):
+    """Leaves a tombstone so synced clients remove the row."""
+    DeletedRecord.objects.create(resource=sender._meta.model_name, object_id=instance.pk)
+
+
+def connect():
+    m2m_changed.connect(user_groups_changed, sender=User.groups.through, dispatch_uid="workshop_user_groups")
+    post_save.connect(group_changed, sender=Group, dispatch_uid="workshop_group_saved")
+    pre_delete.connect(group_changed, sender=Group, dispatch_uid="workshop_group_deleted")
+    post_delete.connect(user_deleted, sender=User, dispatch_uid="workshop_user_deleted")
+
+    for model in (Order, Machine, Task, ActivityLog):
+        post_save.connect(workshop_row_changed, sender=model, dispatch_uid=f"workshop_{model._meta.model_name}_saved")
+        post_delete.connect(workshop_row_changed, sender=model, dispatch_uid=f"workshop_{model._meta.model_name}_deleted")
+        if model is not ActivityLog:
+            post_delete.connect(workshop_row_deleted, sender=model, dispatch_uid=f"workshop_{model._meta.model_name}_tombstone")
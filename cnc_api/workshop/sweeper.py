@@ -0,0 +1,114 @@
+"""
+Maintenance sweeper: sends the due idle machines to maintenance
+(services.check_need_maintenance_all_machines) on a schedule instead of
+on every request. Due dates only move at midnight and usage only on
+completions (which check their own machine), so a sweep every
+WORKSHOP_MAINTENANCE_SWEEP_SECONDS plus one as soon as the day changes
+is enough. Starting a task checks the machine it is about to take,
+so a machine that became due between sweeps never takes a task.
+Each sweep also purges the old sync tombstones.
+
+Modes (WORKSHOP_MAINTENANCE_SWEEPER):
+- "thread": a thread of the API process, started by the first task start.
+- "external" (default): the "run_maintenance_sweeper" command, one for
+  the whole deployment.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .sync import purge_tombstones
+
+logger = logging.getLogger(__name__)
+
+
+def get_mode():
+    return getattr(settings, "WORKSHOP_MAINTENANCE_SWEEPER", "external")
+
+
+def seconds_to_midnight(now):
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=now.tzinfo)
+    return (tomorrow - now).total_seconds()
+
+
+class MaintenanceSweeper:
+    """Sweeps when the interval has passed or the day has changed."""
+
+    def __init__(self, interval_seconds=None):
+        self.interval_seconds = interval_seconds or getattr(settings, "WORKSHOP_MAINTENANCE_SWEEP_SECONDS", 3600)
+        # Day and monotonic() of the last sweep
+        self.swept_on = self.swept_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_due(self):
+        return (
+            self.swept_at is None
+            or self.swept_on != timezone.now().date()
+            or time.monotonic() - self.swept_at >= self.interval_seconds
+        )
+
+    def sweep(self):
+        """One sweep. Returns (machines sent to maintenance, tombstones purged)."""
+        # services starts the sweeper, so it can't be imported at the top
+        from .services import check_need_maintenance_all_machines
+
+        machines = check_need_maintenance_all_machines()
+        purged = purge_tombstones()
+        self.swept_on = timezone.now().date()
+        self.swept_at = time.monotonic()
+        if machines or purged:
+            logger.info("Maintenance sweep: %s machines to maintenance, %s tombstones purged.", len(machines), purged)
+        return machines, purged
+
+    def seconds_to_next_sweep(self):
+        """Until the interval is over or the day changes, whatever comes first."""
+        if self.swept_at is None:
+            return 0.0
+        left = self.interval_seconds - (time.monotonic() - self.swept_at)
+        # A second after midnight, so the new day is seen
+        return max(0.0, min(left, seconds_to_midnight(timezone.now()) + 1))
+
+    def run(self):
+        """Loop of the thread/process until stop()."""
+        while not self._stop.is_set():
+            if self.is_due():
+                try:
+                    self.sweep()
+                except Exception:
+                    logger.exception("Maintenance sweep failed.")
+                    # Try again at the next interval
+                    self.swept_at = time.monotonic()
+                finally:
+                    close_old_connections()
+            self._stop.wait(self.seconds_to_next_sweep())
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="workshop-maintenance-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def start_sweeper():
+    """Starts the sweeper thread of this process once (only in "thread" mode)."""
+    global _sweeper
+    if get_mode() != "thread" or _sweeper is not None:
+        return _sweeper
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = MaintenanceSweeper()
+            _sweeper.start()
+    return _sweeper
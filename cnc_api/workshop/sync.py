@@ -0,0 +1,152 @@
+"""
+Delta sync for shop floor clients.
+A sync token is an opaque encoding of the server time of the previous sync.
+Changed rows are found with the indexed updated_at column and deleted
+rows with the DeletedRecord tombstones.
+Answers are paged: at most WORKSHOP_SYNC_PAGE_SIZE rows of each resource,
+in (updated_at, id) order. While there is more, the answer carries a
+"next" cursor (GET again with ?cursor=) and no token; the last page
+carries the token of the next sync. Rows changed while paging are left
+for the next sync (the pages only show rows changed before the first one).
+"""
+import base64
+import json
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import DeletedRecord, Machine, Order, Task
+from .serializers import MachineSyncSerializer, OrderSyncSerializer, TaskSyncSerializer
+
+# Name in the response -> (model, serializer, tombstone resource, prefetched relations)
+SYNCED = {
+    "orders": (Order, OrderSyncSerializer, "order", ()),
+    "machines": (Machine, MachineSyncSerializer, "machine", ()),
+    "tasks": (Task, TaskSyncSerializer, "task", ("predecessors",)),
+}
+DEFAULT_PAGE_SIZE = 1000
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class ExpiredToken(Exception):
+    pass
+
+
+def encode_token(moment):
+    microseconds = int(moment.timestamp() * 1_000_000)
+    return base64.urlsafe_b64encode(str(microseconds).encode()).decode().rstrip("=")
+
+
+def decode_token(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        microseconds = int(base64.urlsafe_b64decode(padded.encode()).decode())
+        return datetime.fromtimestamp(microseconds / 1_000_000, tz=dt_timezone.utc)
+    except (ValueError, UnicodeDecodeError, OverflowError):
+        raise InvalidToken("Invalid sync token.")
+
+
+def encode_cursor(since, now, after):
+    """
+    Cursor of the next page: the window of the sync (since, now) and,
+    per resource, the (updated_at, id) of the last row sent (None when done).
+    """
+    state = {
+        "since": encode_token(since) if since else None,
+        "now": encode_token(now),
+        "after": {
+            name: [encode_token(position[0]), str(position[1])] if position else None
+            for name, position in after.items()
+        },
+    }
+    return base64.urlsafe_b64encode(json.dumps(state).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        state = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        since = decode_token(state["since"]) if state["since"] else None
+        after = {
+            name: (decode_token(state["after"][name][0]), state["after"][name][1]) if state["after"][name] else None
+            for name in SYNCED
+        }
+        return since, decode_token(state["now"]), after
+    except (ValueError, UnicodeDecodeError, KeyError, TypeError, IndexError):
+        raise InvalidToken("Invalid sync cursor.")
+
+
+def collect_changes(token=None, cursor=None):
+    """
+    One page of the rows changed and deleted since the token (everything
+    if there is none), and the cursor of the next page or, on the last
+    one, the token for the next sync.
+    Changes are looked up a few seconds before the token so rows written
+    by transactions that committed late are not missed. Clients apply
+    them by id, so getting a row twice is harmless.
+    """
+    page_size = getattr(settings, "WORKSHOP_SYNC_PAGE_SIZE", DEFAULT_PAGE_SIZE)
+    if cursor:
+        since, now, after = decode_cursor(cursor)
+    else:
+        now = timezone.now()
+        since = None
+        if token:
+            since = decode_token(token)
+            retention = timedelta(days=getattr(settings, "WORKSHOP_SYNC_TOMBSTONE_DAYS", 30))
+            if since < now - retention:
+                raise ExpiredToken("Sync token too old, reload everything.")
+            since -= timedelta(seconds=getattr(settings, "WORKSHOP_SYNC_OVERLAP_SECONDS", 5))
+        # Nothing sent yet
+        after = {name: (None, None) for name in SYNCED}
+
+    data = {"token": None, "next": None, "full": since is None, "deleted": {}}
+    next_after = {}
+    for name, (model, serializer_class, resource, prefetched) in SYNCED.items():
+        position = after[name]
+        if position is None:
+            # Sent on a previous page
+            data[name] = []
+            next_after[name] = None
+            continue
+        rows = model.objects.prefetch_related(*prefetched).filter(updated_at__lt=now)
+        if since:
+            rows = rows.filter(updated_at__gte=since)
+        updated_at, pk = position
+        if updated_at is not None:
+            rows = rows.filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, pk__gt=pk))
+        page = list(rows.order_by("updated_at", "pk")[:page_size + 1])
+        more = len(page) > page_size
+        page = page[:page_size]
+        data[name] = serializer_class(page, many=True).data
+        next_after[name] = (page[-1].updated_at, page[-1].pk) if more else None
+
+        # The tombstones come with the first page
+        deleted = []
+        if since and not cursor:
+            deleted = [
+                str(object_id)
+                for object_id in DeletedRecord.objects
+                .filter(resource=resource, deleted_at__gte=since)
+                .values_list("object_id", flat=True)
+            ]
+        data["deleted"][name] = deleted
+
+    if any(next_after.values()):
+        data["next"] = encode_cursor(since, now, next_after)
+    else:
+        data["token"] = encode_token(now)
+    return data
+
+
+def purge_tombstones():
+    """Deletes the tombstones older than the retention. Returns how many."""
+    retention = timedelta(days=getattr(settings, "WORKSHOP_SYNC_TOMBSTONE_DAYS", 30))
+    deleted, _ = DeletedRecord.objects.filter(deleted_at__lt=timezone.now() - retention).delete()
+    return deleted
@@ -7,10 +7,17 @@ import json
 import pytest
 from django.contrib.auth.models import User, Group
 from rest_framework.test import APIClient
-from datetime import timedelta
+from datetime import date, timedelta
 from django.utils import timezone
 
-from cnc_api.workshop.models import Order, Machine, Task, ActivityLog
+from cnc_api.workshop.models import Order, Machine, Task, ActivityLog, DurationStat
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Cached data (roles, metrics gauges...) must not leak between tests."""
+    from django.core.cache import cache
+    cache.clear()
 
 # TEST ORDER
 @pytest.mark.django_db
@@ -468,7 +475,7 @@ def test_export_activitylogs_json():
     
     assert response.status_code == 200
     assert response["Content-Disposition"].startswith("attachment;")
-    data = json.loads(response.content)
+    data = json.loads(b"".join(response.streaming_content))
     assert isinstance(data, list)
 
 @pytest.mark.django_db
@@ -491,8 +498,1420 @@ def test_export_activitylogs_csv():
     assert response["Content-Disposition"].startswith("attachment;")
     
     # Check CSV content
-    content = response.content.decode("utf-8")
+    content = b"".join(response.streaming_content).decode("utf-8")
     reader = csv.reader(io.StringIO(content))
     rows = list(reader)
     assert rows[0] == ['log_id', 'log_type', 'message', 'time', 'task_id', 'user_id', 'username']
-    assert any("Export log CSV" in row for row in rows)
\ No newline at end of file
+    assert any("Export log CSV" in row for row in rows)
+
+# TEST METRICS
+@pytest.mark.django_db
+def test_metrics_endpoint_counts_task_starts():
+    """
+    Start a task and a task that cannot get a machine.
+    Assert /metrics shows the counters, the latency histogram and the gauges.
+    """
+    from django.core.cache import cache
+    from cnc_api.workshop import metrics
+
+    cache.delete(metrics.GAUGES_CACHE_KEY)
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    Machine.objects.create(name="Machine Metrics", machine_type="lathe", status="idle", location="M")
+    order = Order.objects.create(name="Order Metrics")
+    task1 = Task.objects.create(order=order, queue_number=1, required_machine_type="lathe", status="pending")
+    task2 = Task.objects.create(order=order, queue_number=2, required_machine_type="grinder", status="pending")
+    started = metrics.TASKS_STARTED.value(machine_type="lathe")
+    failures = metrics.ASSIGNMENT_FAILURES.value(machine_type="grinder")
+
+    client.put(f"/api/tasks/{task1.task_id}/start/")
+    client.put(f"/api/tasks/{task2.task_id}/start/")
+
+    assert metrics.TASKS_STARTED.value(machine_type="lathe") == started + 1
+    assert metrics.ASSIGNMENT_FAILURES.value(machine_type="grinder") == failures + 1
+
+    response = client.get("/metrics")
+    body = response.content.decode("utf-8")
+    assert response.status_code == 200
+    assert 'workshop_request_duration_seconds_count{viewset="task",action="start",method="PUT"}' in body
+    assert 'workshop_machines{status="running",machine_type="lathe"} 1' in body
+    assert 'workshop_pending_tasks{machine_type="grinder"} 1' in body
+
+
+@pytest.mark.django_db
+def test_metrics_need_an_allowed_address_or_the_token(settings):
+    """
+    Scrape /metrics from an address that isn't allowed.
+    Assert 403 without the token or with a wrong one, 200 with the token.
+    """
+    settings.WORKSHOP_METRICS_ALLOWED_IPS = ("10.0.0.5",)
+    settings.WORKSHOP_METRICS_TOKEN = "scrape-secret"
+    client = APIClient()
+
+    assert client.get("/metrics").status_code == 403
+    assert client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code == 403
+    assert client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-secret").status_code == 200
+    assert client.get("/metrics", REMOTE_ADDR="10.0.0.5").status_code == 200
+
+    # No token configured: only the allowed addresses
+    settings.WORKSHOP_METRICS_TOKEN = None
+    assert client.get("/metrics", HTTP_AUTHORIZATION="Bearer ").status_code == 403
+
+
+# TEST PROFILING
+@pytest.mark.django_db
+def test_admin_can_profile_a_request(settings, tmp_path):
+    """
+    An admin asks for a profile with the header.
+    Assert the profile files are stored and can be downloaded.
+    """
+    settings.WORKSHOP_PROFILING_DIR = tmp_path
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+    Order.objects.create(name="Order Profiled")
+
+    response = client.get("/api/orders/", HTTP_X_PROFILE="cprofile")
+    profile_id = response["X-Profile-Id"]
+
+    assert response.status_code == 200
+    assert (tmp_path / f"{profile_id}.prof").exists()
+    summary = json.loads((tmp_path / f"{profile_id}.json").read_text())
+    assert summary["queries"] >= 1
+
+    download = client.get(f"/api/profiles/{profile_id}.json/")
+    assert download.status_code == 200
+
+@pytest.mark.django_db
+def test_operator_cannot_profile_a_request(settings, tmp_path):
+    settings.WORKSHOP_PROFILING_DIR = tmp_path
+    operator = User.objects.create_user(username="op1", password="operator123")
+    client = APIClient()
+    client.force_authenticate(user=operator)
+
+    response = client.get("/api/orders/?profile=1")
+
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response
+    assert client.get("/api/profiles/").status_code == 403
+
+
+# TEST SEED DATA
+@pytest.mark.django_db
+def test_seed_workshop_is_reproducible():
+    """
+    Seed a small workshop twice with the same seed.
+    Assert the sizes and that the generated rows are the same.
+    """
+    from django.core.management import call_command
+
+    reference_date = date(2025, 6, 1)
+    options = {
+        "machines": 8, "orders": 30, "logs": 200, "seed": 3,
+        "reference_date": reference_date, "stdout": io.StringIO(),
+    }
+    call_command("seed_workshop", **options)
+    first_tasks = set(Task.objects.values_list("task_id", "status", "machine_id"))
+    first_machines = set(Machine.objects.values_list("machine_id", "last_maintenance", "maintenance_due_date"))
+    # No machine is due at the reference date
+    assert all(last <= reference_date < due for _, last, due in first_machines)
+
+    assert Machine.objects.count() == 8
+    assert Order.objects.count() == 30
+    assert ActivityLog.objects.count() == 200
+    # A running machine has exactly one task in progress
+    assert Machine.objects.filter(status="running").count() == Task.objects.filter(status="in_progress").count()
+
+    call_command("seed_workshop", flush=True, **options)
+    assert set(Task.objects.values_list("task_id", "status", "machine_id")) == first_tasks
+    assert set(Machine.objects.values_list("machine_id", "last_maintenance", "maintenance_due_date")) == first_machines
+
+    # By default the schedule is relative to today: the fleet isn't due
+    call_command("seed_workshop", flush=True, machines=8, orders=30, logs=200, seed=3, stdout=io.StringIO())
+    assert not Machine.objects.filter(Machine.due_for_maintenance(timezone.now().date())).exists()
+
+
+@pytest.mark.django_db
+def test_bench_endpoints_skips_cases_without_rows():
+    """
+    Benchmark with no machine at all.
+    Assert the pass_maintenance case is skipped instead of calling /api/machines/None/.
+    """
+    from django.core.management import call_command
+
+    admin = User.objects.create_user(username="seed_admin", password="admin123")
+    admin.groups.add(Group.objects.create(name="admin"))
+    out = io.StringIO()
+    call_command(
+            "bench_endpoints", only=["machines-pass_maintenance", "machines-list"],
+            iterations=2, warmup=0, stdout=out
+    )
+
+    output = out.getvalue()
+    assert "machines-pass_maintenance" in output and "skipped" in output
+    # Read endpoints are measured cold and warm (from the response cache)
+    assert "warm p95" in output
+
+
+
+# TEST ROLES
+@pytest.mark.django_db
+def test_jwt_roles_claim_skips_group_queries():
+    """
+    Get a token as admin.
+    Assert it carries the roles and that the permission check makes no group query.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+
+    token_response = client.post("/api/token/", {"username": "admin", "password": "admin123"}, format="json")
+    assert token_response.status_code == 200
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {token_response.data['access']}")
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post("/api/orders/", {"name": "Order JWT"}, format="json")
+
+    assert response.status_code == 201
+    assert not any("auth_group" in query["sql"] for query in queries.captured_queries)
+
+    refreshed = client.post("/api/token/refresh/", {"refresh": token_response.data["refresh"]}, format="json")
+    assert refreshed.status_code == 200
+
+@pytest.mark.django_db
+def test_cached_roles_are_cleared_when_groups_change():
+    """
+    A session admin creates a machine, then leaves the "admin" group.
+    Assert the cached role is dropped and the next write is forbidden.
+    """
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_login(admin)
+    machine = {"name": "Machine Roles", "machine_type": "mill", "status": "idle", "location": "R"}
+
+    assert client.post("/api/machines/", machine, format="json").status_code == 201
+    admin.groups.remove(group)
+    assert client.post("/api/machines/", machine, format="json").status_code == 403
+
+@pytest.mark.django_db
+def test_stateless_jwt_user_skips_user_query(settings):
+    """
+    With the token-user mode on, a JWT request doesn't load the User row.
+    Assert the log created by the request still points to the user.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    settings.WORKSHOP_JWT_STATELESS_USER = True
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    Machine.objects.create(name="Machine Token", machine_type="lathe", status="idle", location="T")
+    order = Order.objects.create(name="Order Token")
+    task = Task.objects.create(order=order, queue_number=1, required_machine_type="lathe", status="pending")
+    client = APIClient()
+    token = client.post("/api/token/", {"username": "admin", "password": "admin123"}, format="json").data["access"]
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.put(f"/api/tasks/{task.task_id}/start/")
+
+    assert response.status_code == 200
+    assert not any('FROM "auth_user"' in query["sql"] for query in queries.captured_queries)
+    assert ActivityLog.objects.filter(task=task, user=admin).exists()
+
+
+# TEST RESPONSE CACHE
+@pytest.mark.django_db
+def test_machine_list_is_cached_and_start_is_visible_on_next_read():
+    """
+    Read the machines twice: the second read comes from the cache.
+    Start a task and assert the next read shows the machine "running".
+    """
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+    machine = Machine.objects.create(name="Machine Cached", machine_type="lathe", status="idle", location="C")
+    order = Order.objects.create(name="Order Cached")
+    task = Task.objects.create(order=order, queue_number=1, required_machine_type="lathe", status="pending")
+
+    assert client.get("/api/machines/")["X-Cache"] == "MISS"
+    assert client.get("/api/machines/")["X-Cache"] == "HIT"
+    # Query params are part of the key
+    assert client.get("/api/machines/?status=idle")["X-Cache"] == "MISS"
+
+    client.put(f"/api/tasks/{task.task_id}/start/")
+    response = client.get("/api/machines/")
+
+    assert response["X-Cache"] == "MISS"
+    assert response.data[0]["status"] == "running"
+    assert response.data[0]["tasks"][0]["task_id"] == str(task.task_id)
+
+
+@pytest.mark.django_db
+def test_response_cache_is_bypassed_with_a_per_process_cache_and_workers(settings):
+    """
+    A per-process cache (LocMemCache) while several workers may run:
+    assert nothing is cached and the system check warns about it.
+    """
+    from cnc_api.workshop.checks import response_cache_check
+
+    settings.WORKSHOP_SINGLE_PROCESS = False
+    client = APIClient()
+    client.force_authenticate(user=User.objects.create_user(username="operator", password="operator123"))
+    Machine.objects.create(name="Machine Uncached", machine_type="lathe")
+
+    assert "X-Cache" not in client.get("/api/machines/")
+    assert "X-Cache" not in client.get("/api/machines/")
+    assert [warning.id for warning in response_cache_check(None)] == ["workshop.W001"]
+
+    # A shared backend is coherent across the workers
+    settings.CACHES = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://cache"}}
+    assert response_cache_check(None) == []
+
+
+# TEST CONDITIONAL GET
+@pytest.mark.django_db
+def test_unchanged_order_list_returns_304():
+    """
+    Poll the orders with the ETag of the previous answer.
+    Assert 304 while nothing changes and 200 once a nested task changes.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    admin = User.objects.create_user(username="admin", password="admin123")
+    client = APIClient()
+    client.force_authenticate(user=admin)
+    order = Order.objects.create(name="Order ETag")
+    task = Task.objects.create(order=order, queue_number=1, required_machine_type="lathe", status="pending")
+
+    first = client.get("/api/orders/")
+    etag = first["ETag"]
+    assert first.status_code == 200
+    assert first.has_header("Last-Modified")
+
+    # One aggregate per relation, not a join of orders x tasks x logs
+    with CaptureQueriesContext(connection) as queries:
+        assert client.get("/api/orders/", HTTP_IF_NONE_MATCH=etag).status_code == 304
+    assert not [query for query in queries if "DISTINCT" in query["sql"]]
+
+    task.operation = "turning"
+    task.save()
+    second = client.get("/api/orders/", HTTP_IF_NONE_MATCH=etag)
+    assert second.status_code == 200
+    assert second["ETag"] != etag
+
+    # A detail only changes with its own rows
+    detail_etag = client.get(f"/api/orders/{order.pk}/")["ETag"]
+    other = Order.objects.create(name="Other order")
+    Task.objects.create(order=other, queue_number=1, required_machine_type="mill")
+    assert client.get(f"/api/orders/{order.pk}/", HTTP_IF_NONE_MATCH=detail_etag).status_code == 304
+
+@pytest.mark.django_db
+def test_unchanged_machine_detail_returns_304_with_if_modified_since():
+    admin = User.objects.create_user(username="admin", password="admin123")
+    client = APIClient()
+    client.force_authenticate(user=admin)
+    machine = Machine.objects.create(name="Machine ETag", machine_type="mill", status="idle", location="E")
+
+    first = client.get(f"/api/machines/{machine.machine_id}/")
+    response = client.get(
+            f"/api/machines/{machine.machine_id}/",
+            HTTP_IF_MODIFIED_SINCE=first["Last-Modified"]
+    )
+
+    assert response.status_code == 304
+    assert client.get("/api/machines/00000000-0000-0000-0000-000000000000/").status_code == 404
+
+
+# TEST SYNC
+@pytest.mark.django_db
+def test_sync_returns_only_changes_and_tombstones():
+    """
+    Do a full sync, change a task and delete another order.
+    Assert the next sync only returns the changed task and the deletions.
+    """
+    operator = User.objects.create_user(username="op1", password="operator123")
+    client = APIClient()
+    client.force_authenticate(user=operator)
+    order = Order.objects.create(name="Order Sync")
+    task = Task.objects.create(order=order, queue_number=1, required_machine_type="lathe", status="pending")
+    old_order = Order.objects.create(name="Order Sync Old")
+    old_task = Task.objects.create(order=old_order, queue_number=1, required_machine_type="mill", status="pending")
+    Machine.objects.create(name="Machine Sync", machine_type="lathe", status="idle", location="S")
+
+    full = client.get("/api/sync/")
+    assert full.status_code == 200
+    assert full.data["full"]
+    assert len(full.data["orders"]) == 2
+
+    # Move the stamps of the untouched rows before the token (outside the overlap window)
+    past = timezone.now() - timedelta(minutes=10)
+    Order.objects.update(updated_at=past)
+    Machine.objects.update(updated_at=past)
+    Task.objects.update(updated_at=past)
+    task.operation = "turning"
+    task.save()
+    old_order_id = str(old_order.order_id)
+    old_order.delete()
+
+    delta = client.get("/api/sync/", {"since": full.data["token"]})
+
+    assert delta.status_code == 200
+    assert [t["task_id"] for t in delta.data["tasks"]] == [str(task.task_id)]
+    assert delta.data["orders"] == []
+    assert delta.data["machines"] == []
+    assert delta.data["deleted"]["orders"] == [old_order_id]
+    assert delta.data["deleted"]["tasks"] == [str(old_task.task_id)]
+    assert client.get("/api/sync/", {"since": "not-a-token"}).status_code == 400
+
+
+@pytest.mark.django_db
+def test_sync_is_paged_with_a_cursor(settings):
+    """
+    Do a full sync of five orders with two rows per page.
+    Assert every order comes once and only the last page has the token.
+    """
+    settings.WORKSHOP_SYNC_PAGE_SIZE = 2
+    operator = User.objects.create_user(username="op1", password="operator123")
+    client = APIClient()
+    client.force_authenticate(user=operator)
+    orders = [Order.objects.create(name=f"Order Page {n}") for n in range(5)]
+    Machine.objects.create(name="Machine Page", machine_type="lathe", status="idle", location="S")
+
+    seen, pages = [], 0
+    response = client.get("/api/sync/")
+    while True:
+        assert response.status_code == 200
+        pages += 1
+        seen += [o["order_id"] for o in response.data["orders"]]
+        if not response.data["next"]:
+            break
+        assert response.data["token"] is None
+        response = client.get("/api/sync/", {"cursor": response.data["next"]})
+
+    assert pages == 3
+    assert sorted(seen) == sorted(str(o.order_id) for o in orders)
+    assert response.data["token"]
+    assert client.get("/api/sync/", {"cursor": "not-a-cursor"}).status_code == 400
+
+
+# TEST SPARSE FIELDS
+@pytest.mark.django_db
+def test_machine_list_with_sparse_fields():
+    """
+    Ask for two fields of the machines.
+    Assert only those come back and the nested tasks are not queried.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    operator = User.objects.create_user(username="op1", password="operator123")
+    client = APIClient()
+    client.force_authenticate(user=operator)
+    machine = Machine.objects.create(name="Machine Sparse", machine_type="lathe", status="idle", location="F")
+    order = Order.objects.create(name="Order Sparse")
+    Task.objects.create(order=order, machine=machine, queue_number=1, required_machine_type="lathe")
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get("/api/machines/", {"fields": "machine_id,status"})
+
+    assert response.status_code == 200
+    assert response.data == [{"machine_id": str(machine.machine_id), "status": "idle"}]
+    assert not any("workshop_task" in query["sql"] for query in queries.captured_queries)
+    machine_query = next(q["sql"] for q in queries.captured_queries if 'FROM "workshop_machine"' in q["sql"] and "MAX" not in q["sql"])
+    assert '"description"' not in machine_query
+
+    omitted = client.get("/api/orders/", {"omit": "tasks,description"})
+    assert "tasks" not in omitted.data[0]
+    assert "description" not in omitted.data[0]
+    assert "name" in omitted.data[0]
+
+
+# TEST MESSAGEPACK
+@pytest.mark.django_db
+def test_messagepack_read_write_and_export(monkeypatch):
+    """
+    Create an order sending MessagePack and read it back as MessagePack.
+    Assert the JSON export can be downloaded as MessagePack too, streamed in batches.
+    """
+    import msgpack
+
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    created = client.post(
+            "/api/orders/",
+            msgpack.packb({"name": "Order Msgpack"}),
+            content_type="application/msgpack",
+            HTTP_ACCEPT="application/msgpack"
+    )
+    assert created.status_code == 201
+    assert created["Content-Type"] == "application/msgpack"
+    order = msgpack.unpackb(created.content)
+
+    listed = client.get("/api/orders/", HTTP_ACCEPT="application/msgpack")
+    assert [o["order_id"] for o in msgpack.unpackb(listed.content)] == [order["order_id"]]
+
+    task = Task.objects.create(order_id=order["order_id"], queue_number=1, required_machine_type="lathe")
+    for number in range(5):
+        ActivityLog.objects.create(task=task, log_type="info", message=f"Msgpack log {number}")
+    # Stream it in several batches
+    monkeypatch.setattr("cnc_api.workshop.views.EXPORT_BATCH_SIZE", 2)
+    export = client.get("/api/activitylogs/export/json/", HTTP_ACCEPT="application/msgpack")
+    assert export.status_code == 200
+    assert export.streaming
+    rows = msgpack.unpackb(b"".join(export.streaming_content))
+    assert sorted(row["message"] for row in rows) == [f"Msgpack log {number}" for number in range(5)]
+
+
+# TEST COMPRESSION
+@pytest.mark.django_db
+def test_compressed_streamed_export_and_small_responses():
+    """
+    Download the CSV export with gzip and assert it decompresses to the CSV.
+    Assert small responses are not compressed.
+    """
+    import gzip
+
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    order = Order.objects.create(name="Order Compression")
+    task = Task.objects.create(order=order, queue_number=1, required_machine_type="lathe")
+    for number in range(200):
+        ActivityLog.objects.create(task=task, log_type="info", message=f"Compressed log {number}", user=admin)
+
+    response = client.get("/api/activitylogs/export/csv/", HTTP_ACCEPT_ENCODING="gzip")
+    assert response["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response["Vary"]
+    rows = list(csv.reader(io.StringIO(gzip.decompress(b"".join(response.streaming_content)).decode("utf-8"))))
+    assert len(rows) == 201
+    assert rows[1][6] == "admin"
+
+    small = client.get(f"/api/orders/{order.order_id}/?fields=name", HTTP_ACCEPT_ENCODING="gzip")
+    assert small.status_code == 200
+    assert not small.has_header("Content-Encoding")
+
+
+@pytest.mark.django_db
+def test_compression_negotiation_and_weak_etag():
+    """
+    Assert the preferred encoding is picked, q=0 is refused,
+    and the weak ETag of a compressed list still gives a 304.
+    """
+    from cnc_api.workshop.compression import ENCODERS, choose_encoding
+
+    assert choose_encoding("gzip;q=0.5, identity") == "gzip"
+    assert choose_encoding("gzip;q=0") is None
+    assert choose_encoding("") is None
+    if "br" in ENCODERS:
+        assert choose_encoding("gzip, br") == "br"
+        assert choose_encoding("gzip, br;q=0.5") == "gzip"
+
+    user = User.objects.create_user(username="operator", password="operator123")
+    client = APIClient()
+    client.force_authenticate(user=user)
+    for number in range(30):
+        Machine.objects.create(name=f"Compressed machine {number}", machine_type="lathe", status="idle")
+
+    response = client.get("/api/machines/", HTTP_ACCEPT_ENCODING="gzip")
+    assert response["Content-Encoding"] == "gzip"
+    assert response["ETag"].startswith('W/"')
+    again = client.get("/api/machines/", HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=response["ETag"])
+    assert again.status_code == 304
+    assert again["ETag"] == response["ETag"]
+
+
+# TEST PRECOMPUTED SCHEMA
+@pytest.mark.django_db
+def test_schema_is_generated_once_and_served_with_etag(monkeypatch, settings, tmp_path):
+    """
+    Without built files, the schema is generated on the first hit only.
+    Assert an unchanged ETag gets a 304 and the UI page still renders.
+    """
+    from cnc_api.workshop import schema
+
+    settings.WORKSHOP_SCHEMA_DIR = tmp_path
+    schema.clear_documents()
+    calls = []
+    render_schema = schema.render_schema
+    monkeypatch.setattr(schema, "render_schema", lambda: calls.append(1) or render_schema())
+    client = APIClient()
+
+    response = client.get("/swagger/?format=openapi")
+    assert response.status_code == 200
+    assert "/orders/" in json.loads(response.content)["paths"]
+    yaml_response = client.get("/swagger.yaml")
+    assert yaml_response.status_code == 200
+    assert b"/orders/:" in yaml_response.content
+    assert client.get("/swagger/?format=openapi", HTTP_IF_NONE_MATCH=response["ETag"]).status_code == 304
+    assert client.get("/redoc/").status_code == 200
+    assert len(calls) == 1
+    schema.clear_documents()
+
+
+@pytest.mark.django_db
+def test_build_schema_command_files_are_served(settings, tmp_path):
+    """
+    Write the schema with the command and assert the files are what gets served.
+    """
+    from django.core.management import call_command
+    from cnc_api.workshop import schema
+
+    settings.WORKSHOP_SCHEMA_DIR = tmp_path
+    schema.clear_documents()
+    call_command("build_schema", stdout=io.StringIO())
+    (tmp_path / "openapi.json").write_text('{"swagger": "2.0", "paths": {}}')
+
+    response = APIClient().get("/swagger.json")
+    assert json.loads(response.content) == {"swagger": "2.0", "paths": {}}
+    assert (tmp_path / "openapi.yaml").read_bytes().startswith(b"swagger:")
+    schema.clear_documents()
+
+
+# TEST RATE LIMITS
+@pytest.mark.django_db
+def test_export_token_bucket_per_user(settings):
+    """
+    Exhaust the export budget of a user and assert the 429 has a Retry-After.
+    Assert reads and other users keep their own buckets.
+    """
+    settings.WORKSHOP_THROTTLE_RATES = {"export": "2/min", "write": "600/min", "read": "3000/min"}
+    user = User.objects.create_user(username="operator", password="operator123")
+    other = User.objects.create_user(username="operator2", password="operator123")
+    client = APIClient()
+    client.force_authenticate(user=user)
+
+    assert client.get("/api/activitylogs/export/csv/").status_code == 200
+    assert client.get("/api/activitylogs/export/csv/").status_code == 200
+    throttled = client.get("/api/activitylogs/export/csv/")
+    assert throttled.status_code == 429
+    # 1 token every 30 seconds
+    assert 0 < int(throttled["Retry-After"]) <= 30
+
+    # Same user, another endpoint; and another user on the same endpoint
+    assert client.get("/api/activitylogs/export/json/").status_code == 200
+    assert client.get("/api/activitylogs/").status_code == 200
+    client.force_authenticate(user=other)
+    assert client.get("/api/activitylogs/export/csv/").status_code == 200
+
+
+def test_token_bucket_refills(monkeypatch):
+    """
+    Assert an empty bucket gets its tokens back with time, up to the capacity.
+    """
+    from types import SimpleNamespace
+    from django.test import override_settings
+    from cnc_api.workshop import throttling
+
+    now = [1000.0]
+    monkeypatch.setattr(throttling.time, "time", lambda: now[0])
+    request = SimpleNamespace(method="POST", user=SimpleNamespace(pk=7, is_authenticated=True))
+    view = SimpleNamespace(basename="task", action="start")
+    throttle = throttling.TokenBucketThrottle()
+
+    with override_settings(WORKSHOP_THROTTLE_RATES={"write": "3/min"}):
+        assert [throttle.allow_request(request, view) for _ in range(4)] == [True, True, True, False]
+        assert throttle.wait() == pytest.approx(20)
+        now[0] += 20
+        assert throttle.allow_request(request, view)
+        assert not throttle.allow_request(request, view)
+        now[0] += 3600
+        assert [throttle.allow_request(request, view) for _ in range(4)] == [True, True, True, False]
+
+
+# TEST DISPATCH QUEUE
+@pytest.mark.django_db
+def test_freed_machine_takes_queued_task_of_another_order():
+    """
+    Two orders wait for the only lathe.
+    Assert completing the running task starts the oldest queued task,
+    even if it belongs to another order, and starts that order.
+    """
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    lathe = Machine.objects.create(name="Only lathe", machine_type="lathe", status="idle")
+    running_order = Order.objects.create(name="Running order")
+    running = Task.objects.create(order=running_order, queue_number=1, required_machine_type="lathe")
+    assert client.put(f"/api/tasks/{running.task_id}/start/").status_code == 200
+
+    first_order = Order.objects.create(name="First waiting order")
+    second_order = Order.objects.create(name="Second waiting order")
+    first = Task.objects.create(order=first_order, queue_number=1, required_machine_type="lathe")
+    second = Task.objects.create(order=second_order, queue_number=1, required_machine_type="lathe")
+    # No lathe free: both stay pending, in the queue
+    assert client.put(f"/api/orders/{first_order.order_id}/start/").status_code == 400
+    assert client.put(f"/api/tasks/{second.task_id}/start/").status_code == 400
+    first.refresh_from_db()
+    assert first.status == "pending" and first.queued_at is not None
+
+    response = client.put(f"/api/tasks/{running.task_id}/complete/")
+    assert response.status_code == 200
+
+    first.refresh_from_db()
+    second.refresh_from_db()
+    first_order.refresh_from_db()
+    lathe.refresh_from_db()
+    assert first.status == "in_progress" and first.machine == lathe and first.queued_at is None
+    assert first_order.status == "in_progress"
+    assert second.status == "pending" and second.queued_at is not None
+    assert lathe.status == "running"
+
+
+@pytest.mark.django_db
+def test_machine_passing_maintenance_takes_queued_task():
+    """
+    Assert a machine back from maintenance starts the queued task right away.
+    """
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    mill = Machine.objects.create(name="Mill in maintenance", machine_type="mill", status="maintenance")
+    order = Order.objects.create(name="Order waiting for a mill")
+    task = Task.objects.create(order=order, queue_number=1, required_machine_type="mill")
+    assert client.put(f"/api/tasks/{task.task_id}/start/").status_code == 400
+
+    assert client.put(f"/api/machines/{mill.machine_id}/pass_maintenance/").status_code == 200
+    task.refresh_from_db()
+    mill.refresh_from_db()
+    assert task.status == "in_progress" and task.machine == mill
+    assert mill.status == "running"
+    assert ActivityLog.objects.filter(task=task, message__contains="dispatch queue").exists()
+
+
+# TEST PRIORITIES AND DUE DATES
+@pytest.mark.django_db
+def test_dispatch_follows_priority_then_due_date():
+    """
+    Queue three tasks and assert the backlog and the dispatcher take
+    the urgent one first, then the earliest due date.
+    """
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    today = timezone.now().date()
+    late = Order.objects.create(name="Normal late", priority=1, due_date=today + timedelta(days=9))
+    soon = Order.objects.create(name="Normal soon", priority=1, due_date=today + timedelta(days=2))
+    urgent = Order.objects.create(name="Urgent", priority=3)
+    tasks = {}
+    for order in (late, soon, urgent):
+        tasks[order.name] = Task.objects.create(order=order, queue_number=1, required_machine_type="grinder")
+        assert client.put(f"/api/tasks/{tasks[order.name].task_id}/start/").status_code == 400
+    # Inherited from the order
+    assert tasks["Urgent"].priority == 3
+    assert tasks["Normal soon"].due_date == today + timedelta(days=2)
+
+    backlog = client.get("/api/tasks/backlog/?machine_type=grinder").json()
+    assert [task["order_name"] for task in backlog["grinder"]] == ["Urgent", "Normal soon", "Normal late"]
+    assert list(backlog) == ["grinder"]
+
+    grinder = Machine.objects.create(name="Grinder", machine_type="grinder", status="maintenance")
+    client.put(f"/api/machines/{grinder.machine_id}/pass_maintenance/")
+    tasks["Urgent"].refresh_from_db()
+    assert tasks["Urgent"].status == "in_progress"
+
+
+@pytest.mark.django_db
+def test_order_priority_change_moves_its_tasks():
+    """
+    Assert changing the priority of an order moves its queued task
+    to the front of the backlog.
+    """
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    first = Order.objects.create(name="First")
+    second = Order.objects.create(name="Second")
+    for order in (first, second):
+        task = Task.objects.create(order=order, queue_number=1, required_machine_type="mill")
+        client.put(f"/api/tasks/{task.task_id}/start/")
+    assert [t["order_name"] for t in client.get("/api/tasks/backlog/").json()["mill"]] == ["First", "Second"]
+
+    response = client.patch(f"/api/orders/{second.order_id}/", {"priority": 2}, format="json")
+    assert response.status_code == 200
+    backlog = client.get("/api/tasks/backlog/").json()
+    assert [t["order_name"] for t in backlog["mill"]] == ["Second", "First"]
+    assert backlog["mill"][0]["priority"] == 2
+    assert backlog["lathe"] == []
+
+
+# TEST TASK DEPENDENCIES
+@pytest.mark.django_db
+def test_independent_tasks_run_in_parallel_and_join():
+    """
+    Milling and grinding don't depend on each other, turning needs both.
+    Assert both start with the order and turning starts after the last one.
+    Assert the critical path goes through the longest branch.
+    """
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    for machine_type in ("mill", "grinder", "lathe"):
+        Machine.objects.create(name=f"DAG {machine_type}", machine_type=machine_type, status="idle")
+    order = Order.objects.create(name="Order DAG")
+    milling = Task.objects.create(
+            order=order, queue_number=1, required_machine_type="mill",
+            estimated_duration=timedelta(minutes=30)
+    )
+    grinding = Task.objects.create(
+            order=order, queue_number=2, required_machine_type="grinder",
+            estimated_duration=timedelta(minutes=60)
+    )
+    response = client.post(
+            "/api/tasks/",
+            {
+                "order": str(order.order_id), "queue_number": 3, "required_machine_type": "lathe",
+                "operation": "turning", "estimated_duration": "00:20:00",
+                "predecessors": [str(milling.task_id), str(grinding.task_id)],
+            },
+            format="json"
+    )
+    assert response.status_code == 201
+    turning = Task.objects.get(task_id=response.data["task_id"])
+
+    path = client.get(f"/api/orders/{order.order_id}/critical_path/").json()
+    assert path["makespan_minutes"] == 80
+    assert path["critical_path"] == [str(grinding.task_id), str(turning.task_id)]
+    assert path["tasks"][str(milling.task_id)]["slack_minutes"] == 30
+
+    assert client.put(f"/api/orders/{order.order_id}/start/").status_code == 200
+    milling.refresh_from_db()
+    grinding.refresh_from_db()
+    assert milling.status == "in_progress" and grinding.status == "in_progress"
+
+    client.put(f"/api/tasks/{milling.task_id}/complete/")
+    turning.refresh_from_db()
+    assert turning.status == "pending"
+    # Can't be started by hand either while grinding runs
+    assert client.put(f"/api/tasks/{turning.task_id}/start/").status_code == 400
+
+    client.put(f"/api/tasks/{grinding.task_id}/complete/")
+    turning.refresh_from_db()
+    assert turning.status == "in_progress"
+    response = client.put(f"/api/tasks/{turning.task_id}/complete/")
+    order.refresh_from_db()
+    assert order.status == "completed"
+
+
+@pytest.mark.django_db
+def test_predecessors_must_be_same_order_and_acyclic():
+    """
+    Assert cycles and predecessors from other orders are refused.
+    """
+    admin = User.objects.create_user(username="admin", password="admin123")
+    group = Group.objects.create(name="admin")
+    admin.groups.add(group)
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    order = Order.objects.create(name="Order cycle")
+    first = Task.objects.create(order=order, queue_number=1, required_machine_type="mill")
+    second = Task.objects.create(order=order, queue_number=2, required_machine_type="mill")
+    second.predecessors.add(first)
+    other = Task.objects.create(order=Order.objects.create(name="Other"), queue_number=1)
+
+    response = client.patch(
+            f"/api/tasks/{first.task_id}/", {"predecessors": [str(second.task_id)]}, format="json"
+    )
+    assert response.status_code == 400
+    assert "cycle" in str(response.data["predecessors"])
+    response = client.patch(
+            f"/api/tasks/{first.task_id}/", {"predecessors": [str(other.task_id)]}, format="json"
+    )
+    assert response.status_code == 400
+    assert first.predecessors.count() == 0
+
+
+# TEST IN-MEMORY DISPATCHER
+@pytest.mark.django_db
+def test_dispatcher_assigns_by_priority_in_one_batch():
+    """
+    Two idle lathes and three queued tasks: assert one pass starts the two
+    most urgent ones and the state agrees with the DB afterwards.
+    Assert a change made behind its back shows in the consistency check.
+    """
+    from cnc_api.workshop.dispatcher import Dispatcher, check_consistency
+
+    lathes = [Machine.objects.create(name=f"Lathe {n}", machine_type="lathe", status="idle") for n in range(2)]
+    tasks = {}
+    for name, priority in (("low", 0), ("urgent", 3), ("high", 2)):
+        order = Order.objects.create(name=name, priority=priority)
+        tasks[name] = Task.objects.create(
+                order=order, queue_number=1, required_machine_type="lathe", queued_at=timezone.now()
+        )
+
+    dispatcher = Dispatcher()
+    applied = dispatcher.run_once()
+    assert {task_id for task_id, _ in applied} == {tasks["urgent"].pk, tasks["high"].pk}
+    for task in tasks.values():
+        task.refresh_from_db()
+    assert tasks["urgent"].status == "in_progress" and tasks["urgent"].order.status == "in_progress"
+    assert tasks["low"].status == "pending" and tasks["low"].queued_at is not None
+    assert not any(check_consistency(dispatcher.state).values())
+    assert Machine.objects.filter(status="running").count() == 2
+
+    # A lathe freed by hand (not through the services)
+    Machine.objects.filter(pk=lathes[0].pk).update(status="idle")
+    assert check_consistency(dispatcher.state)["idle_missing"] == [str(lathes[0].pk)]
+
+
+@pytest.mark.django_db
+def test_dispatcher_reloads_only_the_rejected_rows():
+    """
+    Take the only idle lathe by hand after the state is loaded and queue
+    another task without telling the dispatcher.
+    Assert the decision is rejected and only its task and machine are
+    reloaded: the task is back in the queue, the lathe and the new task are not.
+    """
+    from cnc_api.workshop.dispatcher import Dispatcher
+
+    lathe = Machine.objects.create(name="Lathe", machine_type="lathe", status="idle")
+    queued = Task.objects.create(
+            order=Order.objects.create(name="Queued"), queue_number=1,
+            required_machine_type="lathe", queued_at=timezone.now()
+    )
+    dispatcher = Dispatcher()
+    dispatcher.reload()
+    # A direct start (not through the services) bypasses the state
+    Machine.objects.filter(pk=lathe.pk).update(status="running")
+    unseen = Task.objects.create(
+            order=Order.objects.create(name="Unseen"), queue_number=1,
+            required_machine_type="lathe", queued_at=timezone.now()
+    )
+
+    assert dispatcher.run_once() == []
+    assert queued.pk in dispatcher.state.queued_ids
+    assert lathe.pk not in dispatcher.state.idle
+    assert unseen.pk not in dispatcher.state.queued_ids
+
+    Machine.objects.filter(pk=lathe.pk).update(status="idle")
+    dispatcher.state.refresh(machine_ids=[lathe.pk])
+    assert dispatcher.run_once() == [(queued.pk, lathe.pk)]
+
+
+@pytest.mark.django_db
+def test_thread_mode_hands_freed_machine_to_dispatcher(settings, monkeypatch, django_capture_on_commit_callbacks):
+    """
+    With WORKSHOP_DISPATCHER = "thread", completing a task only sends the
+    idle machine to the dispatcher, which then starts the queued task.
+    """
+    from cnc_api.workshop import dispatcher as dispatcher_module
+    from cnc_api.workshop.services import complete_task
+
+    settings.WORKSHOP_DISPATCHER = "thread"
+    dispatcher = dispatcher_module.Dispatcher()
+    monkeypatch.setattr(dispatcher_module, "get_dispatcher", lambda: dispatcher)
+
+    mill = Machine.objects.create(name="Mill", machine_type="mill", status="running")
+    running = Task.objects.create(
+            order=Order.objects.create(name="Running"), queue_number=1,
+            required_machine_type="mill", status="in_progress", machine=mill
+    )
+    waiting = Task.objects.create(
+            order=Order.objects.create(name="Waiting"), queue_number=1,
+            required_machine_type="mill", queued_at=timezone.now()
+    )
+    dispatcher.reload()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        complete_task(running)
+    waiting.refresh_from_db()
+    assert waiting.status == "pending"
+    assert dispatcher.inbox.qsize() == 1
+
+    assert dispatcher.run_once() == [(waiting.pk, mill.pk)]
+    waiting.refresh_from_db()
+    assert waiting.status == "in_progress" and waiting.machine == mill
+
+
+@pytest.mark.django_db
+def test_mill_turn_capabilities_through_the_api(monkeypatch):
+    """
+    A lathe that also mills, faster than the plain mill:
+    assert the capabilities are written with the machine and
+    a mill task starts on the fastest idle machine able to do it.
+    """
+    from cnc_api.workshop.serializers import MachineSerializer
+    from cnc_api.workshop.services import start_task_with_auto_machine_assignation
+
+    admin = User.objects.create_user(username="admin", password="admin123")
+    admin.groups.add(Group.objects.create(name="admin"))
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    Machine.objects.create(name="Mill", machine_type="mill", status="idle")
+    response = client.post(
+            "/api/machines/",
+            {
+                "name": "Mill-turn", "machine_type": "lathe",
+                "capabilities": [{"machine_type": "mill", "speed_factor": 1.5}],
+            },
+            format="json"
+    )
+    assert response.status_code == 201
+    mill_turn_id = response.data["machine_id"]
+    response = client.get(f"/api/machines/{mill_turn_id}/")
+    assert response.data["capabilities"] == [{"machine_type": "mill", "speed_factor": 1.5}]
+
+    task = Task.objects.create(order=Order.objects.create(name="Milling"), queue_number=1, required_machine_type="mill")
+    start_task_with_auto_machine_assignation(task)
+    assert str(task.machine.pk) == mill_turn_id
+
+    # A failure while writing the capabilities leaves the machine as it was
+    def fail(self, machine, capabilities):
+        raise RuntimeError("capabilities not written")
+
+    monkeypatch.setattr(MachineSerializer, "save_capabilities", fail)
+    with pytest.raises(RuntimeError):
+        client.patch(
+                f"/api/machines/{mill_turn_id}/",
+                {"name": "Renamed", "capabilities": [{"machine_type": "grinder", "speed_factor": 1.0}]},
+                format="json"
+        )
+    monkeypatch.undo()
+    mill_turn = Machine.objects.get(pk=mill_turn_id)
+    assert mill_turn.name == "Mill-turn"
+    assert list(mill_turn.capabilities.values_list("machine_type", flat=True)) == ["mill"]
+
+    # The list sent replaces the previous one
+    response = client.patch(f"/api/machines/{mill_turn_id}/", {"capabilities": []}, format="json")
+    assert response.status_code == 200
+    assert not Machine.objects.get(pk=mill_turn_id).capabilities.exists()
+
+
+@pytest.mark.django_db
+def test_batch_assignment_is_optimal_not_first_idle():
+    """
+    A lathe, a mill-turn and a queued lathe task ahead of a mill task:
+    giving the lathe task to the mill-turn would leave the mill task waiting.
+    Assert one pass starts both, and the numpy Hungarian algorithm finds
+    the same cost as trying every assignment of small matrices.
+    """
+    import itertools
+    import numpy as np
+    from cnc_api.workshop.assignment import hungarian
+    from cnc_api.workshop.dispatcher import Dispatcher
+    from cnc_api.workshop.models import MachineCapability
+
+    mill_turn = Machine.objects.create(name="Mill-turn", machine_type="lathe", status="idle")
+    MachineCapability.objects.create(machine=mill_turn, machine_type="mill")
+    lathe = Machine.objects.create(name="Lathe", machine_type="lathe", status="idle")
+    turning = Task.objects.create(
+            order=Order.objects.create(name="Turning", priority=3), queue_number=1,
+            required_machine_type="lathe", queued_at=timezone.now()
+    )
+    milling = Task.objects.create(
+            order=Order.objects.create(name="Milling"), queue_number=1,
+            required_machine_type="mill", queued_at=timezone.now()
+    )
+
+    assert sorted(Dispatcher().run_once()) == sorted([(turning.pk, lathe.pk), (milling.pk, mill_turn.pk)])
+
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        rows, columns = map(int, rng.integers(1, 6, 2))
+        cost = rng.integers(0, 50, (rows, columns)).astype(float)
+        found_rows, found_columns = hungarian(cost)
+        if rows <= columns:
+            best = min(cost[range(rows), list(p)].sum() for p in itertools.permutations(range(columns), rows))
+        else:
+            best = min(cost[list(p), range(columns)].sum() for p in itertools.permutations(range(rows), columns))
+        assert len(found_rows) == min(rows, columns)
+        assert cost[found_rows, found_columns].sum() == best
+
+
+@pytest.mark.django_db
+def test_usage_counters_trigger_maintenance():
+    """
+    A mill due every 2 tasks: assert completing tasks adds to its counters,
+    the second one sends it to maintenance, and passing the maintenance
+    restarts the counters since the last one (not the totals).
+    Assert the sweep also catches an idle machine over its hours.
+    """
+    from rest_framework.exceptions import ValidationError
+    from cnc_api.workshop.services import check_need_maintenance_all_machines, complete_task
+
+    admin = User.objects.create_user(username="admin", password="admin123")
+    admin.groups.add(Group.objects.create(name="admin"))
+    client = APIClient()
+    client.force_authenticate(user=admin)
+
+    mill = Machine.objects.create(name="Mill", machine_type="mill", maintenance_gap_cycles=2)
+    for number in range(2):
+        task = Task.objects.create(
+                order=Order.objects.create(name=f"Order {number}"), queue_number=1,
+                required_machine_type="mill", machine=mill, status="in_progress",
+                start_time=timezone.now() - timedelta(hours=1, minutes=30)
+        )
+        Machine.objects.filter(pk=mill.pk).update(status="running")
+        assert client.put(f"/api/tasks/{task.task_id}/complete/").status_code == 200
+        mill.refresh_from_db()
+        assert mill.cycles_since_maintenance == number + 1
+        assert mill.total_hours == pytest.approx(1.5 * (number + 1), abs=0.01)
+    assert mill.status == "maintenance"
+
+    # A stale copy of the task (a concurrent completion) isn't counted again
+    stale = Task.objects.get(pk=task.pk)
+    stale.status = "in_progress"
+    with pytest.raises(ValidationError):
+        complete_task(stale)
+    mill.refresh_from_db()
+    assert mill.total_cycles == 2
+
+    assert client.put(f"/api/machines/{mill.machine_id}/pass_maintenance/").status_code == 200
+    mill.refresh_from_db()
+    assert (mill.cycles_since_maintenance, mill.hours_since_maintenance) == (0, 0)
+    assert mill.total_cycles == 2
+
+    # Over its hours while idle (a maintenance gap changed by hand...)
+    lathe = Machine.objects.create(name="Lathe", machine_type="lathe", maintenance_gap_hours=100)
+    Machine.objects.filter(pk=lathe.pk).update(hours_since_maintenance=120)
+    assert check_need_maintenance_all_machines() == [lathe.pk]
+    lathe.refresh_from_db()
+    assert lathe.status == "maintenance"
+    assert ActivityLog.objects.filter(message__contains="Lathe is now under MAINTENANCE").exists()
+
+
+def make_due(machine):
+    """Last maintenance 20 days ago with a gap of 10."""
+    last = timezone.now().date() - timedelta(days=20)
+    Machine.objects.filter(pk=machine.pk).update(
+            last_maintenance=last, maintenance_gap_days=10, maintenance_due_date=last + timedelta(days=10)
+    )
+
+
+@pytest.mark.django_db
+def test_start_checks_only_the_machine_it_takes():
+    """
+    The fastest lathe is due: assert the task starts on the other one,
+    the due lathe goes to maintenance, and a due grinder (not needed
+    by the task) is left for the sweeper.
+    """
+    from cnc_api.workshop.models import MachineCapability
+    from cnc_api.workshop.services import start_task_with_auto_machine_assignation
+
+    due_lathe = Machine.objects.create(name="Due lathe", machine_type="lathe")
+    MachineCapability.objects.create(machine=due_lathe, machine_type="lathe", speed_factor=2.0)
+    lathe = Machine.objects.create(name="Lathe", machine_type="lathe")
+    grinder = Machine.objects.create(name="Grinder", machine_type="grinder")
+    make_due(due_lathe)
+    make_due(grinder)
+
+    task = Task.objects.create(order=Order.objects.create(name="Turning"), queue_number=1, required_machine_type="lathe")
+    start_task_with_auto_machine_assignation(task)
+    assert task.machine == lathe
+    assert Machine.objects.get(pk=due_lathe.pk).status == "maintenance"
+    assert Machine.objects.get(pk=grinder.pk).status == "idle"
+
+
+@pytest.mark.django_db
+def test_maintenance_sweeper_sweeps_on_schedule_and_day_change():
+    """
+    Assert a sweep sends the due machines to maintenance and purges old
+    tombstones, and the next one is due after the interval or when the day changes.
+    """
+    from cnc_api.workshop.models import DeletedRecord
+    from cnc_api.workshop.sweeper import MaintenanceSweeper, seconds_to_midnight
+
+    grinder = Machine.objects.create(name="Grinder", machine_type="grinder")
+    make_due(grinder)
+    old = DeletedRecord.objects.create(resource="order", object_id=grinder.pk)
+    DeletedRecord.objects.filter(pk=old.pk).update(deleted_at=timezone.now() - timedelta(days=90))
+
+    sweeper = MaintenanceSweeper(interval_seconds=3600)
+    assert sweeper.is_due()
+    assert sweeper.sweep() == ([grinder.pk], 1)
+    assert Machine.objects.get(pk=grinder.pk).status == "maintenance"
+    assert not sweeper.is_due()
+    assert sweeper.seconds_to_next_sweep() <= min(3600, seconds_to_midnight(timezone.now()) + 1)
+
+    sweeper.swept_on -= timedelta(days=1)
+    assert sweeper.is_due()
+
+
+@pytest.mark.django_db
+def test_maintenance_plan_staggers_machines_due_together():
+    """
+    Three mills due in two days and a day of milling work:
+    assert the plan keeps every machine on or before its due date,
+    doesn't take the three down the same day, and delays the work
+    less than sending them all on their due date.
+    """
+    client = APIClient()
+    client.force_authenticate(user=User.objects.create_user(username="planner", password="planner123"))
+
+    last = timezone.now().date() - timedelta(days=8)
+    mills = [Machine.objects.create(name=f"Mill {n}", machine_type="mill") for n in range(3)]
+    Machine.objects.filter(machine_type="mill").update(
+            last_maintenance=last, maintenance_gap_days=10, maintenance_due_date=last + timedelta(days=10)
+    )
+    order = Order.objects.create(name="Milling")
+    for number in range(40):
+        Task.objects.create(
+                order=order, queue_number=number, required_machine_type="mill",
+                estimated_duration=timedelta(hours=1)
+        )
+
+    response = client.get("/api/maintenance/plan/", {"horizon_days": 7})
+    assert response.status_code == 200
+    schedule = response.data["schedule"]
+    assert {row["machine_id"] for row in schedule} == {str(mill.pk) for mill in mills}
+    assert all(row["planned_date"] <= row["due_date"] for row in schedule)
+    assert len({row["planned_date"] for row in schedule}) > 1
+    mill_plan = response.data["machine_types"]["mill"]
+    assert mill_plan["backlog_hours"] == 40
+    assert mill_plan["delay_hour_days"] < mill_plan["delay_hour_days_at_due_dates"]
+
+    assert client.get("/api/maintenance/plan/", {"horizon_days": 365}).status_code == 400
+
+
+@pytest.mark.django_db
+def test_watchdog_notifies_then_fails_stale_tasks(settings):
+    """
+    Assert tasks running far longer than expected (their estimate or the
+    duration statistics of the operation) are logged once, the ones past the fail
+    factor fail and their machine takes the next queued task.
+    """
+    from cnc_api.workshop.estimates import record_duration
+    from cnc_api.workshop.services import fail_task
+    from cnc_api.workshop.watchdog import check_stale_tasks
+
+    settings.WORKSHOP_WATCHDOG_FAIL_FACTOR = 4
+    now = timezone.now()
+    order = Order.objects.create(name="Stale")
+
+    def running(name, hours_ago, operation="drilling", **fields):
+        machine = Machine.objects.create(name=name, machine_type="mill", status="running")
+        return Task.objects.create(
+                order=order, queue_number=1, required_machine_type="mill", operation=operation,
+                status="in_progress", machine=machine, start_time=now - timedelta(hours=hours_ago), **fields
+        )
+
+    forgotten = running("Mill 1", 5, estimated_duration=timedelta(hours=1))
+    late = running("Mill 2", 3, estimated_duration=timedelta(hours=1))
+    unestimated = running("Mill 3", 2, operation="milling")
+    on_time = running("Mill 4", 1, estimated_duration=timedelta(hours=1))
+    # Milling usually takes half an hour (drilling has no statistics yet)
+    for _ in range(3):
+        record_duration(Task(
+                order=order, required_machine_type="mill", operation="milling",
+                start_time=now - timedelta(days=1), finish_time=now - timedelta(days=1) + timedelta(minutes=30)
+        ))
+    waiting = Task.objects.create(
+            order=Order.objects.create(name="Waiting"), queue_number=1,
+            required_machine_type="mill", queued_at=now
+    )
+
+    result = check_stale_tasks(now=now)
+    assert result["failed"] == [forgotten.pk]
+    assert set(result["notified"]) == {late.pk, unestimated.pk}
+    forgotten.refresh_from_db()
+    waiting.refresh_from_db()
+    assert forgotten.status == "failed"
+    assert waiting.status == "in_progress" and waiting.machine == forgotten.machine
+    on_time.refresh_from_db()
+    assert on_time.overdue_at is None
+
+    # Notified once
+    assert check_stale_tasks(now=now) == {"notified": [], "failed": []}
+
+    # Completed by an operator after the watchdog read it: left alone
+    Task.objects.filter(pk=late.pk).update(status="completed", finish_time=now)
+    assert fail_task(late, "stale") is None
+    assert late.status == "completed"
+    assert Machine.objects.get(pk=late.machine_id).status == "running"
+
+
+@pytest.mark.django_db
+def test_failed_task_blocks_its_successors():
+    """
+    Fail the first task of a chain of three.
+    Assert the two after it stay pending, are logged as blocked and are
+    listed as blocked by the critical path of the order.
+    """
+    from cnc_api.workshop.services import fail_task
+
+    operator = User.objects.create_user(username="op1", password="operator123")
+    client = APIClient()
+    client.force_authenticate(user=operator)
+    machine = Machine.objects.create(name="Lathe", machine_type="lathe", status="running")
+    order = Order.objects.create(name="Order Blocked", status="in_progress")
+    turning = Task.objects.create(
+            order=order, queue_number=1, required_machine_type="lathe", operation="turning",
+            status="in_progress", machine=machine, start_time=timezone.now()
+    )
+    grinding = Task.objects.create(order=order, queue_number=2, required_machine_type="lathe", operation="grinding")
+    polishing = Task.objects.create(order=order, queue_number=3, required_machine_type="lathe", operation="polishing")
+
+    fail_task(turning, "tool broke")
+
+    grinding.refresh_from_db()
+    assert grinding.status == "pending" and grinding.queued_at is None
+    warning = ActivityLog.objects.get(task=turning, log_type="warning")
+    assert "'grinding', 'polishing'" in warning.message
+    path = client.get(f"/api/orders/{order.order_id}/critical_path/").json()
+    assert path["blocked"] == [str(grinding.task_id), str(polishing.task_id)]
+
+
+def test_duration_statistics_match_the_sample():
+    """
+    Assert the streamed statistics (Welford mean and variance, P² median
+    and 90th percentile) stay close to the exact ones of the sample.
+    """
+    import numpy as np
+    from cnc_api.workshop.estimates import observe, quantile_seconds
+
+    rng = np.random.default_rng(50)
+    durations = rng.lognormal(mean=7, sigma=0.5, size=5000)
+    stat = DurationStat(operation="milling", machine_type="mill")
+    for seconds in durations:
+        observe(stat, float(seconds))
+
+    assert stat.count == 5000
+    assert stat.mean_seconds == pytest.approx(durations.mean())
+    assert stat.variance_seconds == pytest.approx(durations.var(ddof=1))
+    assert quantile_seconds(stat, 0.5) == pytest.approx(np.quantile(durations, 0.5), rel=0.03)
+    assert quantile_seconds(stat, 0.9) == pytest.approx(np.quantile(durations, 0.9), rel=0.03)
+
+
+@pytest.mark.django_db
+def test_completed_tasks_update_duration_statistics_and_etas(settings):
+    """
+    Assert completing tasks records their durations per machine and per
+    machine type, a starting task gets a predicted finish from them,
+    and the ETA of an order follows its dependencies.
+    """
+    from django.utils.dateparse import parse_datetime
+    from rest_framework.exceptions import ValidationError
+    from cnc_api.workshop.services import complete_task
+
+    settings.WORKSHOP_STATS_MIN_COUNT = 2
+    admin = User.objects.create_user(username="admin", password="admin123")
+    admin.groups.add(Group.objects.create(name="admin"))
+    client = APIClient()
+    client.force_authenticate(user=admin)
+    machine = Machine.objects.create(name="Mill", machine_type="mill")
+    history = Order.objects.create(name="History")
+    for minutes in (20, 40):
+        task = Task.objects.create(
+                order=history, queue_number=1, required_machine_type="mill", operation="milling",
+                status="in_progress", machine=machine, start_time=timezone.now() - timedelta(minutes=minutes)
+        )
+        machine.status = "running"
+        machine.save()
+        assert client.put(f"/api/tasks/{task.pk}/complete/").status_code == 200
+
+    # Completing a stale copy again (a concurrent request) adds nothing
+    stale = Task.objects.get(pk=task.pk)
+    stale.status = "in_progress"
+    with pytest.raises(ValidationError):
+        complete_task(stale)
+
+    stats = {stat.machine_id: stat for stat in DurationStat.objects.filter(operation="milling")}
+    assert set(stats) == {machine.pk, None}
+    assert stats[None].count == 2
+    assert stats[None].mean_seconds == pytest.approx(30 * 60, abs=5)
+    response = client.get("/api/duration-stats/", {"machine_type": "mill"})
+    assert response.status_code == 200
+
+    order = Order.objects.create(name="Next")
+    first = Task.objects.create(order=order, queue_number=1, required_machine_type="mill", operation="milling")
+    second = Task.objects.create(
+            order=order, queue_number=2, required_machine_type="mill", operation="milling",
+            estimated_duration=timedelta(hours=2)
+    )
+    second.predecessors.add(first)
+    assert client.put(f"/api/orders/{order.pk}/start/").status_code == 200
+    first.refresh_from_db()
+    assert first.predicted_finish - first.start_time == pytest.approx(timedelta(minutes=30), abs=timedelta(seconds=5))
+
+    eta = client.get(f"/api/orders/{order.pk}/eta/").json()
+    projected = parse_datetime(eta["projected_completion"])
+    # The second task uses the milling statistics too, not its estimate
+    assert projected - first.start_time == pytest.approx(timedelta(hours=1), abs=timedelta(seconds=5))
+    assert parse_datetime(eta["projected_completion_p90"]) >= projected
+    assert set(eta["tasks"]) == {str(first.pk), str(second.pk)}
+
+
+# TEST LOAD GENERATOR
+def test_load_generator_stats_and_login_retry():
+    """
+    Assert the load generator summarizes the latencies and errors per
+    endpoint, and a request that keeps getting 401 is retried once
+    after a new login, then counted as an error.
+    """
+    import asyncio
+    from types import SimpleNamespace
+    from cnc_api.loadtest.shop_floor import Stats, VirtualUser
+
+    stats = Stats()
+    for milliseconds in range(1, 101):
+        stats.record("machines-list", milliseconds / 1000, "ok" if milliseconds <= 98 else "http_500")
+    window = stats.flush_window(interval=10)
+    assert window["requests"] == 100 and window["throughput_rps"] == 10
+    assert (window["p50_ms"], window["p95_ms"], window["p99_ms"]) == (50, 95, 99)
+    assert window["errors"] == {"http_500": 2}
+    assert stats.summary()["machines-list"]["errors"] == {"http_500": 2}
+
+    class RejectingHttp:
+        """Logs in fine, but every token is rejected."""
+
+        def __init__(self):
+            self.token = None
+            self.requests = []
+
+        async def request(self, method, path, payload=None):
+            self.requests.append(path)
+            if path == "/api/token/":
+                return 200, b'{"access": "token"}'
+            return 401, b'{"detail": "Token is invalid or expired"}'
+
+        async def close(self):
+            pass
+
+    options = SimpleNamespace(url="http://localhost:8000", timeout=1, seed=1, password="secret")
+    user = VirtualUser(options, Stats(), "operator", 0)
+    user.http = RejectingHttp()
+
+    status, _ = asyncio.run(user.call("tasks-list", "GET", "/api/tasks/"))
+    assert status == 401
+    assert user.http.requests == ["/api/tasks/", "/api/token/", "/api/tasks/"]
+    assert user.stats.summary()["tasks-list"]["errors"] == {"http_401": 1}
@@ -0,0 +1,74 @@
+"""
+Token-bucket rate limits, per user and per endpoint.
+Every (user, endpoint) pair has a bucket that holds up to N tokens and
+refills at N tokens per period; a request takes one token. Bursts up to N
+are allowed, a script calling in a loop is held to the refill rate.
+The budget (N/period) depends on the scope of the endpoint:
+- "export": the log exports (the heaviest reads).
+- "write": POST/PUT/PATCH/DELETE, including start and complete.
+- "read": everything else.
+The buckets live in the default cache, so all the workers share them
+when the cache is shared (locmem is per process).
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+from .metrics import THROTTLED
+
+DEFAULT_RATES = {"export": "30/min", "write": "600/min", "read": "3000/min"}
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_rate(rate):
+    """'30/min' -> (30 tokens, 30 / 60 tokens per second). None -> no limit."""
+    if rate is None:
+        return None, None
+    count, period = rate.split("/")
+    capacity = int(count)
+    return capacity, capacity / PERIODS[period[0]]
+
+
+def get_scope(request, view):
+    """Budget used by the request: the view's own scope for the action, or by method."""
+    scope = getattr(view, "throttle_action_scopes", {}).get(getattr(view, "action", None))
+    if scope:
+        return scope
+    return "read" if request.method in ("GET", "HEAD", "OPTIONS") else "write"
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Applies the WORKSHOP_THROTTLE_RATES budgets.
+    DRF answers a 429 with Retry-After (from wait()) when a bucket is empty.
+    """
+
+    def allow_request(self, request, view):
+        self.scope = get_scope(request, view)
+        rates = getattr(settings, "WORKSHOP_THROTTLE_RATES", DEFAULT_RATES)
+        self.capacity, self.refill = parse_rate(rates.get(self.scope))
+        if self.capacity is None:
+            return True
+
+        user = request.user
+        ident = f"user:{user.pk}" if user and user.is_authenticated else f"ip:{self.get_ident(request)}"
+        endpoint = f"{getattr(view, 'basename', None) or type(view).__name__}:{getattr(view, 'action', None) or request.method}"
+        key = f"workshop:throttle:{self.scope}:{endpoint}:{ident}"
+
+        # Refill by the time since the last request, up to the capacity.
+        # get + set is not atomic: concurrent requests may get a token or two extra
+        now = time.time()
+        tokens, updated = cache.get(key, (self.capacity, now))
+        self.tokens = min(self.capacity, tokens + (now - updated) * self.refill)
+        if self.tokens < 1:
+            THROTTLED.inc(scope=self.scope)
+            return False
+        # Kept until the bucket would be full again (then it is the same as missing)
+        cache.set(key, (self.tokens - 1, now), int(self.capacity / self.refill) + 1)
+        return True
+
+    def wait(self):
+        """Seconds until the bucket has a token again."""
+        return (1 - self.tokens) / self.refill
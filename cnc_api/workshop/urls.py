@@ -1,6 +1,6 @@
 from rest_framework.routers import DefaultRouter
 from django.urls import path, include
-from .views import OrderViewSet, MachineViewSet, TaskViewSet, ActivityLogViewSet
+from .views import OrderViewSet, MachineViewSet, TaskViewSet, ActivityLogViewSet, DurationStatViewSet, ProfileViewSet, SyncView, MaintenancePlanView
 
 # Create a DefaultRouter instance to automatically generate URL patterns for the viewsets
 router = DefaultRouter()
@@ -10,9 +10,17 @@ router.register(r"orders", OrderViewSet)
 router.register(r"machines", MachineViewSet)
 router.register(r"tasks", TaskViewSet)
 router.register(r"activitylogs", ActivityLogViewSet)
+# Duration statistics of the operations (read only)
+router.register(r"duration-stats", DurationStatViewSet)
+# Stored request profiles (admins only)
+router.register(r"profiles", ProfileViewSet, basename="profile")
 
 # Define the URL patterns for this app
 urlpatterns = [
     # Include all automatically generated routes from the router
     path("", include(router.urls)),
+    # Changes since the last sync (shop floor tablets)
+    path("sync/", SyncView.as_view(), name="sync"),
+    # Staggered maintenance schedule
+    path("maintenance/plan/", MaintenancePlanView.as_view(), name="maintenance-plan"),
 ]
\ No newline at end of file
@@ -4,32 +4,127 @@ Each class responds to each resource.
 ModelViewSet simplifies the API creating CRUD for each model.
 """
 import csv
+import json
 
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from django.http import HttpResponse, JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import FileResponse, Http404, StreamingHttpResponse
 from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 
-from .models import Order, Machine, Task, ActivityLog
-from .permissions import IsAdminOrReadOnly
+from .conditional import ConditionalGetMixin
+from .metrics import MetricsMixin
+from .models import Order, Machine, Task, ActivityLog, DurationStat
+from .permissions import IsAdmin, IsAdminOrReadOnly
+from .profiling import ProfilingMixin, list_profiles
+from .renderers import message_packer
+from .response_cache import ResponseCacheMixin
 from .serializers import OrderSerializer, MachineSerializer, TaskSerializer, ActivityLogSerializer
+from .serializers import DurationStatSerializer
 from .services import start_task_with_auto_machine_assignation as start_auto
+from .services import complete_task, dispatch_machine, pass_machine_maintenance, TaskQueued
+from .services import get_backlog, release_ready_tasks, update_order_schedule
+from .dependencies import critical_path
+from .estimates import projected_completion
+from .planner import plan_maintenance
 from .services import create_log_event_task
-from .services import check_need_maintenance_all_machines
+from .sync import ExpiredToken, InvalidToken, collect_changes
+
+# Rows read and serialized at a time by the streamed exports
+EXPORT_BATCH_SIZE = 2000
+
+
+def batches(rows, size):
+    """Splits an iterator of rows into lists of `size` rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class EchoBuffer:
+    """File-like object for csv.writer: returns the line instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+class WorkshopViewSet(
+        ProfilingMixin,
+        MetricsMixin,
+        ConditionalGetMixin,
+        ResponseCacheMixin,
+        viewsets.ModelViewSet
+):
+    """
+    Base for the workshop viewsets.
+    Adds the instrumentation shared by every resource
+    and the cheap paths for reads (304s, cached responses).
+    """
+    # Nested field -> lookups to prefetch when the field is in the response
+    nested_prefetches = {}
+
+    def selected_field_names(self):
+        """Fields left in the response after ?fields= and ?omit=."""
+        return set(self.get_serializer().fields)
+
+    def get_queryset(self):
+        """
+        For list and retrieve, load only the columns of the selected fields
+        and prefetch only the nested rows that are shown.
+        """
+        queryset = super().get_queryset()
+        if self.action not in ("list", "retrieve"):
+            return queryset
+        selected = self.selected_field_names()
+        model_fields = {f.name for f in queryset.model._meta.concrete_fields}
+        columns = [name for name in selected if name in model_fields]
+        if columns:
+            queryset = queryset.only(*columns)
+        for name, lookups in self.nested_prefetches.items():
+            if name in selected:
+                queryset = queryset.prefetch_related(*lookups)
+        return queryset
+
+    def get_conditional_relations(self):
+        """Nested relations in the ETag, skipping the ones not shown."""
+        selected = self.selected_field_names()
+        return [
+            relation for relation in self.conditional_relations
+            if relation.split("__")[0] in selected
+        ]
+
 
 # Create your views here.
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(WorkshopViewSet):
     # Give the permissions set in permissions.py
     permission_classes = [IsAdminOrReadOnly]
     
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
+    # Orders show their tasks and the logs of those tasks
+    cache_dependencies = ("order", "task", "activitylog")
+    conditional_relations = ("tasks", "tasks__logs")
+    nested_prefetches = {"tasks": ("tasks__logs", "tasks__predecessors")}
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = ["status", "date_completion"]
+    filterset_fields = ["status", "date_completion", "priority"]
+
+    def perform_update(self, serializer):
+        # The tasks keep the priority and due date of their order
+        old_schedule = (serializer.instance.priority, serializer.instance.due_date)
+        order = serializer.save()
+        if (order.priority, order.due_date) != old_schedule:
+            update_order_schedule(order)
 
     @action(detail=True, methods=["get", "put"], name="Start")
     def start(self, request, pk=None):
@@ -37,7 +132,7 @@ class OrderViewSet(viewsets.ModelViewSet):
         Start an order.
         Task must have machines assigned.
         Only "pending" tasks can be started.
-        Then activate the first task.
+        Then activate the first tasks (every one without predecessors).
         """
         order = self.get_object()
 
@@ -52,65 +147,96 @@ class OrderViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Get the first task on the queue
-        first_task = order.tasks.order_by("queue_number").first()
-        
-        if first_task:
-            try:
-                # Start the task and log it
-                task = start_auto(first_task)
-                # Create a log when the order start.
-                create_log_event_task(
-                        task,
-                        log_type="info",
-                        message=f"'{task.order.name}' is now IN PROGRESS.",
-                        user=request.user if request.user.is_authenticated else None
-                )
-                # Create a log when the task starts.
-                create_log_event_task(
-                        task=task,
-                        log_type="info",
-                        message=f"'{task.operation}' started on machine '{task.machine.name}'.",
-                        user=request.user if request.user.is_authenticated else None
-                )
-                # Change the status and starting date, then save the updated order
-                order.status = "in_progress"
-                order.date_start = timezone.now()
-                order.save()
-                
-                return Response(
-                        {"detail": f"Task {task.task_id} started (machine: '{task.machine.name}')"},
-                        status=status.HTTP_200_OK
-                )
-            except ValidationError as e:
-                return Response(
-                        {"detail": str(e.detail)},
-                        status=status.HTTP_400_BAD_REQUEST
-                )
-        else:
+        if not order.tasks.exists():
             return Response(
                         {"detail": f"Order '{order.name}' cannot be started - No tasks are found."},
                         status=status.HTTP_400_BAD_REQUEST
                 )
 
+        user = request.user if request.user.is_authenticated else None
+        # Start every task without pending predecessors (the first one for a chain)
+        started, queued = release_ready_tasks(order, user=user)
+        if not started:
+            detail = TaskQueued.default_detail if queued else "No task of the order is ready to start."
+            return Response(
+                    {"detail": detail},
+                    status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Create a log when the order start.
+        create_log_event_task(
+                started[0],
+                log_type="info",
+                message=f"'{order.name}' is now IN PROGRESS.",
+                user=user
+        )
+        # Change the status and starting date, then save the updated order
+        order.status = "in_progress"
+        order.date_start = timezone.now()
+        order.save()
+
+        detail = ", ".join(f"Task {task.task_id} started (machine: '{task.machine.name}')" for task in started)
+        if queued:
+            detail += f". {len(queued)} task(s) queued waiting for a machine"
+        return Response(
+                {"detail": detail},
+                status=status.HTTP_200_OK
+        )
 
-class MachineViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=["get"])
+    def critical_path(self, request, pk=None):
+        """
+        Minimum time the order needs (makespan) with unlimited machines:
+        the longest chain of dependent tasks, and the slack of every task.
+        """
+        order = self.get_object()
+        return Response(critical_path(order.pk))
+
+    @action(detail=True, methods=["get"])
+    def eta(self, request, pk=None):
+        """
+        When the order should be completed, from the duration statistics
+        of its operations (mean and 90th percentile), and when each task should finish.
+        """
+        order = self.get_object()
+        return Response(projected_completion(order.pk))
+
+
+class MachineViewSet(WorkshopViewSet):
     # Give the permissions set in permissions.py
     permission_classes = [IsAdminOrReadOnly]
 
     queryset = Machine.objects.all()
     serializer_class = MachineSerializer
+    # Machines show their tasks and the logs of those tasks
+    cache_dependencies = ("machine", "task", "activitylog")
+    conditional_relations = ("tasks", "tasks__logs")
+    # Capabilities are only written with their machine (its updated_at changes)
+    nested_prefetches = {
+        "tasks": ("tasks__logs", "tasks__predecessors"),
+        "capabilities": ("capabilities",),
+    }
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["status", "machine_type"]
 
+    def perform_create(self, serializer):
+        # A new idle machine takes the first task of the dispatch queue
+        machine = serializer.save()
+        if machine.status == "idle":
+            dispatch_machine(machine)
+
+    def perform_update(self, serializer):
+        # Same for a machine set back to idle by hand
+        machine = serializer.save()
+        if machine.status == "idle":
+            dispatch_machine(machine)
+
     @action(detail=True, methods=["get", "put"], name="Pass maintenance")
     def pass_maintenance(self, request, pk=None):
         """Passes the maintenance of a machine."""
         machine = self.get_object()
-        machine.last_maintenance = timezone.now().date()
         if machine.status == "maintenance":
-            machine.status = "idle"
-            machine.save()
+            machine = pass_machine_maintenance(machine)
             # Log the pass of the maintenance
             message = f"Machine '{machine.name}' passed its maintenance on {machine.last_maintenance}."
             create_log_event_task(
@@ -130,12 +256,40 @@ class MachineViewSet(viewsets.ModelViewSet):
             )
         
 
-class TaskViewSet(viewsets.ModelViewSet):
+class TaskViewSet(WorkshopViewSet):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
+    conditional_relations = ("logs",)
+    nested_prefetches = {"logs": ("logs",), "predecessors": ("predecessors",)}
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["status", "order", "machine"]
 
+    @action(detail=False, methods=["get"])
+    def backlog(self, request):
+        """
+        The dispatch queue of every machine type, in the order the tasks
+        will start (priority, due date, time queued).
+        ?machine_type= for only one type, ?limit= tasks per type (default 100).
+        """
+        types = [machine_type for machine_type, _ in Machine.TYPE_POSSIBLE]
+        machine_type = request.query_params.get("machine_type")
+        if machine_type:
+            if machine_type not in types:
+                raise ValidationError({"machine_type": f"Unknown machine type '{machine_type}'."})
+            types = [machine_type]
+        try:
+            limit = min(int(request.query_params.get("limit", 100)), 1000)
+        except ValueError:
+            raise ValidationError({"limit": "Must be a number."})
+
+        return Response({
+            machine_type: [
+                {"position": position, **task}
+                for position, task in enumerate(get_backlog(machine_type, limit), start=1)
+            ]
+            for machine_type in types
+        })
+
     @action(detail=True, methods=["get", "put"])
     def start(self, request, pk=None):
         """
@@ -172,67 +326,50 @@ class TaskViewSet(viewsets.ModelViewSet):
         Tasks that are not "in_progress" cannot be completed.
         Task status changes.
         Machine changes to "idle" if it was on "running".
-        Next task (if any) starts.
+        Next tasks (the ones with all their predecessors completed) start.
         """
         task = self.get_object()
+        user = request.user if request.user.is_authenticated else None
 
         if task.status != "in_progress":
             return Response(
                     {"detail": "Cannot complete a task that is not 'in_progress'."},
                     status=status.HTTP_400_BAD_REQUEST
             )
-        # Change the status and save the updated task
-        task.status = "completed"
-        task.finish_time = timezone.now()
-        task.save()
+        # Change the status of the task and free its machine
+        task = complete_task(task)
         # Create the log for the task completion
         create_log_event_task(
                 task,
                 log_type="info",
                 message=f"'{task.operation}' completed",
-                user=request.user if request.user.is_authenticated else None
+                user=user
         )
-        # Change the status for the used machine depending if it needs or not maintenance
-        if task.machine.needs_maintenance:
-            task.machine.status = "maintenance"
-        else:
-            task.machine.status = "idle"
-        task.machine.save()
 
-        # Checks if there is any machine that needs maintenance but still has "idle" status
-        check_need_maintenance_all_machines()
         # Create a log for the task that created the maintenance
+        # (the other due machines are found by the maintenance sweeper)
         if task.machine.status == "maintenance":
             create_log_event_task(
                     task=task,
                     log_type="warning",
                     message=f"Task {task.task_id} was completed. '{task.machine.name}' is now under MAINTENANCE.",
-                    user=request.user if request.user.is_authenticated else None
+                    user=user
             )
 
 
-        # Look for the next task on the order
-        next_task = (
-            Task.objects
-            .filter(order=task.order, queue_number__gt=task.queue_number, status="pending")
-            .order_by("queue_number")
-            .first()
-        )
-        # Start the new task
-        if next_task and next_task.status == "pending":
-            task = start_auto(next_task)
-            create_log_event_task(
-                    task,
-                    log_type="info",
-                    message=f"'{task.operation}' started on machine '{task.machine.name}'.",
-                    user=request.user if request.user.is_authenticated else None
-            )
-
+        # Start the tasks of the order that were waiting for this one
+        started, queued = release_ready_tasks(task.order, user=user)
+        if started or queued:
+            detail = f"Task {task.task_id} completed."
+            if started:
+                detail += " Started: " + ", ".join(str(t.task_id) for t in started) + "."
+            if queued:
+                detail += " Queued waiting for a machine: " + ", ".join(str(t.task_id) for t in queued) + "."
             return Response(
-                    {"detail": f"Task {next_task.task_id} completed."},
+                    {"detail": detail},
                     status=status.HTTP_200_OK
             )
-        elif not next_task:
+        elif not task.order.tasks.filter(status__in=("pending", "in_progress")).exists():
             # Complete the Order if there are no more tasks
             task.order.date_completion = timezone.now()
             task.order.status = "completed"
@@ -242,7 +379,7 @@ class TaskViewSet(viewsets.ModelViewSet):
                     task,
                     log_type="info",
                     message=f"'{task.order.name}' completed.",
-                    user=request.user if request.user.is_authenticated else None
+                    user=user
             )
             
             return Response(
@@ -250,13 +387,14 @@ class TaskViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_200_OK
             )
         else:
+            # Other branches of the order are still running (or queued)
             return Response(
-                    {"detail": "Tasks must be pending in order to be started."},
-                    status=status.HTTP_400_BAD_REQUEST
+                    {"detail": f"Task {task.task_id} completed. The order is waiting for its other tasks."},
+                    status=status.HTTP_200_OK
             )
 
 
-class ActivityLogViewSet(viewsets.ModelViewSet):
+class ActivityLogViewSet(WorkshopViewSet):
     # Give the permissions set in permissions.py
     permission_classes = [IsAdminOrReadOnly]
 
@@ -264,48 +402,167 @@ class ActivityLogViewSet(viewsets.ModelViewSet):
     serializer_class = ActivityLogSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["log_type", "task"]
+    # The exports have their own (smaller) rate limit
+    throttle_action_scopes = {"export_json": "export", "export_csv": "export"}
 
     @action(detail=False, methods=["get"], url_path="export/json")
     def export_json(self, request):
         """
         Export ActivityLogs as downloadable JSON
+        (or MessagePack with "Accept: application/msgpack")
+        Both are streamed in batches, so big exports don't sit in memory
         """
         queryset = self.filter_queryset(self.get_queryset())
-        serializer = self.get_serializer(queryset, many=True)
-        data = serializer.data
+
+        # Same export in MessagePack if the client asked for it
+        if request.accepted_renderer.format == "msgpack":
+            response = StreamingHttpResponse(self.stream_msgpack(queryset), content_type="application/msgpack")
+            response["Content-Disposition"] = 'attachment; filename="activity_logs.msgpack"'
+            return response
 
         # Handle JSON export
-        response = JsonResponse(data, safe=False)
+        response = StreamingHttpResponse(self.stream_json(queryset), content_type="application/json")
         # Make the export auto-downloadable
         response["Content-Disposition"] = 'attachment; filename="activity_logs.json"'
         return response
+
+    def stream_json(self, queryset):
+        """The JSON array of the logs, one batch of rows at a time."""
+        yield "["
+        separator = ""
+        for batch in batches(queryset.iterator(chunk_size=EXPORT_BATCH_SIZE), EXPORT_BATCH_SIZE):
+            rows = json.dumps(self.get_serializer(batch, many=True).data, cls=DjangoJSONEncoder)
+            # Drop the brackets of the batch, they go around the whole export
+            yield separator + rows[1:-1]
+            separator = ","
+        yield "]"
+
+    def stream_msgpack(self, queryset):
+        """
+        The MessagePack array of the logs: the array header, then the packed
+        rows one batch at a time.
+        The header needs the number of rows first, so the rows are limited
+        to that count; if logs are deleted while the export streams, the
+        missing slots are sent as nil to keep the array whole.
+        """
+        packer = message_packer()
+        count = queryset.count()
+        yield packer.pack_array_header(count)
+        sent = 0
+        rows = queryset[:count].iterator(chunk_size=EXPORT_BATCH_SIZE)
+        for batch in batches(rows, EXPORT_BATCH_SIZE):
+            yield b"".join(packer.pack(row) for row in self.get_serializer(batch, many=True).data)
+            sent += len(batch)
+        if sent < count:
+            yield packer.pack(None) * (count - sent)
     
     @action(detail=False, methods=["get"], url_path="export/csv")
     def export_csv(self, request):
         """
         Export ActivityLogs as downloadable CSV
+        The CSV is streamed in batches, so big exports don't sit in memory
         """
-        queryset = self.filter_queryset(self.get_queryset())
+        queryset = self.filter_queryset(self.get_queryset()).select_related("user")
         
         # Create CSV response
-        response = HttpResponse(content_type='text/csv')
+        response = StreamingHttpResponse(self.stream_csv(queryset), content_type='text/csv')
         # Make the export auto-downloadable
         response['Content-Disposition'] = 'attachment; filename="activity_logs.csv"'
-        
-        writer = csv.writer(response)
+        return response
+
+    def stream_csv(self, queryset):
+        """The CSV rows of the logs, one batch of rows at a time."""
+        writer = csv.writer(EchoBuffer())
         # Write the header
-        writer.writerow(['log_id', 'log_type', 'message', 'time', 'task_id', 'user_id', 'username'])
+        yield writer.writerow(['log_id', 'log_type', 'message', 'time', 'task_id', 'user_id', 'username'])
         
         # Write the fields for each log in a row
-        for log in queryset:
-            writer.writerow([
-                str(log.log_id),
-                log.log_type,
-                log.message,
-                log.time.isoformat(),
-                str(log.task.task_id) if log.task else '',
-                log.user.id if log.user else '',
-                log.user.username if log.user else ''
-            ])
-        
-        return response
\ No newline at end of file
+        for batch in batches(queryset.iterator(chunk_size=EXPORT_BATCH_SIZE), EXPORT_BATCH_SIZE):
+            yield "".join(
+                    writer.writerow([
+                        str(log.log_id),
+                        log.log_type,
+                        log.message,
+                        log.time.isoformat(),
+                        # The ids are on the log, no need to load the task
+                        str(log.task_id) if log.task_id else '',
+                        log.user_id if log.user_id else '',
+                        log.user.username if log.user_id else ''
+                    ])
+                    for log in batch
+            )
+
+
+class DurationStatViewSet(ProfilingMixin, MetricsMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Duration statistics of the operations, per machine and per machine type
+    (machine empty). Kept up to date by every completed task.
+    """
+    permission_classes = [IsAdminOrReadOnly]
+
+    queryset = DurationStat.objects.order_by("operation", "machine_type", "machine")
+    serializer_class = DurationStatSerializer
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ["operation", "machine_type", "machine"]
+
+
+class ProfileViewSet(viewsets.ViewSet):
+    """
+    Stored request profiles (see profiling.py).
+    Only admins can list and download them.
+    """
+    permission_classes = [IsAdmin]
+    # Profile files are named "<date>-<viewset>-<action>-<id>.<extension>"
+    lookup_value_regex = r"[\w.-]+"
+
+    def list(self, request):
+        """List the stored profiles, newest first."""
+        return Response([
+                {"name": f.name, "size": f.stat().st_size}
+                for f in list_profiles()
+        ])
+
+    def retrieve(self, request, pk=None):
+        """Download a profile file."""
+        # Only serve names that are in the listing to avoid path traversal
+        files = {f.name: f for f in list_profiles()}
+        if pk not in files:
+            raise Http404("Profile not found.")
+        return FileResponse(open(files[pk], "rb"), as_attachment=True, filename=pk)
+
+
+class SyncView(ProfilingMixin, MetricsMixin, APIView):
+    """
+    Changes since the last sync: GET /api/sync/?since=<token>
+    Without "since" every order, machine and task is returned.
+    Answers are paged: while "next" is set, GET /api/sync/?cursor=<next>
+    for the rest. The last page has the token to use on the next sync.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            data = collect_changes(request.query_params.get("since"), request.query_params.get("cursor"))
+        except InvalidToken as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ExpiredToken as e:
+            return Response({"detail": str(e)}, status=status.HTTP_410_GONE)
+        return Response(data)
+
+
+class MaintenancePlanView(ProfilingMixin, MetricsMixin, APIView):
+    """
+    Staggered maintenance schedule: GET /api/maintenance/plan/?horizon_days=21
+    For every machine due within the horizon, the day (not after its due
+    date) its maintenance loses the least production (see planner.py).
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            horizon_days = int(request.query_params.get("horizon_days", 0)) or None
+        except ValueError:
+            raise ValidationError({"horizon_days": "Must be a number."})
+        if horizon_days is not None and not 1 <= horizon_days <= 90:
+            raise ValidationError({"horizon_days": "Must be between 1 and 90."})
+        return Response(plan_maintenance(horizon_days))
@@ -0,0 +1,80 @@
+"""
+Watchdog for stale tasks: an "in_progress" task nobody completes keeps
+its machine "running" forever.
+A task is overdue once it has run longer than its expected duration
+times a factor, plus WORKSHOP_WATCHDOG_GRACE_MINUTES. The expected
+duration is the one of its predicted_finish, or else the one of the
+duration statistics (estimates.expected_duration).
+Policies, each with its own factor (None turns it off):
+- WORKSHOP_WATCHDOG_NOTIFY_FACTOR: a warning log, once per task (Task.overdue_at).
+- WORKSHOP_WATCHDOG_FAIL_FACTOR: the task fails and its machine is
+  released (services.fail_task), so queued tasks can use it. A task
+  completed since the pass read it is skipped.
+A pass only reads the in progress tasks started before the grace period
+(index task_status_start_idx), never the whole table.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .estimates import expected_duration, load_stats
+from .models import Task
+from .services import create_log_event_task, fail_task
+
+DEFAULT_GRACE_MINUTES = 30
+DEFAULT_NOTIFY_FACTOR = 2.0
+
+
+def expected_running_time(task, stats):
+    """What the task was expected to take when it started (or from the statistics now)."""
+    if task.predicted_finish is not None:
+        return task.predicted_finish - task.start_time
+    return expected_duration(task, stats)
+
+
+def check_stale_tasks(now=None, dry_run=False):
+    """
+    One pass of the watchdog. Returns {"notified": [...], "failed": [...]}
+    (task ids); with dry_run nothing is changed.
+    """
+    now = now or timezone.now()
+    grace = timedelta(minutes=getattr(settings, "WORKSHOP_WATCHDOG_GRACE_MINUTES", DEFAULT_GRACE_MINUTES))
+    notify_factor = getattr(settings, "WORKSHOP_WATCHDOG_NOTIFY_FACTOR", DEFAULT_NOTIFY_FACTOR)
+    fail_factor = getattr(settings, "WORKSHOP_WATCHDOG_FAIL_FACTOR", None)
+    result = {"notified": [], "failed": []}
+
+    # Nothing started after this can be overdue
+    tasks = list(
+        Task.objects
+        .filter(status="in_progress", start_time__lt=now - grace)
+        .select_related("machine")
+    )
+    if not tasks:
+        return result
+    stats = load_stats(tasks)
+
+    for task in tasks:
+        expected = expected_running_time(task, stats)
+        running = now - task.start_time
+        machine_type = task.required_machine_type
+        if fail_factor is not None and running > expected * fail_factor + grace:
+            if dry_run:
+                result["failed"].append(task.pk)
+            elif fail_task(task, f"still in progress after {running}, expected {expected}.") is not None:
+                result["failed"].append(task.pk)
+                metrics.STALE_TASKS.inc(action="failed", machine_type=machine_type)
+        elif notify_factor is not None and running > expected * notify_factor + grace and task.overdue_at is None:
+            result["notified"].append(task.pk)
+            if not dry_run:
+                task.overdue_at = now
+                task.save(update_fields=["overdue_at", "updated_at"])
+                create_log_event_task(
+                        task,
+                        log_type="warning",
+                        message=f"'{task.operation}' on '{task.machine}' is overdue: "
+                                f"in progress for {running}, expected {expected}."
+                )
+                metrics.STALE_TASKS.inc(action="notified", machine_type=machine_type)
+    return result